@@ -2,6 +2,10 @@ import time
 import requests
 import json
 import smtplib
+import queue
+import threading
+import collections
+import functools
 from datetime import timezone
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
@@ -10,7 +14,7 @@ import Doberman
 
 dtnow = Doberman.utils.dtnow
 
-__all__ = 'AlarmMonitor'.split()
+__all__ = 'AlarmMonitor NotificationDispatcher ContactDirectory AlarmAggregator AlarmStateTable AlarmDelivery'.split()
 
 
 class AlarmMonitor(Doberman.PipelineMonitor):
@@ -19,20 +23,70 @@ class AlarmMonitor(Doberman.PipelineMonitor):
     """
 
     def setup(self):
+        # the directory and the dispatcher have to exist before the pipelines start
+        self.directory = ContactDirectory(self.db, self.logger)
+        self.directory.refresh()
+        cfg = self.directory.config.get('dispatcher', {})
+        self.dispatcher = NotificationDispatcher(
+            self.logger,
+            senders={'email': self.send_email, 'sms': self.send_sms, 'phone': self.send_phonecall},
+            connectors={'email': self.smtp_connect, 'sms': self.http_session, 'phone': self.http_session},
+            workers=cfg.get('workers', {'email': 1, 'sms': 2, 'phone': 2}),
+            deadline=cfg.get('deadline', 120),
+            retries=cfg.get('retries', 2),
+            backoff=cfg.get('backoff', 5),
+            timeout=cfg.get('timeout', 10),
+            queue_size=cfg.get('queue_size', 100),
+            idle_close=cfg.get('idle_close', 300))
+        window = self.directory.config.get('aggregation', {}).get('window', 10)
+        self.aggregator = AlarmAggregator(window) if window > 0 else None
+        self.alarm_state = AlarmStateTable(self.db, self.logger,
+                                           resync=self.directory.config.get('state_resync', 300))
         super().setup()
-        self.current_shifters = self.db.distinct('contacts', 'name', {'on_shift': True})
-        self.current_shifters.sort()
-        self.register(obj=self.check_shifters, period=60, name='shiftercheck', _no_stop=True)
+        self.current_shifters = self.directory.shifters
+        self.register(obj=self.check_shifters, period=self.directory.config.get('contacts_refresh', 60),
+                      name='shiftercheck', _no_stop=True)
+        if self.aggregator is not None:
+            self.register(obj=self.send_digests, period=1, name='digests', _no_stop=True)
+        self.register(obj=self.alarm_state.flush, period=self.directory.config.get('state_flush', 5),
+                      name='alarmstate', _no_stop=True)
+
+    def shutdown(self):
+        super().shutdown()
+        self.alarm_state.flush()
+        self.dispatcher.close()
 
     def get_connection_details(self, which):
-        detail_doc = self.db.get_experiment_config('alarm')
+        detail_doc = self.directory.config
         try:
             return detail_doc['connection_details'][which]
         except KeyError:
             self.logger.critical(f'Could not load connection details for {which}')
             return None
 
-    def send_phonecall(self, phone_numbers, message):
+    def smtp_connect(self, timeout=None):
+        """
+        Opens (and logs into) an SMTP session
+        """
+        connection_details = self.get_connection_details('email')
+        if connection_details is None:
+            raise ValueError("No email connection details found")
+        server_addr = connection_details['server']
+        if server_addr == 'localhost':  # From localhost
+            return smtplib.SMTP(server_addr, timeout=timeout)
+        # with e.g. gmail
+        server = smtplib.SMTP(server_addr, int(connection_details['port']), timeout=timeout)
+        server.starttls()
+        server.login(connection_details['fromaddr'], connection_details['password'])
+        return server
+
+    def http_session(self, timeout=None):
+        """
+        A session so consecutive requests reuse the connection
+        """
+        return requests.Session()
+
+    def send_phonecall(self, phone_numbers, message, conn=None, timeout=None):
         # Get connection details
         connection_details = self.get_connection_details('twilio')
         if connection_details is None:
@@ -63,22 +117,19 @@ class AlarmMonitor(Doberman.PipelineMonitor):
                 'From': fromnumber,
                 'Parameters': json.dumps({'message': message})
             }
-            response = requests.post(url, auth=auth, data=data)
+            response = (conn or requests).post(url, auth=auth, data=data, timeout=timeout)
             if response.status_code != 201:
                 raise RuntimeError(f"Couldn't place call, status"
                                    + f" {response.status_code}: {response.json()['message']}")
 
-    def send_email(self, addresses, subject, message, level, pipeline):
+    def send_email(self, addresses, subject, message, level, pipeline, conn=None, timeout=None):
         # Get connection details
         connection_details = self.get_connection_details('email')
         if connection_details is None:
             raise ValueError("No email connection details found")
         # Compose connection details and addresses
         now = dtnow().replace(tzinfo=timezone.utc).astimezone(tz=None).strftime("%Y-%m-%d %H:%M %Z")
-        server_addr = connection_details['server']
-        port = int(connection_details['port'])
         fromaddr = connection_details['fromaddr']
-        password = connection_details['password']
         if not isinstance(addresses, list):
             addresses = addresses.split(',')
         msg = MIMEMultipart()
@@ -86,38 +137,42 @@ class AlarmMonitor(Doberman.PipelineMonitor):
         msg['To'] = ', '.join(addresses)
         msg['Subject'] = subject
         message = f'<b>{message}</b>'
+        # digests come from several pipelines
+        pipelines = [p for p in (pipeline if isinstance(pipeline, (list, tuple)) else [pipeline]) if p is not None]
         if website_url := connection_details.get('website', None):
             # add links to view sensors of the pipeline
             message += f'<br><br>Show sensors involved in this pipeline:<ul>'
-            sensors = self.db.get_pipeline(pipeline).get('depends_on', [])
+            sensors = []
+            for p in pipelines:
+                sensors += [s for s in (self.db.get_pipeline(p) or {}).get('depends_on', []) if s not in sensors]
             for sensor in sensors:
                 message += f'<li><a href="{website_url}?sensor={sensor}">{sensor}</a></li>'
             message += '</ul>'
-        silence_duration = self.db.get_experiment_config('alarm').get('silence_duration')[level]
+        silence_duration = self.directory.config.get('silence_duration')[level]
         message += f'This alarm is automatically silenced for <b>{int(silence_duration / 60)} minutes</b>.'
         if website_url:
             # add manual silence options
             message += '<br><br>To silence the pipeline for longer, click one of the following links:<ul>'
-            for silence_for, text in zip((15, 60, 360), ('15 minutes', '1 hour', '6 hours')):
-                if silence_for > int(silence_duration / 60):
-                    message += f'<li><a href="{website_url}/pipeline?pipeline={pipeline}&silence={silence_for}">' \
-                               f'{text}</a></li> '
+            for p in pipelines:
+                for silence_for, text in zip((15, 60, 360), ('15 minutes', '1 hour', '6 hours')):
+                    if silence_for > int(silence_duration / 60):
+                        if len(pipelines) > 1:
+                            text = f'{p}: {text}'
+                        message += f'<li><a href="{website_url}/pipeline?pipeline={p}&silence={silence_for}">' \
+                                   f'{text}</a></li> '
             message += '</ul>'
         message += f'<hr>Message created on {now} by Doberman slow control.'
         msg.attach(MIMEText(message, 'html'))
         # Connect and send
         self.logger.warning(f'Sending e-mail to {len(addresses)} recipient{"s" if len(addresses)>1 else ""}')
-        if server_addr == 'localhost':  # From localhost
-            smtp = smtplib.SMTP(server_addr)
-            smtp.sendmail(fromaddr, addresses, msg.as_string())
-        else:  # with e.g. gmail
-            server = smtplib.SMTP(server_addr, port)
-            server.starttls()
-            server.login(fromaddr, password)
+        if conn is None:
+            server = self.smtp_connect(timeout)
             server.sendmail(fromaddr, addresses, msg.as_string())
             server.quit()
+        else:
+            conn.sendmail(fromaddr, addresses, msg.as_string())
 
-    def send_sms(self, phone_numbers, message):
+    def send_sms(self, phone_numbers, message, conn=None, timeout=None):
         """
         Send an SMS.
         Designed for usewith smscreator.de
@@ -143,54 +198,138 @@ class AlarmMonitor(Doberman.PipelineMonitor):
             phone_numbers = [phone_numbers]
         self.logger.warning(f'Sending SMS to {len(phone_numbers)} recipient{"s" if len(phone_numbers)>1 else ""}')
         for tonumber in phone_numbers:
-            data = postparameters
+            data = dict(postparameters)
             data['Recipient'] = tonumber
             data['SMSText'] = message
             data['SendDate'] = now
-            response = requests.post(url, data=data)
+            response = (conn or requests).post(url, data=data, timeout=timeout)
             if response.status_code != 200:
                 raise RuntimeError(f"Couldn't send message, status {response.status_code}: "
                                    f"{response.content.decode('ascii')}")
 
-    def log_alarm(self, level=None, message=None, pipeline=None, _hash=None, prot_rec_dict=None):
+    def log_alarm(self, level=None, message=None, pipeline=None, _hash=None, prot_rec_dict=None, device=None,
+                  on_delivery=None):
         """
-        Sends 'message' to the contacts specified by 'level'.
+        Sends 'message' to the contacts specified by 'level'. The messages are only
+        queued here, the dispatcher delivers them in the background. The first alarm of a
+        device (or pipeline, if no device is given) goes out straight away, further alarms of
+        the same device within the aggregation window are collected and sent as a digest.
+
+        :param on_delivery: called as f(bool, exception or None) once it's known whether the
+            alarm reached anyone, see AlarmDelivery. Without it, this raises if a message
+            can't be queued. Default None
         """
-        exception = None
         if not prot_rec_dict:
-            prot_rec_dict = self.db.get_contact_addresses(level)
+            prot_rec_dict = self.directory.addresses(level)
+        alarm = (level, message, pipeline)
+        delivery = AlarmDelivery(on_delivery) if on_delivery is not None else None
+        if self.aggregator is not None:
+            batch = self.aggregator.add(device or pipeline, alarm, prot_rec_dict, delivery)
+            if len(batch) != 1:
+                # either held back, or an escalation that takes the held back alarms along
+                if batch:
+                    self.send_grouped(batch)
+                return
+        exception = None
         for protocol, recipients in prot_rec_dict.items():
             try:
-                if protocol == 'sms':
-                    message = f'{self.db.experiment_name.upper()} {message}'
-                    self.send_sms(recipients, message)
-                elif protocol == 'email':
-                    subject = f'{self.db.experiment_name.capitalize()} level {level} alarm'
-                    self.send_email(addresses=recipients, subject=subject, message=message, level=level, pipeline=pipeline)
-                elif protocol == 'phone':
-                    self.send_phonecall(recipients, message)
-                else:
-                    raise ValueError(f"Couldn't send alarm message. Protocol {protocol} unknown.")
+                self.submit_alarms(protocol, recipients, [alarm], [delivery])
             except Exception as e:
                 exception = e  # Save it for later but try other methods anyway
-        if exception is not None:
+        if delivery is not None:
+            delivery.seal(exception)
+        elif exception is not None:
             raise exception
 
-    def check_shifters(self):
+    def submit_alarms(self, protocol, recipients, alarms, deliveries=()):
         """
-        Logs a notification (alarm) when the list of shifters changes
+        Hands one alarm, or a digest of several, to the dispatcher
+
+        :param protocol: which protocol
+        :param recipients: list of addresses
+        :param alarms: list of (level, message, pipeline)
+        :param deliveries: the AlarmDelivery (or None) of each alarm, told how the message fared
         """
+        on_done = None
+        if deliveries := [d for d in deliveries if d is not None]:
+            on_done = functools.partial(self.delivered, deliveries)
+        level = max(a[0] or 0 for a in alarms)
+        if len(alarms) == 1:
+            message, pipeline = alarms[0][1], alarms[0][2]
+            subject = f'{self.db.experiment_name.capitalize()} level {level} alarm'
+            sep = ''
+        else:
+            pipeline = list(dict.fromkeys(a[2] for a in alarms))
+            subject = f'{self.db.experiment_name.capitalize()} level {level} alarm digest ({len(alarms)} alarms)'
+            sep = '<br>' if protocol == 'email' else '; '
+            message = f'{len(alarms)} alarms: ' + sep.join(a[1] for a in alarms)
+        if protocol == 'sms':
+            jobs = self.dispatcher.submit(protocol, recipients, on_done=on_done,
+                                          message=f'{self.db.experiment_name.upper()} {message}')
+        elif protocol == 'email':
+            jobs = self.dispatcher.submit(protocol, recipients, on_done=on_done, subject=subject, message=message,
+                                          level=level, pipeline=pipeline)
+        else:
+            jobs = self.dispatcher.submit(protocol, recipients, on_done=on_done, message=message)
+        for d in deliveries:
+            d.expect(jobs)
 
-        new_shifters = self.db.distinct('contacts', 'name', {'on_shift': True})
-        new_shifters.sort()
+    @staticmethod
+    def delivered(deliveries, ok, error=None):
+        """
+        Passes the outcome of one message on to the alarms it contained
+        """
+        for d in deliveries:
+            d.result(ok, error)
+
+    def send_digests(self):
+        """
+        Sends the alarms the aggregator collected
+        """
+        self.send_grouped(self.aggregator.due())
+
+    def send_grouped(self, due):
+        """
+        Sends several alarms, one message per protocol and recipient
+
+        :param due: list of (alarm, prot_rec_dict, delivery)
+        """
+        per_recipient = collections.defaultdict(list)  # (protocol, address): [indices into due]
+        for i, (alarm, prot_rec_dict, delivery) in enumerate(due):
+            for protocol, recipients in prot_rec_dict.items():
+                for address in ([recipients] if isinstance(recipients, str) else recipients):
+                    per_recipient[(protocol, address)].append(i)
+        # recipients who get the same alarms can share a message
+        shared = collections.defaultdict(list)  # (protocol, indices): [addresses]
+        for (protocol, address), indices in per_recipient.items():
+            shared[(protocol, tuple(indices))].append(address)
+        errors = {}
+        for (protocol, indices), addresses in shared.items():
+            try:
+                self.submit_alarms(protocol, addresses, [due[i][0] for i in indices], [due[i][2] for i in indices])
+            except Exception as e:
+                self.logger.error(f'Could not queue a {protocol} digest: {type(e)}: {e}')
+                errors.update({i: e for i in indices})
+        for i, (_, _, delivery) in enumerate(due):
+            if delivery is not None:
+                delivery.seal(errors.get(i))
+
+    def check_shifters(self):
+        """
+        Refreshes the contact directory and logs a notification (alarm) when the list
+        of shifters changes
+        """
+        if self.directory.refresh():
+            self.logger.info('Contacts or alarm config changed, rebuilt the contact directory')
+        new_shifters = self.directory.shifters
         if new_shifters != self.current_shifters:
             if len(new_shifters) == 0:
-                self.db.update_db('contact', {'name': {'$in': self.current_shifters}}, {'$set': {'on_shift': True}})
+                # tell the ones who just went off shift
                 self.log_alarm(level=1, message='No more allocated shifters.',
                                pipeline='AlarmMonitor',
                                _hash=Doberman.utils.make_hash(time.time(), 'AlarmMonitor'),
+                               prot_rec_dict=self.directory.addresses(1, shifters=self.current_shifters),
                                )
-                self.db.update_db('contact', {'name': {'$in': self.current_shifters}}, {'$set': {'on_shift': False}})
                 return
             msg = f'{", ".join(new_shifters)} '
             msg += ('is ' if len(new_shifters) == 1 else 'are ')
@@ -201,3 +340,458 @@ class AlarmMonitor(Doberman.PipelineMonitor):
                            pipeline='AlarmMonitor',
                            _hash=Doberman.utils.make_hash(time.time(), 'AlarmMonitor'),
                            )
+
+
+class AlarmStateTable(object):
+    """
+    Keeps track of which sensors are in an alarm state. Nodes set the state every cycle,
+    but only changes are written to the database, and they're written in batches by
+    flush(), so a steady state costs no writes at all. The first state a node sets after
+    startup is always written, and every so often flush() writes the state of every sensor
+    a node set, so a lost write or a stale document doesn't stick around.
+    """
+
+    def __init__(self, db, logger, resync=300):
+        """
+        :param resync: seconds between full writes, 0 to turn them off. Default 300
+        """
+        self.db = db
+        self.logger = logger
+        self.resync = resync
+        self.lock = threading.Lock()
+        self.state = {doc['name']: bool(doc.get('alarm_is_triggered', False))
+                      for doc in db.read_from_db('sensors', projection={'name': 1, 'alarm_is_triggered': 1})}
+        self.seen = set()
+        self.dirty = {}
+        self.last_sync = time.monotonic()
+
+    def set(self, name, triggered):
+        with self.lock:
+            if self.state.get(name) != triggered or name not in self.seen:
+                self.seen.add(name)
+                self.state[name] = triggered
+                self.dirty[name] = triggered
+
+    def get(self, name):
+        return self.state.get(name, False)
+
+    def triggered(self):
+        """
+        :returns: list of the sensors in an alarm state
+        """
+        with self.lock:
+            return [name for name, triggered in self.state.items() if triggered]
+
+    def flush(self):
+        """
+        Writes the changes since the last flush, or everything if it's time to resync,
+        one update per value
+        """
+        now = time.monotonic()
+        with self.lock:
+            if self.resync and now - self.last_sync >= self.resync:
+                self.dirty = {name: self.state[name] for name in self.seen}
+                self.last_sync = now
+            dirty, self.dirty = self.dirty, {}
+        for value in (True, False):
+            if names := [name for name, triggered in dirty.items() if triggered is value]:
+                try:
+                    self.db.update_db('sensors', {'name': {'$in': names}}, {'$set': {'alarm_is_triggered': value}})
+                except Exception as e:
+                    self.logger.error(f'Could not update alarm states: {type(e)}: {e}')
+                    with self.lock:
+                        for name in names:
+                            self.dirty.setdefault(name, value)
+
+
+class AlarmAggregator(object):
+    """
+    Groups alarms so an outage doesn't send one message per sensor. The first alarm of
+    a group opens a window and is sent right away, the alarms that arrive while the window
+    is open are held back and come out of due() when it closes, after which a new window
+    opens. A group without new alarms when its window closes is forgotten. An alarm at a
+    higher level than the group's window doesn't wait, it goes out immediately together
+    with what was held back, and opens a new window at its level.
+    """
+
+    def __init__(self, window=10):
+        """
+        :param window: seconds. Default 10
+        """
+        self.window = window
+        self.lock = threading.Lock()
+        self.groups = {}  # group: [window end, [(alarm, prot_rec_dict, delivery)], level]
+
+    def add(self, group, alarm, prot_rec_dict, delivery=None):
+        """
+        :param alarm: (level, message, pipeline)
+        :param delivery: the alarm's AlarmDelivery, or None. Kept with a held back alarm
+        :returns: list of (alarm, prot_rec_dict, delivery) to send now. Empty if the alarm
+            was held back, more than one if it escalated and flushed the held back alarms
+        """
+        now = time.monotonic()
+        level = alarm[0] or 0
+        ret = [(alarm, prot_rec_dict, delivery)]
+        with self.lock:
+            if (entry := self.groups.get(group)) is not None and (entry[0] > now or entry[1]):
+                if level <= entry[2]:
+                    entry[1].append(ret[0])
+                    return []
+                ret = entry[1] + ret
+            self.groups[group] = [now + self.window, [], level]
+            return ret
+
+    def due(self):
+        """
+        :returns: list of (alarm, prot_rec_dict, delivery) of the groups whose window closed
+        """
+        now = time.monotonic()
+        ret = []
+        with self.lock:
+            for group, entry in list(self.groups.items()):
+                if entry[0] > now:
+                    continue
+                if entry[1]:
+                    ret += entry[1]
+                    self.groups[group] = [now + self.window, [], max(a[0][0] or 0 for a in entry[1])]
+                else:
+                    del self.groups[group]
+        return ret
+
+
+class AlarmDelivery(object):
+    """
+    Tells whoever raised an alarm whether it reached anyone. One alarm can go out as
+    several messages (protocols, recipients, digests), and the callback is called exactly
+    once: with True as soon as one of them got through, or with False and the last error
+    once all of them failed. expect() counts the messages as they're queued, and seal()
+    says that there won't be any more.
+    """
+
+    def __init__(self, callback):
+        """
+        :param callback: called as f(bool, exception or None), on the dispatcher's thread
+        """
+        self.callback = callback
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.sealed = False
+        self.done = False
+        self.error = None
+
+    def expect(self, n=1):
+        with self.lock:
+            self.pending += n
+
+    def result(self, ok, error=None):
+        """
+        The outcome of one message
+        """
+        with self.lock:
+            self.pending -= 1
+            self.error = error or self.error
+            if not (fire := self.fire_now(ok)):
+                return
+        self.callback(*fire)
+
+    def seal(self, error=None):
+        """
+        No more messages will be queued for this alarm
+        :param error: why a message couldn't be queued, if one couldn't. Default None
+        """
+        with self.lock:
+            self.sealed = True
+            self.error = error or self.error
+            if not (fire := self.fire_now(False)):
+                return
+        self.callback(*fire)
+
+    def fire_now(self, ok):
+        """
+        Called with the lock held
+        :returns: the callback's arguments if it's time to call it, otherwise None
+        """
+        if self.done:
+            return None
+        if ok:
+            self.done = True
+            return True, None
+        if self.sealed and self.pending <= 0:
+            self.done = True
+            return False, self.error or RuntimeError('No messages were sent')
+        return None
+
+
+class ContactDirectory(object):
+    """
+    Resolves alarm levels to addresses without going to the database. refresh() reads
+    the contacts and the alarm config, and the level -> protocol -> addresses table is
+    only rebuilt when either of them changed.
+    """
+
+    def __init__(self, db, logger):
+        self.db = db
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.config = {}
+        self.contacts = []
+        self.shifters = []
+        self.table = {}
+
+    def refresh(self):
+        """
+        Re-reads the contacts and the alarm config
+        :returns: True if the table was rebuilt
+        """
+        config = self.db.get_experiment_config('alarm') or {}
+        config.pop('_id', None)
+        contacts = sorted(self.db.read_from_db('contacts', projection={'_id': 0}), key=lambda doc: doc['name'])
+        if config == self.config and contacts == self.contacts:
+            return False
+        with self.lock:
+            self.config = config
+            self.contacts = contacts
+            self.shifters = sorted(doc['name'] for doc in contacts if doc.get('on_shift'))
+            self.table = {level: self.resolve(level) for level in range(len(config.get('protocols', [])))}
+        return True
+
+    def resolve(self, level, shifters=None):
+        """
+        Works out who to contact how at this level. If there are no protocols for this level,
+        takes those of the highest level defined. If there are no recipients, takes everyone.
+
+        :param level: which alarm level
+        :param shifters: names to use for the shifters group. Default None (who's on shift)
+        :returns: dict, keys = message protocols, values = list of addresses
+        """
+        protocols = self.config.get('protocols') or [[]]
+        if level >= len(protocols):
+            self.logger.error(f'No message protocols for alarm level {level}! Defaulting to highest level defined')
+            protocols = protocols[-1]
+        else:
+            protocols = protocols[level]
+        groups = self.config.get('recipients', [])
+        groups = groups[level] if level < len(groups) else ['everyone']
+        names = set()
+        for group in groups:
+            if group == 'shifters':
+                names.update(self.shifters if shifters is None else shifters)
+            elif group == 'experts':
+                names.update(doc['name'] for doc in self.contacts if doc.get('expert'))
+            elif group == 'everyone':
+                names.update(doc['name'] for doc in self.contacts)
+        ret = {p: [] for p in protocols}
+        for doc in self.contacts:
+            if doc['name'] not in names:
+                continue
+            for p in protocols:
+                if p in doc:
+                    ret[p].append(doc[p])
+                else:
+                    self.logger.error(f"No {p} contact details for {doc['name']}")
+        return ret
+
+    def addresses(self, level, shifters=None):
+        """
+        Same as resolve, but from the table when possible
+        """
+        with self.lock:
+            if shifters is not None:
+                return self.resolve(level, shifters)
+            if level not in self.table:
+                self.table[level] = self.resolve(level)
+            return {p: list(a) for p, a in self.table[level].items()}
+
+
+class NotificationDispatcher(object):
+    """
+    Delivers alarm notifications in the background, so a pipeline that raises an alarm
+    only has to put it into a queue. Each protocol has its own queue and workers, and each
+    worker keeps its connection (an SMTP session, an http session) open between messages.
+    Protocols in fan_out get one job per recipient so the recipients are contacted in
+    parallel. Failed sends are retried with an exponential backoff until either the
+    retries or the deadline run out. Each job can carry an on_done callback that's told
+    whether it was eventually sent.
+    """
+
+    def __init__(self, logger, senders, connectors=None, workers=None, fan_out=('sms', 'phone'), deadline=120,
+                 retries=2, backoff=5, timeout=10, queue_size=100, idle_close=300):
+        """
+        :param logger: a logger
+        :param senders: dict, keys = protocols, values = functions called as
+            f(recipients, conn=conn, timeout=timeout, **kwargs)
+        :param connectors: dict, keys = protocols, values = functions called as f(timeout=timeout)
+            that return a connection to pass to the sender. Default None (no connections)
+        :param workers: dict, number of workers per protocol. Default None (1 each)
+        :param fan_out: protocols that get one job per recipient. Default sms and phone
+        :param deadline: seconds after submission after which a message is given up. Default 120
+        :param retries: how often a failed message is retried. Default 2
+        :param backoff: seconds before the first retry, doubling every time. Default 5
+        :param timeout: network timeout in seconds. Default 10
+        :param queue_size: the length of each queue. Default 100
+        :param idle_close: close connections that haven't been used for this many seconds. Default 300
+        """
+        self.logger = logger
+        self.senders = senders
+        self.connectors = connectors or {}
+        self.fan_out = set(fan_out)
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.idle_close = idle_close
+        self.event = threading.Event()
+        self.queues = {protocol: queue.Queue(maxsize=queue_size) for protocol in senders}
+        self.threads = []
+        workers = workers or {}
+        for protocol in senders:
+            for i in range(max(1, workers.get(protocol, 1))):
+                t = threading.Thread(target=self.work, args=(protocol,), name=f'{protocol}_{i}', daemon=True)
+                t.start()
+                self.threads.append(t)
+
+    def submit(self, protocol, recipients, on_done=None, **kwargs):
+        """
+        Queues a message. Raises ValueError for an unknown protocol and queue.Full if
+        the protocol is backed up. If some jobs of a fanned out message were queued before
+        the queue filled up, the rest are reported to on_done as failed instead.
+
+        :param protocol: which protocol to use
+        :param recipients: a list of recipients
+        :param on_done: called once per job as f(True) when it was sent or f(False, exception)
+            when it was given up, from a worker thread. Default None
+        :key **kwargs: passed to the sender
+        :returns: how many jobs were queued, i.e. how often on_done will be called
+        """
+        if protocol not in self.queues:
+            raise ValueError(f"Couldn't send alarm message. Protocol {protocol} unknown.")
+        if not recipients:
+            raise ValueError(f'No recipients given for {protocol}')
+        deadline = time.monotonic() + self.deadline
+        if protocol in self.fan_out:
+            if isinstance(recipients, str):
+                recipients = [recipients]
+            batches = [[r] for r in recipients]
+        else:
+            batches = [recipients]
+        for i, r in enumerate(batches):
+            try:
+                self.queues[protocol].put_nowait((deadline, 0, r, kwargs, on_done))
+            except queue.Full as e:
+                if i == 0 or on_done is None:
+                    raise
+                for _ in batches[i:]:
+                    on_done(False, e)
+                break
+        return len(batches)
+
+    def connect(self, protocol, remaining):
+        if (connector := self.connectors.get(protocol)) is None:
+            return None
+        return connector(timeout=min(self.timeout, remaining))
+
+    def disconnect(self, conn):
+        if conn is not None:
+            try:
+                (getattr(conn, 'quit', None) or conn.close)()
+            except Exception:
+                pass
+        return None
+
+    def work(self, protocol):
+        """
+        The worker loop
+        """
+        q = self.queues[protocol]
+        send = self.senders[protocol]
+        conn, last_used = None, 0
+        while True:
+            try:
+                job = q.get(timeout=1)
+            except queue.Empty:
+                if conn is not None and time.monotonic() - last_used > self.idle_close:
+                    conn = self.disconnect(conn)
+                if self.event.is_set():
+                    break
+                continue
+            if job is None:
+                break
+            deadline, attempt, recipients, kwargs, on_done = job
+            if (remaining := deadline - time.monotonic()) <= 0:
+                self.logger.critical(f'Gave up on a {protocol} message to {len(recipients)} recipient(s), '
+                                     f'the deadline passed')
+                self.report(on_done, False, TimeoutError(f'{protocol} message deadline passed'))
+                continue
+            try:
+                if fresh := conn is None:
+                    conn = self.connect(protocol, remaining)
+                try:
+                    send(recipients, conn=conn, timeout=min(self.timeout, remaining), **kwargs)
+                except Exception:
+                    if fresh:
+                        raise
+                    # the connection we kept may have gone stale, try once more with a new one
+                    self.disconnect(conn)
+                    conn = self.connect(protocol, remaining)
+                    send(recipients, conn=conn, timeout=min(self.timeout, remaining), **kwargs)
+                last_used = time.monotonic()
+            except Exception as e:
+                conn = self.disconnect(conn)
+                self.retry(protocol, job, e)
+            else:
+                self.report(on_done, True)
+        self.disconnect(conn)
+
+    def report(self, on_done, ok, error=None):
+        """
+        Tells the submitter how a job went. A broken callback mustn't take the worker down.
+        """
+        if on_done is None:
+            return
+        try:
+            on_done(ok, error)
+        except Exception as e:
+            self.logger.error(f'Delivery callback failed: {type(e)}: {e}')
+
+    def retry(self, protocol, job, e):
+        """
+        Schedules another attempt, if there's time for one
+        """
+        deadline, attempt, recipients, kwargs, on_done = job
+        delay = self.backoff * 2 ** attempt
+        if attempt >= self.retries or time.monotonic() + delay >= deadline or self.event.is_set():
+            self.logger.critical(f'Could not send {protocol} message after {attempt + 1} attempt(s). '
+                                 f'{type(e)}: {e}')
+            self.report(on_done, False, e)
+            return
+        self.logger.error(f'Sending {protocol} message failed ({type(e)}: {e}), retrying in {delay} s')
+        t = threading.Timer(delay, self.requeue,
+                            args=(protocol, (deadline, attempt + 1, recipients, kwargs, on_done)))
+        t.daemon = True
+        t.start()
+
+    def requeue(self, protocol, job):
+        if self.event.is_set():
+            self.report(job[-1], False, RuntimeError('Dispatcher closed'))
+            return
+        try:
+            self.queues[protocol].put_nowait(job)
+        except queue.Full as e:
+            self.logger.critical(f'Could not retry {protocol} message, the queue is full')
+            self.report(job[-1], False, e)
+
+    def close(self, timeout=10):
+        """
+        Stops the workers once they've sent what's already queued, waiting at most timeout seconds
+        """
+        self.event.set()
+        for protocol, q in self.queues.items():
+            for t in self.threads:
+                if t.name.startswith(f'{protocol}_'):
+                    try:
+                        q.put(None, timeout=timeout)
+                    except queue.Full:
+                        pass
+        end = time.monotonic() + timeout
+        for t in self.threads:
+            t.join(max(0, end - time.monotonic()))
@@ -1,4 +1,5 @@
 import Doberman
+import functools
 import time
 
 
@@ -13,6 +14,8 @@ class AlarmNode(Doberman.Node):
         self.description = kwargs['description']
         self.device = kwargs['device']
         self._log_alarm = kwargs['log_alarm']
+        self.alarm_state = kwargs.get('alarm_state')
+        self.alarm_is_triggered = None
         self.max_reading_delay = kwargs['max_reading_delay']
         self.escalation_config = kwargs['escalation_config']
         self.escalation_level = 0
@@ -40,11 +43,22 @@ class AlarmNode(Doberman.Node):
             self.logger.warning((f'{self.name} at level {self.config["alarm_level"]}/{self.escalation_level} '
                                  f'for {self.messages_this_level} messages, need {self.escalation_config[total_level]} '
                                  f'to escalate'))
+    def set_alarm_state(self, triggered):
+        """
+        Records whether the input sensor is in an alarm state. With the monitor's state table
+        this doesn't touch the database, otherwise we write only if the state changed
+        """
+        if self.alarm_state is not None:
+            self.alarm_state.set(self.input_var, triggered)
+        elif self.alarm_is_triggered != triggered:
+            self.set_sensor_setting(self.input_var, 'alarm_is_triggered', triggered)
+        self.alarm_is_triggered = triggered
+
     def reset_alarm(self):
         """
         Resets the cached alarm state
         """
-        self.set_sensor_setting(self.input_var, 'alarm_is_triggered', False)
+        self.set_alarm_state(False)
         if self.hash is not None:
             self.logger.info(f'{self.name} resetting alarm {self.hash}')
             self.hash = None
@@ -55,7 +69,7 @@ class AlarmNode(Doberman.Node):
         """
         Let the outside world know that something is going on
         """
-        self.set_sensor_setting(self.input_var, 'alarm_is_triggered', True)
+        self.set_alarm_state(True)
         # Only send message if pipeline is silenced at base_level or above, 
         # or if it is silenced at level -1 (universal)
         if not self.is_silent or -1 < self.pipeline.silenced_at_level < self.config['alarm_level']:
@@ -67,21 +81,42 @@ class AlarmNode(Doberman.Node):
             self.escalate()
             level = self.config['alarm_level'] + self.escalation_level
             try:
+                # the message is only queued here, so until we hear back how it went we hold off
+                # as if it couldn't be sent. delivered() sets the real silence
+                self.pipeline.silence_for(self.silence_duration_cant_send, self.config['alarm_level'])
                 self._log_alarm(level=level,
                                 message=msg,
                                 pipeline=self.pipeline.name,
-                                _hash=self.hash)
-                # self-silence if the message was successfully sent
-                self.pipeline.silence_for(self.auto_silence_duration[level], self.config['alarm_level'])
-                self.messages_this_level += 1
+                                _hash=self.hash,
+                                device=self.device,
+                                on_delivery=functools.partial(self.delivered, self.hash, level))
             except Exception as e:
                 self.logger.error(f"Exception sending alarm: {type(e)}, {e}.")
                 self.pipeline.silence_for(self.silence_duration_cant_send, self.config['alarm_level'])
         else:
             self.logger.debug(msg)
+
+    def delivered(self, _hash, level, ok, error=None):
+        """
+        Called by the alarm monitor once it knows whether an alarm message reached anyone
+
+        :param _hash: the hash of the alarm the message was for
+        :param level: the level it was sent at
+        :param ok: whether it was sent
+        :param error: why not, if it wasn't. Default None
+        """
+        if not ok:
+            self.logger.error(f'Alarm message could not be delivered: {type(error)}, {error}.')
+            self.pipeline.silence_for(self.silence_duration_cant_send, self.config['alarm_level'])
+            return
+        # self-silence since the message was successfully sent
+        self.pipeline.silence_for(self.auto_silence_duration[level], self.config['alarm_level'])
+        if _hash is not None and _hash == self.hash:
+            # only count messages toward escalating the alarm they were about
+            self.messages_this_level += 1
            
     def shutdown(self):
-        self.set_sensor_setting(self.input_var, 'alarm_is_triggered', False)
+        self.set_alarm_state(False)
 
         
 class CheckRemoteHeartbeatNode(Doberman.Node):
@@ -129,27 +164,38 @@ class CheckRemoteHeartbeatNode(Doberman.Node):
 
 
 class TriggeredAlarmsNode(Doberman.Node):
+    """
+    Checks whether any sensors are in an alarm state. The output_var is 1 if any of them
+    are and 0 otherwise, and the package also gets the list of them as 'triggered_sensors'.
+
+    Runtime params:
+    :param sensors_to_check: "any" or a list of sensor names. Default "any"
+    """
 
     def setup(self, **kwargs):
         super().setup(**kwargs)
-        self.get_sensor_setting = kwargs['get_sensor_setting']
-        self.distinct = kwargs['distinct']
+        self.get_triggered_sensors = kwargs['get_triggered_sensors']
+        self.alarm_state = kwargs.get('alarm_state')
 
     def process(self, package):
         sensors_to_check = self.config.get('sensors_to_check', 'any')
-        if sensors_to_check == 'any':
-            sensor_list = self.distinct('sensors', 'name')
-        elif isinstance(sensors_to_check, list):
-            sensor_list = sensors_to_check
-        else:
+        if sensors_to_check != 'any' and not isinstance(sensors_to_check, list):
             self.logger.error('invalid option sensors_to_check: must be "any" or a list of sensor names.')
             return 0
-        for sensor in sensor_list:
-            if status := self.get_sensor_setting(sensor, 'alarm_is_triggered'):
-                if not isinstance(status, dict):  # get_sensor_setting returns whole doc if field doesn't exist
-                    self.logger.debug(f'{sensor} in alarm state')
-                    return 1
-        return 0
+        names = None if sensors_to_check == 'any' else sensors_to_check
+        if self.alarm_state is not None:
+            # same process as the alarm pipelines, no need to ask the database
+            triggered = self.alarm_state.triggered()
+            if names is not None:
+                triggered = [sensor for sensor in names if sensor in triggered]
+        else:
+            triggered = self.get_triggered_sensors(names)
+        if triggered:
+            self.logger.debug(f'{", ".join(triggered)} in alarm state')
+        package = dict(package)
+        package[self.output_var] = int(len(triggered) > 0)
+        package['triggered_sensors'] = triggered
+        return package
 
 
 class DeviceRespondingBase(AlarmNode):
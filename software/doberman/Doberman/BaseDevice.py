@@ -6,17 +6,27 @@ except ImportError:
 import socket
 import time
 import threading
+import os
+import stat
+import struct
+import fcntl
 from subprocess import PIPE, Popen, TimeoutExpired
 
-__all__ = 'Device SoftwareDevice SerialDevice LANDevice CheapSocketDevice'.split()
+__all__ = 'Device SoftwareDevice SerialDevice LANDevice CheapSocketDevice RevPiDevice'.split()
 
 
 class Device(object):
     """
-    Generic device class. Defines the interface with Doberman
+    Generic device class. Defines the interface with Doberman.
+    Readouts are coalesced: identical readout commands waiting in the queue are executed
+    once and all get the reply. If params['coalesce_window'] is set (seconds, default 0 =
+    off), a readout repeated within that time of the last successful identical one gets that
+    reply (with its timestamp) without asking the device. Other commands aren't coalesced
+    and clear the stored replies.
     """
     _msg_start = ''
     _msg_end = ''
+    coalesce_window = 0
 
     def __init__(self, opts, logger, event):
         """
@@ -32,6 +42,8 @@ class Device(object):
         self.event = event
         self.cv = threading.Condition()
         self.cmd_queue = []
+        self.coalesce_window = self.params.get('coalesce_window', self.coalesce_window)
+        self.last_replies = {}  # command: (time.monotonic() of the reply, reply)
         self.set_parameters()
         self.base_setup()
 
@@ -80,19 +92,37 @@ class Device(object):
                     if len(self.cmd_queue) > 0:
                         command, ret = self.cmd_queue.pop(0)
                         print(f'command, ret = {command}, {ret}')
+                        rets = [ret]
+                        if ret is not None:
+                            # identical readouts waiting behind this one get the same reply
+                            rets += [r for c, r in self.cmd_queue if c == command and r is not None]
+                            self.cmd_queue = [(c, r) for c, r in self.cmd_queue if c != command or r is None]
                 if command is not None:
-                    self.logger.debug(f'Executing {command}')
-                    t_start = time.time()  # we don't want perf_counter because we care about
-                    pkg = self.send_recv(command)
-                    print(f'pkg = {pkg}')
-                    print(pkg)
-                    t_stop = time.time()  # the clock time when the data came out not cpu time
-                    pkg['time'] = 0.5 * (t_start + t_stop)
-                    if ret is not None:
-                        d, cv = ret
-                        with cv:
-                            d.update(pkg)
-                            cv.notify()
+                    last = self.last_replies.get(command) if ret is not None else None
+                    if last is not None and time.monotonic() - last[0] < self.coalesce_window:
+                        self.logger.debug(f'Reusing the reply to {command}')
+                        pkg = last[1]
+                    else:
+                        self.logger.debug(f'Executing {command}')
+                        t_start = time.time()  # we don't want perf_counter because we care about
+                        pkg = self.send_recv(command)
+                        print(f'pkg = {pkg}')
+                        print(pkg)
+                        t_stop = time.time()  # the clock time when the data came out not cpu time
+                        pkg['time'] = 0.5 * (t_start + t_stop)
+                        if ret is not None:
+                            if self.coalesce_window > 0 and pkg.get('retcode', 0) == 0 \
+                                    and pkg.get('data') is not None:
+                                self.last_replies[command] = (time.monotonic(), pkg)
+                        else:
+                            # this might have changed what the device would reply
+                            self.last_replies.clear()
+                    for r in rets:
+                        if r is not None:
+                            d, cv = r
+                            with cv:
+                                d.update(pkg)
+                                cv.notify()
             except Exception as e:
                 self.logger.error(f'Scheduler caught a {type(e)} while processing {command}: {e}')
         self.logger.info('Readout scheduler returning')
@@ -312,6 +342,133 @@ class LANDevice(Device):
         return ret
 
 
+class RevPiDevice(Device):
+    """
+    Class for devices using the process image of a RevolutionPi (/dev/piControl0). The image
+    is opened once and read with pread, and variable positions are only looked up once.
+    The inputs listed in params['inputs'] are read together with read_inputs, which copies
+    the block of the image they span into a buffer in one call.
+    A regular file can stand in for the process image (for testing) if the positions are
+    given in params['positions'] = {name: [address, bit, length in bits]}.
+    16 and 32 bit values are signed unless listed in params['unsigned'].
+    With params['snapshot'] the DeviceMonitor reads all sensors with 'r <variable>' readout
+    commands through one SnapshotSensor, which sends the 'snapshot' command.
+    """
+    path = '/dev/piControl0'
+    fd = None  # so shutdown works if setup didn't get as far as opening the image
+    _find_variable = (ord('K') << 8) + 17
+    _set_value = (ord('K') << 8) + 16
+    _formats = {8: 'B', 16: '<h', 32: '<i'}
+
+    def setup(self):
+        self.fd = os.open(self.path, os.O_RDWR)
+        self.is_device = stat.S_ISCHR(os.fstat(self.fd).st_mode)
+        self.positions = {name: tuple(pos) for name, pos in self.params.get('positions', {}).items()}
+        self.unsigned = set(self.params.get('unsigned', []))
+        self.snapshot = self.params.get('snapshot', False)
+        self.layouts = {}
+        self.set_inputs(self.params.get('inputs', []))
+
+    def shutdown(self):
+        # close() also runs from __del__
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def get_position(self, name):
+        """
+        Finds a variable in the process image
+        :param name: name of the variable as defined in the Pictory
+        :returns: (address, bit, length in bits)
+        """
+        if name not in self.positions:
+            if not self.is_device:
+                raise ValueError(f'No position given for {name}')
+            # name (32 bytes), address (2 bytes), bit (1 byte), padding, length (2 bytes)
+            buf = bytearray(struct.pack('38s', name.encode()))
+            fcntl.ioctl(self.fd, self._find_variable, buf)
+            address, bit = struct.unpack_from('<HB', buf, 32)
+            self.positions[name] = (address, bit, struct.unpack_from('<H', buf, 36)[0])
+        return self.positions[name]
+
+    def layout(self, name):
+        """
+        :returns: (struct.Struct or None for a single bit, address, bit)
+        """
+        if name not in self.layouts:
+            address, bit, length = self.get_position(name)
+            if length == 1:
+                self.layouts[name] = (None, address, bit)
+            else:
+                fmt = self._formats[length]
+                self.layouts[name] = (struct.Struct(fmt.upper() if name in self.unsigned else fmt), address, bit)
+        return self.layouts[name]
+
+    def set_inputs(self, names):
+        """
+        Sets which variables read_inputs returns. Variables that can't be found are left
+        out, so one bad readout command doesn't take down the other inputs
+        """
+        layouts = []
+        for name in names:
+            try:
+                layouts.append((name, *self.layout(name)))
+            except (ValueError, OSError) as e:
+                self.logger.error(f'Can\'t read {name} from the process image: {type(e)}: {e}')
+        start, size = 0, 0
+        if layouts:
+            start = min(address for _, _, address, _ in layouts)
+            size = max(address + (s.size if s else 1) for _, s, address, _ in layouts) - start
+        image = bytearray(size)
+        # one assignment, so a concurrent read_inputs sees either the old or the new block
+        self.block = (start, image, memoryview(image),
+                      [(name, s, address - start, bit) for name, s, address, bit in layouts])
+
+    @staticmethod
+    def unpack(buf, s, offset, bit):
+        if s is None:
+            return (buf[offset] >> bit) & 1
+        return s.unpack_from(buf, offset)[0]
+
+    def read_inputs(self):
+        """
+        Reads all the inputs with one copy of the process image
+        :returns: dict {name: value}
+        """
+        start, image, view, inputs = self.block
+        if (n := os.preadv(self.fd, [image], start)) != len(image):
+            raise OSError(f'Read {n} bytes of the process image instead of {len(image)}')
+        return {name: self.unpack(view, s, offset, bit) for name, s, offset, bit in inputs}
+
+    def read(self, name):
+        """
+        Read value of a variable
+        :param name: name of the variable as defined in the Pictory
+        """
+        s, address, bit = self.layout(name)
+        ret = self.unpack(os.pread(self.fd, s.size if s else 1, address), s, 0, bit)
+        self.logger.debug(f'{name}: {ret}')
+        return ret
+
+    def write(self, name, value):
+        """
+        Set the value of a variable (most likely an output)
+        :param name: name of the variable as defined in the Pictory
+        :param value: value to be set
+        """
+        s, address, bit = self.layout(name)
+        value = int(value)
+        if s is not None:
+            os.pwrite(self.fd, value.to_bytes(s.size, 'little', signed=value < 0), address)
+        elif self.is_device:
+            # the driver sets single bits for us
+            fcntl.ioctl(self.fd, self._set_value, struct.pack('<HBB', address, bit, value))
+        else:
+            byte = os.pread(self.fd, 1, address)[0]
+            byte = byte | (1 << bit) if value else byte & ~(1 << bit)
+            os.pwrite(self.fd, bytes([byte]), address)
+
+
 class CheapSocketDevice(LANDevice):
     """
     Some hardware treats sockets as disposable and expects a new one for each connection, so we do that here
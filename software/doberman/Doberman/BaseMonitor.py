@@ -2,9 +2,14 @@ import Doberman
 import threading
 from functools import partial
 import time
+import heapq
+import itertools
+import math
+import zlib
+import queue
 import zmq
 
-__all__ = 'Monitor'.split()
+__all__ = 'Monitor Scheduler ScheduledTask'.split()
 
 
 class Monitor(object):
@@ -30,6 +35,10 @@ class Monitor(object):
         self.threads = {}
         self.restart_info = {}
         self.no_stop_threads = set()
+        cfg = (self.db.get_experiment_config('hypervisor') or {}).get('scheduler', {})
+        self.scheduler = Scheduler(self.logger, workers=cfg.get('workers', 2),
+                                   readout_workers=cfg.get('readout_workers', 4), stagger=cfg.get('stagger', 10))
+        self.scheduler.start()
         self.sh = Doberman.utils.SignalHandler(self.logger, self.event)
         self.db.notify_hypervisor(active=self.name)
         self.logger.info('Child setup starting')
@@ -38,6 +47,14 @@ class Monitor(object):
         time.sleep(1)
         self.register(obj=self.check_threads, period=30, name='check_threads', _no_stop=True)
         self.register(obj=self.listen, name='listen', _no_stop=True)
+        if self.db.influx_gzip is not None:
+            self.register(obj=self.db.report_influx_compression, name='influx_compression', _no_stop=True,
+                          period=self.db.influx_gzip.get('report_period', 3600))
+        if self.db.historian_writes:
+            self.register(obj=self.db.historian.enforce_retention, period=3600, name='historian_retention',
+                          _no_stop=True)
+            self.register(obj=self.db.historian.roll_up_pending, period=60, name='historian_rollups',
+                          _no_stop=True)
 
 
     def __del__(self):
@@ -63,16 +80,20 @@ class Monitor(object):
                 else:
                     pop.append(n)
         map(self.threads.pop, pop)
+        self.scheduler.close()
         self.db.notify_hypervisor(inactive=self.name)
 
     def register(self, name, obj, period=None, _no_stop=False, **kwargs):
         """
-        Register a new function/thing to be called regularly.
+        Register a new function/thing to be called regularly. Functions with a period, and
+        threads with a tick() method (like Sensors), are run by the scheduler rather than
+        getting a thread of their own. Threads with a tick() are run in the readout pool.
 
         :param name: the name of the thing
         :param obj: either a function or a threading.Thread
         :param period: how often (in seconds) you want this thing done. If obj is a
-            function and returns a number, this will be used as the period. Default None
+            function and returns a number, this will be used as the period. A function
+            without a period (ie, one that loops by itself) gets its own thread. Default None
         :param _no_stop: bool, should this thread be allowed to stop? Default false
         :key **kwargs: any kwargs that obj needs to be called
         :returns: None
@@ -83,6 +104,9 @@ class Monitor(object):
             t = obj
             if not hasattr(t, 'event'):
                 raise ValueError('Register received malformed object')
+            if callable(getattr(t, 'tick', None)):
+                t = ScheduledTask(self.scheduler, name, t.tick, period or getattr(t, 'readout_interval', None),
+                                  self.logger, event=t.event, lane='readout', key=getattr(t, 'phase_key', None))
         else:
             # obj is a function, must wrap with FunctionHandler
             if kwargs:
@@ -90,7 +114,10 @@ class Monitor(object):
             else:
                 func = obj
             self.restart_info[name] = (func, period)  # store for restarting later if necessary
-            t = FunctionHandler(func=func, logger=self.logger, period=period, name=name)
+            if period is None:
+                t = FunctionHandler(func=func, logger=self.logger, period=period, name=name)
+            else:
+                t = ScheduledTask(self.scheduler, name, func, period, self.logger)
         if _no_stop:
             self.no_stop_threads.add(name)
         t.start()
@@ -131,11 +158,13 @@ class Monitor(object):
         that aren't
         """
         with self.lock:
-            for n, t in self.threads.items():
+            for n, t in list(self.threads.items()):
                 if not t.is_alive():
                     self.logger.critical(f'{n}-thread died')
                     if n in self.restart_info:
                         try:
+                            # a hung task might still come back, it mustn't run next to its replacement
+                            t.event.set()
                             func, period = self.restart_info[n]
                             self.register(name=n, obj=func, period=period)
                         except Exception as e:
@@ -191,6 +220,204 @@ class Monitor(object):
         pass
 
 
+class WorkerLane(object):
+    """
+    A pool of worker threads that grows with the tasks using it. There can be as many
+    threads as there are tasks (or `workers`, if that's more), so a task that blocks never
+    keeps another from running on time. Threads are only started when all the existing ones
+    are busy, so tasks that finish quickly still share a few.
+    """
+
+    def __init__(self, name, workers=2):
+        self.name = name
+        self.workers = workers
+        self.tasks = 0
+        self.threads = []
+        self.queue = queue.SimpleQueue()
+        self.idle = threading.Semaphore(0)
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def submit(self, func):
+        """
+        Runs func on a worker
+        """
+        with self.lock:
+            if self.closed:
+                raise RuntimeError(f'{self.name} lane is shut down')
+            self.queue.put(func)
+            if self.idle.acquire(blocking=False):
+                return
+            if len(self.threads) < max(self.workers, self.tasks):
+                t = threading.Thread(target=self.work, name=f'{self.name}-{len(self.threads)}', daemon=True)
+                t.start()
+                self.threads.append(t)
+
+    def work(self):
+        while (func := self.queue.get()) is not None:
+            func()
+            self.idle.release()
+
+    def shutdown(self):
+        with self.lock:
+            self.closed = True
+            for _ in self.threads:
+                self.queue.put(None)
+
+
+class Scheduler(threading.Thread):
+    """
+    Runs a Monitor's periodic work from one timer thread and two worker lanes ('default'
+    and 'readout', so slow readouts can't hold up heartbeats) instead of one sleeping
+    thread per task. Tasks sit in a heap ordered by when they're due on the monotonic
+    clock, and a task is only queued again once its current run finished, so it never runs
+    twice at once. Each lane can grow to one thread per task, see WorkerLane. Each task gets
+    a phase offset derived from its name (up to `stagger` seconds) so things registered
+    together don't all fire at once. Tasks that should fire together (like sensors the
+    device can serve with one readout) can share a key to get the same offset.
+    """
+
+    def __init__(self, logger, workers=2, readout_workers=4, stagger=10):
+        """
+        :param logger: the logger
+        :param workers: threads the default lane keeps at least. Default 2
+        :param readout_workers: threads the readout lane keeps at least. Default 4
+        :param stagger: the most a task's phase offset can be, in seconds. Default 10
+        """
+        threading.Thread.__init__(self, name='scheduler', daemon=True)
+        self.logger = logger
+        self.stagger = stagger
+        self.event = threading.Event()
+        self.cv = threading.Condition()
+        self.heap = []
+        self.counter = itertools.count()
+        self.pools = {'default': WorkerLane('worker', workers), 'readout': WorkerLane('readout', readout_workers)}
+
+    def add_task(self, task):
+        """
+        A task starts using its lane, see drop_task
+        """
+        with self.pools[task.lane].lock:
+            self.pools[task.lane].tasks += 1
+
+    def drop_task(self, task):
+        """
+        A stopped task stops using its lane
+        """
+        with self.pools[task.lane].lock:
+            self.pools[task.lane].tasks -= 1
+
+    def add(self, task, when):
+        """
+        Queues a task
+        :param task: a ScheduledTask
+        :param when: time.monotonic() at which it should run
+        """
+        with self.cv:
+            heapq.heappush(self.heap, (when, next(self.counter), task))
+            self.cv.notify()
+
+    def phase(self, name, period):
+        return zlib.crc32(name.encode()) / 2 ** 32 * min(period, self.stagger)
+
+    def run(self):
+        while not self.event.is_set():
+            due = []
+            with self.cv:
+                now = time.monotonic()
+                while self.heap and self.heap[0][0] <= now:
+                    due.append(heapq.heappop(self.heap)[2])
+                if not due:
+                    self.cv.wait(self.heap[0][0] - now if self.heap else None)
+                    continue
+            for task in due:
+                if task.event.is_set():
+                    self.drop_task(task)
+                    continue
+                try:
+                    self.pools[task.lane].submit(task.run_once)
+                except RuntimeError:  # the pools are shut down
+                    return
+
+    def close(self):
+        self.event.set()
+        with self.cv:
+            self.cv.notify()
+        for pool in self.pools.values():
+            pool.shutdown()
+
+
+class ScheduledTask(object):
+    """
+    A function the Scheduler calls every `period` seconds. The ticks are phase-locked to
+    when it started, ticks that were missed are skipped. If the function returns a
+    positive number it becomes the new period. This looks enough like a thread (event,
+    is_alive, join) that the Monitor treats both the same. A run that takes longer than
+    `hang_timeout` counts as the task having died, so check_threads notices.
+    """
+
+    def __init__(self, scheduler, name, func, period, logger, event=None, lane='default', key=None,
+                 hang_timeout=None):
+        """
+        :param hang_timeout: seconds after which a run is considered hung. Default None,
+            3 periods but at least a minute
+        """
+        self.scheduler = scheduler
+        self.name = name
+        self.key = key or name
+        self.func = func
+        self.period = period or 10
+        self.logger = logger
+        self.event = event or threading.Event()
+        self.lane = lane
+        self.hang_timeout = hang_timeout
+        self.idle = threading.Event()
+        self.idle.set()
+        self.busy_since = None
+        self.due = None
+
+    def start(self):
+        self.logger.info(f'Starting {self.name}')
+        self.due = time.monotonic() + self.scheduler.phase(self.key, self.period)
+        self.scheduler.add_task(self)
+        self.scheduler.add(self, self.due)
+
+    def run_once(self):
+        self.idle.clear()
+        self.busy_since = time.monotonic()
+        try:
+            self.logger.debug(f'Running {self.name}')
+            ret = self.func()
+            if isinstance(ret, (int, float)) and 0. < ret:
+                self.period = ret
+        except Exception as e:
+            self.logger.error(f'{self.name} caught a {type(e)}: {e}')
+        finally:
+            self.busy_since = None
+            self.idle.set()
+        if self.event.is_set():
+            self.logger.info(f'Returning {self.name}')
+            self.scheduler.drop_task(self)
+            return
+        self.due += self.period
+        if (now := time.monotonic()) > self.due:
+            self.due += math.ceil((now - self.due) / self.period) * self.period
+        self.scheduler.add(self, self.due)
+
+    def hung(self):
+        """
+        :returns: bool, has the current run been going for too long
+        """
+        timeout = self.hang_timeout or max(3 * self.period, 60)
+        return (since := self.busy_since) is not None and time.monotonic() - since > timeout
+
+    def is_alive(self):
+        return not self.event.is_set() and self.scheduler.is_alive() and not self.hung()
+
+    def join(self, timeout=None):
+        self.idle.wait(timeout)
+
+
 class FunctionHandler(threading.Thread):
     def __init__(self, func=None, logger=None, period=None, event=None, name=None):
         threading.Thread.__init__(self)
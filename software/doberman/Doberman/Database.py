@@ -1,5 +1,8 @@
 import Doberman
 from socket import getfqdn
+import gzip
+import itertools
+import threading
 import time
 import requests
 from datetime import timezone
@@ -18,6 +21,8 @@ class Database(object):
         self.hostname = getfqdn()
         self.experiment_name = experiment_name
         self._db = mongo_client[self.experiment_name]
+        # for get_triggered_sensors. Does nothing if the index already exists
+        self._db['sensors'].create_index('alarm_is_triggered')
         influx_cfg = self.read_from_db('experiment_config', {'name': 'influx'}, only_one=True)
         url = influx_cfg['url']
         query_params = [('precision', influx_cfg.get('precision', 'ms'))]
@@ -37,11 +42,37 @@ class Database(object):
         url += '&'.join([f'{k}={v}' for k, v in query_params])
         precision = {'s': 1, 'ms': 1000, 'us': 1_000_000, 'ns': 1_000_000_000}
         self.influx_cfg = (url, headers, precision[influx_cfg.get('precision', 'ms')])
+        self.encoder = Doberman.LineEncoder(self.influx_cfg[2],
+                                            'testing' if self.experiment_name == 'testing' else None)
+        # gzip: {level, min_size, report_period}, bodies of at least min_size bytes get compressed
+        self.influx_gzip = influx_cfg.get('gzip')
+        self.influx_stats = dict.fromkeys(['requests', 'compressed', 'raw_bytes', 'sent_bytes', 'compress_time'], 0)
+        self.stats_lock = threading.Lock()
+        self.influx_down_since = None
+        self.historian = None
+        self.historian_writes = False
         self.address_cache = {}
 
+    def open_historian(self, write=False):
+        """
+        Opens the local historian, if it's enabled in the experiment config. Only the
+        processes that read out sensors write to it (and replay it after Influx outages),
+        the others only read
+        :param write: bool, does this process store its sensor data. Default False
+        :returns: the Historian, or None
+        """
+        if (hist_cfg := self.get_experiment_config('historian') or {}).get('enabled', False):
+            kwargs = {k: v for k, v in hist_cfg.items()
+                      if k in ['segment_points', 'retention', 'rollups', 'rollup_retention']}
+            self.historian = Doberman.Historian(hist_cfg.get('path', f'/global/historian/{self.experiment_name}'),
+                                                **kwargs)
+            self.historian_writes = write
+        return self.historian
+
     def close(self):
         print('DB shutting down')
-        pass
+        if self.historian is not None:
+            self.historian.close()
 
     def __del__(self):
         self.close()
@@ -286,6 +317,23 @@ class Database(object):
         doc = self.read_from_db('devices', cuts={'name': device}, only_one=True)
         return doc['heartbeat'].replace(tzinfo=timezone.utc)
 
+    def get_heartbeats(self, devices):
+        """
+        Gets the heartbeats and hosts of many devices in one query
+
+        :param devices: list of device names
+        :returns: dict, keys = device names, values = (heartbeat, host). Devices without
+            a document are absent, devices without a heartbeat have None
+        """
+        ret = {}
+        for doc in self.read_from_db('devices', cuts={'name': {'$in': list(devices)}},
+                                     projection={'name': 1, 'heartbeat': 1, 'host': 1, '_id': 0}):
+            hb = doc.get('heartbeat')
+            if hb is not None:
+                hb = hb.replace(tzinfo=timezone.utc)
+            ret[doc['name']] = (hb, doc.get('host'))
+        return ret
+
     def update_heartbeat(self, device=None):
         """
         Heartbeats the specified device or host
@@ -332,6 +380,18 @@ class Database(object):
         self.update_db('sensors', cuts={'name': name},
                        updates={'$set': {field: value}})
 
+    def get_triggered_sensors(self, names=None):
+        """
+        Finds the sensors in an alarm state with a single query
+
+        :param names: only consider these sensors. Default None (all of them)
+        :returns: list of sensor names
+        """
+        cuts = {'alarm_is_triggered': True}
+        if names is not None:
+            cuts['name'] = {'$in': list(names)}
+        return [doc['name'] for doc in self.read_from_db('sensors', cuts, projection={'name': 1, '_id': 0})]
+
     def get_sensor_setting(self, name, field=None):
         """
         Gets a value for one sensor
@@ -389,19 +449,80 @@ class Database(object):
         :param timestamp: a unix timestamp, otherwise uses whatever "now" is if unspecified.
         :returns: None
         """
-        url, headers, precision = self.influx_cfg
         if topic is None or fields is None:
             raise ValueError('Missing required fields for influx insertion')
-        data = f'{topic}' if self.experiment_name != 'testing' else 'testing'
-        if tags is not None:
-            data += ',' + ','.join([f'{k}={v}' for k, v in tags.items()])
-        data += ' '
-        data += ','.join([
-            f'{k}={v}i' if isinstance(v, int) else f'{k}={v}' for k, v in fields.items()
-        ])
         timestamp = timestamp or time.time()
-        data += f' {int(timestamp * precision)}'
-        r = requests.post(url, headers=headers, data=data)
+        stored = self.write_to_historian(topic, tags, fields, timestamp)
+        self.post_to_influx(self.encoder.encode(topic, tags, fields, timestamp), buffered=stored)
+
+    def write_points_to_influx(self, points):
+        """
+        Writes many points to Influx in one request
+        :param points: list of (topic, tags, fields, timestamp), as for write_to_influx
+        :returns: None
+        """
+        stored = [self.write_to_historian(*point) for point in points]
+        if points:
+            self.post_to_influx(self.encoder.encode_batch(points), buffered=all(stored))
+
+    def write_to_historian(self, topic, tags, fields, timestamp):
+        """
+        Keeps a copy of a sensor value in the local historian, if this process writes to one
+        :returns: bool, was it stored
+        """
+        if not self.historian_writes or not tags or 'sensor' not in tags:
+            return False
+        if not isinstance(value := fields.get('value'), (int, float)):
+            return False
+        try:
+            self.historian.write(tags['sensor'], timestamp or time.time(), value, topic=topic, tags=tags)
+        except OSError as e:
+            self.logger.error(f'Couldn\'t write to the historian: {type(e)}: {e}')
+            return False
+        return True
+
+    def post_to_influx(self, data, buffered=False):
+        """
+        Sends line-protocol data to Influx
+        :param data: the encoded points
+        :param buffered: bool, are all the points in the historian, so they can be sent
+            again if Influx is down. Default False
+        :returns: None
+        """
+        url, headers, _ = self.influx_cfg
+        # requests would iterate over a bytearray
+        data = bytes(data)
+        raw_bytes = len(data)
+        dt = None
+        if self.influx_gzip is not None and raw_bytes >= self.influx_gzip.get('min_size', 1024):
+            t_start = time.perf_counter()
+            data = gzip.compress(data, compresslevel=self.influx_gzip.get('level', 6))
+            dt = time.perf_counter() - t_start
+            headers = {**headers, 'Content-Encoding': 'gzip'}
+        with self.stats_lock:
+            self.influx_stats['requests'] += 1
+            self.influx_stats['raw_bytes'] += raw_bytes
+            self.influx_stats['sent_bytes'] += len(data)
+            if dt is not None:
+                self.influx_stats['compressed'] += 1
+                self.influx_stats['compress_time'] += dt
+        try:
+            r = requests.post(url, headers=headers, data=data)
+        except requests.exceptions.RequestException as e:
+            if self.historian_writes:
+                self.influx_unreachable(f'{type(e)}: {e}')
+            if not buffered:
+                raise
+            return
+        if r.status_code >= 500 and self.historian_writes:
+            self.influx_unreachable(f'status code {r.status_code}')
+            if buffered:
+                return
+        if self.influx_down_since is not None and r.status_code in [200, 204]:
+            with self.stats_lock:
+                since, self.influx_down_since = self.influx_down_since, None
+            if since is not None:
+                threading.Thread(target=self.replay_to_influx, args=(since,), daemon=True).start()
         if r.status_code not in [200, 204]:
             # something went wrong
             self.logger.error(f'Got status code {r.status_code} instead of 200/204')
@@ -411,6 +532,54 @@ class Database(object):
                 self.logger.error(f'{type(e)}: {e}')
                 self.logger.error(r.content)
 
+    def influx_unreachable(self, reason):
+        """
+        Influx didn't take the data, but the historian has it and it'll go out again when
+        Influx is back
+        """
+        with self.stats_lock:
+            if self.influx_down_since is not None:
+                return
+            # a minute of margin for readings with older timestamps, rewriting a point is harmless
+            self.influx_down_since = time.time() - 60
+        self.logger.error(f'Influx unreachable ({reason}), keeping the data in the historian')
+
+    def replay_to_influx(self, since, batch=5000):
+        """
+        Sends the points the historian stored since an outage to Influx
+        :param since: unix time the outage started
+        :param batch: points per request. Default 5000
+        """
+        sent = 0
+        # only our own sensors, the other processes writing to this historian replay theirs
+        replay = self.historian.replay(since, names=set(self.historian.written))
+        while points := list(itertools.islice(replay, batch)):
+            self.post_to_influx(self.encoder.encode_batch(points), buffered=True)
+            if self.influx_down_since is not None:
+                break
+            sent += len(points)
+        with self.stats_lock:
+            if self.influx_down_since is not None:
+                # down again, the next replay has to start from the same place
+                self.influx_down_since = min(self.influx_down_since, since)
+                return
+        self.logger.info(f'Sent {sent} points from the historian to Influx')
+
+    def report_influx_compression(self):
+        """
+        Logs how much the Influx writes were compressed since the last call and resets the counters
+        :returns: dict with the counters, the ratio (raw/sent bytes) and the compression time in ms
+        """
+        with self.stats_lock:
+            stats = self.influx_stats
+            self.influx_stats = dict.fromkeys(stats, 0)
+        stats['ratio'] = stats['raw_bytes'] / stats['sent_bytes'] if stats['sent_bytes'] else 1
+        stats['compress_ms'] = 1000 * stats.pop('compress_time')
+        self.logger.info(f'Influx writes: {stats["requests"]} requests ({stats["compressed"]} compressed), '
+                         f'{stats["raw_bytes"]} -> {stats["sent_bytes"]} bytes, ratio {stats["ratio"]:.2f}, '
+                         f'{stats["compress_ms"]:.1f} ms compressing')
+        return stats
+
     def get_current_status(self):
         """
         Gives a snapshot of the current system status
@@ -15,6 +15,7 @@ class DeviceMonitor(Doberman.Monitor):
         print(f"self.name = {self.name}")
         print(f"plugin_dir = {plugin_dir}")
         self.device_ctor = Doberman.utils.find_plugin(self.name, plugin_dir)
+        self.db.open_historian(write=True)
         print(f"self.device_ctor = {self.device_ctor}")
         self.device = None
         cfg_doc = self.db.get_device_setting(self.name)
@@ -22,11 +23,31 @@ class DeviceMonitor(Doberman.Monitor):
         print(self.device)
         print(cfg_doc)
         self.open_device()
-        for rd in cfg_doc['sensors']:
-            self.start_sensor(rd)
+        self.start_sensors(cfg_doc['sensors'])
         self.register(name='heartbeat', obj=self.heartbeat,
                       period=self.db.get_experiment_config(name='hypervisor', field='period'), _no_stop=True)
 
+    def start_sensors(self, sensor_names):
+        """
+        Starts the sensors. If the device takes snapshots, the sensors it can
+        serve from a snapshot share one SnapshotSensor
+        """
+        snapshot = []
+        if getattr(self.device, 'snapshot', False):
+            for doc in self.db.read_from_db('sensors', {'name': {'$in': list(sensor_names)}}):
+                if 'multi_sensor' not in doc and len(doc['readout_command'].split()) == 2 \
+                        and doc['readout_command'].startswith('r '):
+                    snapshot.append(doc['name'])
+        if snapshot:
+            self.logger.info(f'Reading {len(snapshot)} sensors from snapshots')
+            sensor = Doberman.SnapshotSensor(sensor_names=snapshot, db=self.db,
+                                             logger=Doberman.utils.get_child_logger('snapshot', self.db, self.logger),
+                                             device_name=self.name, device=self.device)
+            self.register(name='snapshot', obj=sensor)
+        for sensor_name in sensor_names:
+            if sensor_name not in snapshot:
+                self.start_sensor(sensor_name)
+
     def start_sensor(self, sensor_name):
         self.logger.info(f'Constructing {sensor_name}')
         sensor_doc = self.db.get_sensor_setting(sensor_name)
@@ -113,7 +134,7 @@ class DeviceMonitor(Doberman.Monitor):
 
     def reload_sensors(self):
         sensors = self.db.get_device_setting(self.name, 'sensors')
-        for sensor_name in sensors:
+        for sensor_name in sensors + ['snapshot']:
             if sensor_name in self.threads.keys():
                 self.stop_thread(sensor_name)
-            self.start_sensor(sensor_name)
+        self.start_sensors(sensors)
@@ -0,0 +1,383 @@
+import bisect
+import collections
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+
+__all__ = 'Historian'.split()
+
+_double = struct.Struct('<d')
+
+
+class Series(object):
+    """
+    One time series on disk. The data is split into segments of at most segment_points
+    points, each segment is two append-only files of little-endian doubles, <start>.t with
+    the timestamps and <start>.v with the values, where start is the first timestamp in
+    microseconds. Timestamps are expected to increase. Reads go through mmap, full segments
+    don't change anymore so their maps are kept.
+    """
+
+    def __init__(self, path, segment_points=65536):
+        self.path = path
+        self.segment_points = segment_points
+        os.makedirs(path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.current = None  # [start, fd_t, fd_v, points] of the segment being written
+        self.maps = {}  # start: (t, v) for full segments
+        self.tail = None  # (start, fd_t, fd_v) of the newest segment, for last()
+        self.tail_lock = threading.RLock()
+
+    def segments(self):
+        """
+        :returns: sorted list of segment starts (microseconds)
+        """
+        return sorted(int(fn[:-2]) for fn in os.listdir(self.path) if fn.endswith('.t'))
+
+    def filename(self, start, column):
+        return os.path.join(self.path, f'{start:020d}.{column}')
+
+    def open_segment(self, start):
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+        fd_t = os.open(self.filename(start, 't'), flags, 0o644)
+        fd_v = os.open(self.filename(start, 'v'), flags, 0o644)
+        # if we crashed between the two writes, drop the half point
+        points = min(os.fstat(fd_t).st_size, os.fstat(fd_v).st_size) // 8
+        os.truncate(self.filename(start, 't'), points * 8)
+        os.truncate(self.filename(start, 'v'), points * 8)
+        self.current = [start, fd_t, fd_v, points]
+
+    def close_segment(self):
+        if self.current is not None:
+            os.close(self.current[1])
+            os.close(self.current[2])
+            self.current = None
+
+    def append(self, timestamp, value):
+        """
+        Adds one point
+        :returns: the start of the segment that just filled up, or None
+        """
+        closed = None
+        with self.lock:
+            if self.current is None and (starts := self.segments()):
+                # pick up where the last process left off
+                self.open_segment(starts[-1])
+            if self.current is not None and self.current[3] >= self.segment_points:
+                closed = self.current[0]
+                self.close_segment()
+            if self.current is None:
+                self.open_segment(int(timestamp * 1e6))
+            os.write(self.current[1], _double.pack(timestamp))
+            os.write(self.current[2], _double.pack(value))
+            self.current[3] += 1
+        return closed
+
+    def columns(self, start):
+        """
+        The timestamps and values of one segment
+        :returns: (t, v), memoryviews of doubles
+        """
+        if (ret := self.maps.get(start)) is not None:
+            return ret
+        cols = []
+        for column in 'tv':
+            try:
+                with open(self.filename(start, column), 'rb') as f:
+                    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                cols.append(memoryview(m).cast('d'))
+            except (FileNotFoundError, ValueError):
+                # deleted, or empty, which can't be mapped
+                cols.append(memoryview(b'').cast('d'))
+        n = min(len(cols[0]), len(cols[1]))
+        ret = (cols[0][:n], cols[1][:n])
+        if n >= self.segment_points:
+            self.maps[start] = ret
+        return ret
+
+    def query(self, start=None, end=None):
+        """
+        The points with start <= timestamp < end
+        :returns: (timestamps, values), lists
+        """
+        ts, vs = [], []
+        starts = self.segments()
+        for i, seg in enumerate(starts):
+            if end is not None and seg / 1e6 >= end:
+                break
+            if start is not None and i + 1 < len(starts) and starts[i + 1] / 1e6 <= start:
+                continue
+            t, v = self.columns(seg)
+            lo = bisect.bisect_left(t, start) if start is not None else 0
+            hi = bisect.bisect_left(t, end) if end is not None else len(t)
+            ts += t[lo:hi].tolist()
+            vs += v[lo:hi].tolist()
+        return ts, vs
+
+    def last(self):
+        """
+        The most recent point
+        :returns: (timestamp, value) or None
+        """
+        with self.tail_lock:
+            if self.tail is not None:
+                n, point = self.read_tail()
+                if 0 < n < self.segment_points:
+                    # the newest segment is still filling, so no need to look for a newer one
+                    return point
+            for seg in reversed(self.segments()):
+                if self.tail is None or self.tail[0] != seg:
+                    try:
+                        fds = tuple(os.open(self.filename(seg, column), os.O_RDONLY) for column in 'tv')
+                    except FileNotFoundError:
+                        continue
+                    self.close_tail()
+                    self.tail = (seg, *fds)
+                if (point := self.read_tail()[1]) is not None:
+                    return point
+            return None
+
+    def read_tail(self):
+        """
+        :returns: (number of points, last point or None) of the tail segment. A segment that
+            was deleted (by retention, maybe in another process) counts as empty
+        """
+        _, fd_t, fd_v = self.tail
+        st_t, st_v = os.fstat(fd_t), os.fstat(fd_v)
+        if st_t.st_nlink == 0 or st_v.st_nlink == 0:
+            self.close_tail()
+            return 0, None
+        if (n := min(st_t.st_size, st_v.st_size) // 8) == 0:
+            return 0, None
+        offset = (n - 1) * 8
+        return n, (_double.unpack(os.pread(fd_t, 8, offset))[0], _double.unpack(os.pread(fd_v, 8, offset))[0])
+
+    def close_tail(self):
+        """
+        Forgets the newest segment, so the next last() looks for it again
+        """
+        with self.tail_lock:
+            if self.tail is not None:
+                os.close(self.tail[1])
+                os.close(self.tail[2])
+                self.tail = None
+
+    def drop_before(self, cutoff):
+        """
+        Deletes the segments with only points older than cutoff
+        :returns: number of segments deleted
+        """
+        starts = self.segments()
+        dropped = 0
+        with self.lock:
+            for seg, following in zip(starts, starts[1:]):
+                if following / 1e6 > cutoff:
+                    break
+                if self.current is not None and self.current[0] == seg:
+                    break
+                self.maps.pop(seg, None)
+                for column in 'tv':
+                    try:
+                        os.remove(self.filename(seg, column))
+                    except FileNotFoundError:
+                        pass
+                dropped += 1
+        return dropped
+
+
+class Historian(object):
+    """
+    A local store of recent sensor history, so pipelines and tools don't need a round trip
+    to Influx for it, and so nothing is lost while Influx is unreachable. Each sensor gets a
+    directory with the raw data and one rollup (bin means) per configured width, see Series
+    for the format. The rollups are kept for longer. They're computed from the raw segments
+    that filled up, by roll_up_pending rather than on the write path, so whoever writes the
+    historian should call that every so often.
+    The measurement and tags of a sensor are kept in its meta.json, so the points can be
+    sent to Influx again later.
+    """
+
+    def __init__(self, path, segment_points=65536, retention=7 * 86400, rollups=(60, 3600),
+                 rollup_retention=365 * 86400):
+        """
+        :param path: the root directory
+        :param segment_points: points per segment file. Default 65536 (512 kB per column)
+        :param retention: how long to keep the raw data, in seconds. Default 7 days
+        :param rollups: bin widths in seconds of the rollups. Default (60, 3600)
+        :param rollup_retention: how long to keep the rollups, in seconds. Default 365 days
+        """
+        self.path = path
+        self.segment_points = segment_points
+        self.retention = retention
+        self.rollups = tuple(rollups)
+        self.rollup_retention = rollup_retention
+        self.series = {}
+        self.meta = {}
+        self.written = set()  # the sensors this process writes
+        self.pending = collections.deque()  # (name, segment start) of filled segments to roll up
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def get_series(self, name, width=None):
+        """
+        :param name: the sensor name
+        :param width: the rollup width, or None for the raw data
+        :returns: Series
+        """
+        key = (name, width)
+        if (ret := self.series.get(key)) is None:
+            with self.lock:
+                if (ret := self.series.get(key)) is None:
+                    ret = self.series[key] = Series(os.path.join(self.path, name, str(width or 'raw')),
+                                                    self.segment_points)
+        return ret
+
+    def sensors(self):
+        return sorted(d for d in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, d)))
+
+    def write(self, name, timestamp, value, topic=None, tags=None):
+        """
+        Adds one point
+        :param name: the sensor name
+        :param timestamp: unix time
+        :param value: the value, a number
+        :param topic: the Influx measurement, for replaying. Default None
+        :param tags: the Influx tags, for replaying. Default None
+        """
+        if topic is not None and self.meta.get(name) != (meta := {'topic': topic, 'tags': tags}):
+            self.meta[name] = meta
+            with open(os.path.join(self.get_series(name).path, os.pardir, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+        self.written.add(name)
+        if (closed := self.get_series(name).append(timestamp, float(value))) is not None:
+            self.pending.append((name, closed))
+
+    def roll_up_pending(self):
+        """
+        Rolls up the segments that filled up since the last call. A segment that fails is
+        not retried on its own, its bins go in with the next segment of the sensor
+        :returns: number of segments rolled up
+        """
+        done = 0
+        while self.pending:
+            name, segment = self.pending.popleft()
+            self.roll_up(name, segment)
+            done += 1
+        return done
+
+    def roll_up(self, name, segment):
+        """
+        Adds the bins completed by a filled segment to the rollups. Bins only go in once
+        complete, so one that spans two segments is done with the next one
+        """
+        raw = self.get_series(name)
+        t_end = raw.columns(segment)[0][-1]
+        for width in self.rollups:
+            rollup = self.get_series(name, width)
+            bin_end = math.floor(t_end / width) * width
+            bin_start = last[0] + width if (last := rollup.last()) is not None else None
+            t, v = raw.query(bin_start, bin_end)
+            for b, mean in zip(*self.bin(t, v, width)):
+                rollup.append(b, mean)
+
+    @staticmethod
+    def bin(t, v, width):
+        """
+        Means of v in bins of t
+        :returns: (bin starts, means)
+        """
+        bins, means = [], []
+        total = count = 0
+        current = None
+        for ti, vi in zip(t, v):
+            if (b := math.floor(ti / width) * width) != current:
+                if count:
+                    bins.append(current)
+                    means.append(total / count)
+                current, total, count = b, 0., 0
+            total += vi
+            count += 1
+        if count:
+            bins.append(current)
+            means.append(total / count)
+        return bins, means
+
+    def query(self, name, start=None, end=None):
+        """
+        The raw data of one sensor with start <= timestamp < end
+        :returns: (timestamps, values)
+        """
+        return self.get_series(name).query(start, end)
+
+    def last(self, name):
+        """
+        The most recent point of one sensor
+        :returns: (timestamp, value) or None
+        """
+        if not os.path.isdir(os.path.join(self.path, name)):
+            return None
+        return self.get_series(name).last()
+
+    def downsample(self, name, width, start=None, end=None):
+        """
+        Bin means of one sensor. Where the raw data has already expired, the stored
+        rollup of this width (if there is one) fills in
+        :returns: (bin starts, means)
+        """
+        bins, means = self.bin(*self.query(name, start, end), width)
+        if width in self.rollups:
+            older = bins[0] if bins else end
+            rb, rm = self.get_series(name, width).query(start, older)
+            bins, means = rb + bins, rm + means
+        return bins, means
+
+    def replay(self, start, end=None, names=None):
+        """
+        The points between start and end of the sensors with Influx metadata, ie to send
+        them again after an outage
+        :param names: which sensors. Default None (all of them)
+        :returns: generator of (topic, tags, fields, timestamp)
+        """
+        names = self.sensors() if names is None else sorted(names)
+        # what we know about the newest segments may be out of date by now
+        self.invalidate(names)
+        for name in names:
+            try:
+                with open(os.path.join(self.path, name, 'meta.json')) as f:
+                    meta = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+            for t, v in zip(*self.query(name, start, end)):
+                yield meta['topic'], meta['tags'], {'value': v}, t
+
+    def invalidate(self, names=None):
+        """
+        Drops the cached newest segments, so last() looks at the files again
+        :param names: which sensors. Default None (all of them)
+        """
+        for (name, _), series in list(self.series.items()):
+            if names is None or name in names:
+                series.close_tail()
+
+    def enforce_retention(self):
+        """
+        Deletes the data that's older than the retention times
+        :returns: number of segments deleted
+        """
+        now = time.time()
+        dropped = 0
+        for name in self.sensors():
+            dropped += self.get_series(name).drop_before(now - self.retention)
+            for width in self.rollups:
+                dropped += self.get_series(name, width).drop_before(now - self.rollup_retention)
+        return dropped
+
+    def close(self):
+        for series in self.series.values():
+            with series.lock:
+                series.close_segment()
+            series.close_tail()
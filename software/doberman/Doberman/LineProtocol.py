@@ -0,0 +1,132 @@
+import math
+import numbers
+import threading
+import time
+try:
+    import numpy as np
+    has_numpy = True
+except ImportError:
+    has_numpy = False
+
+__all__ = 'LineEncoder'.split()
+
+# see https://docs.influxdata.com/influxdb/v2.0/reference/syntax/line-protocol/#special-characters
+_measurement_escapes = str.maketrans({',': r'\,', ' ': r'\ ', '\n': r'\n'})
+_key_escapes = str.maketrans({',': r'\,', '=': r'\=', ' ': r'\ ', '\n': r'\n'})
+_string_escapes = str.maketrans({'"': r'\"', '\\': '\\\\'})
+
+
+def escape_measurement(name):
+    return str(name).translate(_measurement_escapes)
+
+
+def escape_key(key):
+    """
+    For tag keys, tag values and field keys
+    """
+    return str(key).translate(_key_escapes)
+
+
+def format_field(value):
+    """
+    One field value in line protocol, typed: bools are t/f, ints get an i, floats are
+    written as the shortest string that round-trips, everything else is a quoted string.
+    Other numeric types (ie numpy scalars) are written like the builtin they stand for
+    :returns: string, or None for values influx can't store (nan, inf)
+    """
+    if (t := type(value)) is float:
+        return repr(value) if math.isfinite(value) else None
+    if t is bool:
+        return 't' if value else 'f'
+    if isinstance(value, numbers.Integral):
+        return f'{int(value)}i'
+    if isinstance(value, numbers.Real):
+        return format_field(float(value))
+    if has_numpy and isinstance(value, np.bool_):
+        return format_field(bool(value))
+    return '"' + str(value).translate(_string_escapes) + '"'
+
+
+class LineEncoder(object):
+    """
+    Encodes points in InfluxDB line protocol. The measurement and tag set of a point
+    don't change between readings of a sensor, so they are escaped and encoded once and
+    cached as a prefix; encoding a point is then only the fields and the timestamp.
+    Batches are encoded into one bytearray that can be posted as it is.
+    """
+
+    def __init__(self, precision=1000, measurement_override=None):
+        """
+        :param precision: timestamp multiplier, ie 1000 for ms. Default 1000
+        :param measurement_override: if given, all points go into this measurement (the
+            'testing' experiment does this). Default None
+        """
+        self.precision = precision
+        self.measurement_override = measurement_override
+        self.prefixes = {}
+        self.field_keys = {}
+        self.lock = threading.Lock()
+
+    def prefix(self, topic, tags=None):
+        """
+        The encoded 'measurement,tag=value,...' of a point, with the tags sorted by key
+        as influx prefers
+        :param topic: the measurement
+        :param tags: dict of tags, or None
+        :returns: bytes
+        """
+        key = (topic, *tags.items()) if tags else topic
+        if (ret := self.prefixes.get(key)) is not None:
+            return ret
+        ret = escape_measurement(self.measurement_override or topic)
+        if tags:
+            ret += ''.join(f',{escape_key(k)}={escape_key(v)}' for k, v in sorted(tags.items()) if v != '')
+        ret = ret.encode()
+        with self.lock:
+            self.prefixes[key] = ret
+        return ret
+
+    def encode_into(self, buf, prefix, fields, timestamp=None):
+        """
+        Appends one point (and a newline if buf isn't empty) to buf
+        :param buf: a bytearray
+        :param prefix: from prefix()
+        :param fields: dict of field names and values
+        :param timestamp: unix time, default now
+        :returns: buf
+        """
+        line = ''
+        for k, v in fields.items():
+            if (key := self.field_keys.get(k)) is None:
+                key = self.field_keys[k] = escape_key(k)
+            # floats are the common case, so skip the call for those
+            if type(v) is float and math.isfinite(v):
+                line += f',{key}={v!r}'
+            elif (v := format_field(v)) is not None:
+                line += f',{key}={v}'
+        if not line:
+            raise ValueError(f'No valid fields in {fields}')
+        if buf:
+            buf += b'\n'
+        buf += prefix
+        buf += f' {line[1:]} {int((timestamp or time.time()) * self.precision)}'.encode()
+        return buf
+
+    def encode(self, topic, tags, fields, timestamp=None):
+        """
+        One point
+        :returns: bytearray
+        """
+        return self.encode_into(bytearray(), self.prefix(topic, tags), fields, timestamp)
+
+    def encode_batch(self, points):
+        """
+        Many points in one body
+        :param points: iterable of (topic, tags, fields, timestamp)
+        :returns: bytearray
+        """
+        buf = bytearray()
+        for topic, tags, fields, timestamp in points:
+            self.encode_into(buf, self.prefix(topic, tags), fields, timestamp)
+        return buf
+
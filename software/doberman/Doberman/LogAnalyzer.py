@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import concurrent.futures
+import csv
+import datetime
+import json
+import os
+import re
+
+from Doberman.LogIndex import LogIndex, iter_records, levels, process_name
+from Doberman.utils import LogSuppressor
+
+__all__ = 'LogAnalyzer'.split()
+
+_constructing = re.compile(r'^Monitor "(?P<name>[^"]+)" constructing')
+_thread_died = re.compile(r'^(?P<thread>.+)-thread died$')
+_ctor_failed = re.compile(r'^Caught a <class \'(?P<exc>[^\']+)\'> while constructing (?P<name>[^:]+): (?P<msg>.*)')
+
+
+def analyze_day(path, bucket=3600, episode_gap=90, t_start=None, t_end=None):
+    """
+    Reads one day directory. This is what the worker processes run, so it only returns
+    small summaries: the restarts, thread deaths merged into episodes, and counts.
+    Repeat summaries written by LogSuppressor count as the records they stand for.
+
+    :param path: the day directory
+    :param bucket: width of the error-rate bins in seconds. Default 3600
+    :param episode_gap: thread deaths of the same thread closer than this many seconds are
+        one episode. Default 90 (the thread check runs every 30 s)
+    :param t_start: unix time, ignore records before this. Default None
+    :param t_end: unix time, ignore records from this on. Default None
+    :returns: dict
+    """
+    restarts = collections.defaultdict(list)  # process: [timestamps]
+    episodes = {}  # (process, thread): [start, end, count]
+    done_episodes = []
+    rates = collections.Counter()  # (process, bin start, level): count
+    ctor_failures = collections.Counter()  # (process, exception, message): count
+    records = 0
+    for fn in LogIndex.log_files(path):
+        process = process_name(fn)
+        for _, (when, level, name, func, line, msg) in iter_records(os.path.join(path, fn)):
+            ts = when.timestamp()
+            if (t_start is not None and ts < t_start) or (t_end is not None and ts >= t_end):
+                continue
+            records += 1
+            # the repeats of a summary happened over the `spread` seconds up to ts
+            msg, count, spread = LogSuppressor.parse_summary(msg)
+            if levels[level] >= levels['WARNING']:
+                rates[(process, int(ts // bucket * bucket), level)] += count
+            if func == '__init__' and (m := _constructing.match(msg)) is not None:
+                restarts[m.group('name')] += [ts - spread * (count - 1 - i) / count for i in range(count)]
+            elif func == 'check_threads' and (m := _thread_died.match(msg)) is not None:
+                key = (process, m.group('thread'))
+                if (ep := episodes.get(key)) is not None and ts - spread - ep[1] <= episode_gap:
+                    ep[1] = ts
+                    ep[2] += count
+                else:
+                    if ep is not None:
+                        done_episodes.append((*key, *ep))
+                    episodes[key] = [ts - spread, ts, count]
+            elif (m := _ctor_failed.match(msg)) is not None:
+                ctor_failures[(m.group('name'), m.group('exc'), m.group('msg'))] += count
+    done_episodes += [(*key, *ep) for key, ep in episodes.items()]
+    return {'records': records,
+            'restarts': dict(restarts),
+            'thread_deaths': sorted(done_episodes, key=lambda e: e[2]),
+            'error_rates': [(*k, v) for k, v in rates.items()],
+            'ctor_failures': [(*k, v) for k, v in ctor_failures.items()]}
+
+
+class LogAnalyzer(object):
+    """
+    Streams through the log archive and collects the things we otherwise only find by eye:
+    how often each process restarts (and the MTBF), when threads die, how many
+    warnings/errors each process writes per time bin, and why processes fail to start.
+    Day directories are handed out to a process pool, each worker streams its files and
+    returns a small summary, so memory doesn't grow with the size of the archive.
+    """
+
+    def __init__(self, root, bucket=3600, episode_gap=90, workers=None):
+        """
+        :param root: the log directory of one experiment, ie /global/logs/<experiment>
+        :param bucket: width of the error-rate bins in seconds. Default 3600
+        :param episode_gap: see analyze_day. Default 90
+        :param workers: number of worker processes. Default None (one per cpu)
+        """
+        self.index = LogIndex(root)
+        self.bucket = bucket
+        self.episode_gap = episode_gap
+        self.workers = workers
+
+    def run(self, start=None, end=None):
+        """
+        Analyzes the archive between start and end (datetimes, both optional)
+        :returns: dict with the merged results
+        """
+        paths = [path for _, path in self.index.days(start, end)]
+        t_start = start.timestamp() if start is not None else None
+        t_end = end.timestamp() if end is not None else None
+        result = {'days': len(paths), 'records': 0, 'restarts': collections.defaultdict(list),
+                  'thread_deaths': [], 'error_rates': collections.Counter(), 'ctor_failures': collections.Counter()}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(analyze_day, path, self.bucket, self.episode_gap, t_start, t_end) for path in paths]
+            for future in futures:
+                day = future.result()
+                result['records'] += day['records']
+                for name, ts in day['restarts'].items():
+                    result['restarts'][name] += ts
+                result['thread_deaths'] += day['thread_deaths']
+                for *key, count in day['error_rates']:
+                    result['error_rates'][tuple(key)] += count
+                for *key, count in day['ctor_failures']:
+                    result['ctor_failures'][tuple(key)] += count
+        result['restarts'] = dict(result['restarts'])
+        result['thread_deaths'] = self.merge_episodes(result['thread_deaths'])
+        result['mtbf'] = self.mtbf(result['restarts'], t_start, t_end)
+        return result
+
+    def merge_episodes(self, episodes):
+        """
+        Joins episodes that span midnight
+        """
+        merged = []
+        last = {}
+        for process, thread, start, end, count in sorted(episodes, key=lambda e: e[2]):
+            if (ep := last.get((process, thread))) is not None and start - ep[3] <= self.episode_gap:
+                ep[3] = max(ep[3], end)
+                ep[4] += count
+                continue
+            ep = [process, thread, start, end, count]
+            last[(process, thread)] = ep
+            merged.append(ep)
+        return [tuple(ep) for ep in merged]
+
+    @staticmethod
+    def mtbf(restarts, start=None, end=None):
+        """
+        Mean time between restarts for each process, in seconds. The first start doesn't
+        count as a failure.
+        :returns: dict, keys = process names, values = (restarts, mtbf or None)
+        """
+        ret = {}
+        for name, ts in restarts.items():
+            ts = sorted(ts)
+            span = (end if end is not None else ts[-1]) - (start if start is not None else ts[0])
+            failures = len(ts) - 1 if start is None else len(ts)
+            ret[name] = (len(ts), span / failures if failures > 0 else None)
+        return ret
+
+    @staticmethod
+    def to_json(result, fn):
+        doc = dict(result)
+        doc['error_rates'] = [[*k, v] for k, v in result['error_rates'].items()]
+        doc['ctor_failures'] = [[*k, v] for k, v in result['ctor_failures'].items()]
+        with open(fn, 'w') as f:
+            json.dump(doc, f, indent=1)
+
+    @staticmethod
+    def to_csv(result, directory):
+        """
+        Writes restarts.csv, thread_deaths.csv, error_rates.csv and ctor_failures.csv
+        """
+        os.makedirs(directory, exist_ok=True)
+        tables = {
+            'restarts': (['process', 'restarts', 'mtbf_s'],
+                         [(k, n, m) for k, (n, m) in sorted(result['mtbf'].items())]),
+            'thread_deaths': (['process', 'thread', 'start', 'end', 'count'], result['thread_deaths']),
+            'error_rates': (['process', 'bin_start', 'level', 'count'],
+                            sorted((*k, v) for k, v in result['error_rates'].items())),
+            'ctor_failures': (['process', 'exception', 'message', 'count'],
+                              sorted((*k, v) for k, v in result['ctor_failures'].items())),
+        }
+        for name, (header, rows) in tables.items():
+            with open(os.path.join(directory, f'{name}.csv'), 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(header)
+                writer.writerows(rows)
+
+    @staticmethod
+    def report(result):
+        """
+        A short human-readable summary
+        :returns: string
+        """
+        fmt = lambda ts: datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M')
+        lines = [f'{result["records"]} records in {result["days"]} days', '', 'Restarts:']
+        for name, (n, mtbf) in sorted(result['mtbf'].items(), key=lambda kv: -kv[1][0]):
+            lines.append(f'  {name}: {n} starts, MTBF ' + (f'{mtbf / 3600:.2f} h' if mtbf else 'n/a'))
+        lines += ['', 'Thread deaths (longest episodes):']
+        for process, thread, start, end, count in sorted(result['thread_deaths'], key=lambda e: e[2] - e[3])[:20]:
+            lines.append(f'  {process}/{thread}: {count} reports, {fmt(start)} to {fmt(end)}')
+        per_process = collections.Counter()
+        for (process, _, level), count in result['error_rates'].items():
+            per_process[(process, level)] += count
+        lines += ['', 'Warnings and errors:']
+        for (process, level), count in sorted(per_process.items()):
+            lines.append(f'  {process} {level}: {count}')
+        if result['ctor_failures']:
+            lines += ['', 'Failures to start:']
+            for (name, exc, msg), count in result['ctor_failures'].most_common():
+                lines.append(f'  {name}: {count}x {exc}: {msg}')
+        return '\n'.join(lines)
+
+    def weekly_report(self, end=None):
+        """
+        The report for the 7 days before end (default now)
+        """
+        end = end or datetime.datetime.now()
+        return self.report(self.run(end - datetime.timedelta(days=7), end))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Analyze the Doberman log archive')
+    parser.add_argument('--root', help='Log directory, default /global/logs/$DOBERMAN_EXPERIMENT_NAME')
+    parser.add_argument('--start', type=datetime.datetime.fromisoformat, help='Earliest time, ie 2024-11-08')
+    parser.add_argument('--end', type=datetime.datetime.fromisoformat, help='Latest time')
+    parser.add_argument('--weekly', action='store_true', help='The last 7 days (before --end, if given)')
+    parser.add_argument('--bucket', type=int, default=3600, help='Error-rate bin width in seconds')
+    parser.add_argument('--workers', type=int, help='Number of worker processes')
+    parser.add_argument('--json', help='Write the results to this json file')
+    parser.add_argument('--csv', help='Write the results as csv files into this directory')
+    args = parser.parse_args()
+    root = args.root or f'/global/logs/{os.environ.get("DOBERMAN_EXPERIMENT_NAME", "")}'
+    analyzer = LogAnalyzer(root, bucket=args.bucket, workers=args.workers)
+    start = args.start
+    if args.weekly:
+        start = (args.end or datetime.datetime.now()) - datetime.timedelta(days=7)
+    result = analyzer.run(start, args.end)
+    print(analyzer.report(result))
+    if args.json:
+        analyzer.to_json(result, args.json)
+    if args.csv:
+        analyzer.to_csv(result, args.csv)
+
+
+if __name__ == '__main__':
+    main()
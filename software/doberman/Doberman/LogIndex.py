@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import gzip
+import json
+import logging
+import os
+import re
+import collections
+import contextlib
+
+from Doberman.utils import number_regex
+
+__all__ = 'LogIndex LogRecord parse_log_line message_template process_name'.split()
+
+LogRecord = collections.namedtuple('LogRecord', 'time level name func line msg file')
+
+levels = {'DEBUG': logging.DEBUG, 'INFO': logging.INFO, 'WARNING': logging.WARNING,
+          'ERROR': logging.ERROR, 'CRITICAL': logging.CRITICAL}
+
+_number = re.compile(number_regex)
+_filename = re.compile(r'^(?P<name>.+?)(?:\.\d+)?\.log(?:\.gz)?$')
+
+
+def process_name(filename):
+    """
+    The name of the process that wrote a log file, ie 'hypervisor' for hypervisor.log.gz
+    or for the size-rotated hypervisor.2.log
+    """
+    if (m := _filename.match(filename)) is not None:
+        return m.group('name')
+    return filename
+
+
+def message_template(msg):
+    """
+    The message with the numbers taken out, so repeats of the same message look the same
+    """
+    return _number.sub('#', msg)
+
+
+def parse_log_line(line):
+    """
+    Parses one line in the format written by DobermanLogger:
+    time | level | name | func | line | msg
+    :param line: string, without the trailing newline
+    :returns: (datetime, level, name, func, line, msg), or None if this isn't the start of a record
+    """
+    fields = line.split(' | ', 5)
+    if len(fields) != 6 or fields[1] not in levels:
+        return None
+    try:
+        when = datetime.datetime.fromisoformat(fields[0])
+    except ValueError:
+        return None
+    return when, fields[1], fields[2], fields[3], fields[4], fields[5]
+
+
+@contextlib.contextmanager
+def open_log(path, offset=0):
+    """
+    Opens a log file for binary reading, positioned at the given uncompressed offset.
+    Gzipped files written by BlockGzipWriter have a .blocks file next to them, which lets
+    us start decompressing at the right block rather than at the beginning.
+    """
+    if not path.endswith('.gz'):
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            yield f
+        return
+    coffset = uoffset = 0
+    if offset and os.path.exists(path + '.blocks'):
+        with open(path + '.blocks') as bf:
+            for line in bf:
+                c, u, _ = map(int, line.split())
+                if u > offset:
+                    break
+                coffset, uoffset = c, u
+    with open(path, 'rb') as raw:
+        raw.seek(coffset)
+        with gzip.GzipFile(fileobj=raw, mode='rb') as f:
+            if offset > uoffset:
+                f.seek(offset - uoffset)
+            yield f
+
+
+def iter_records(path, start_offset=0):
+    """
+    Generates the records in one log file. Lines that don't parse (ie, multi-line stderr output)
+    are appended to the previous record.
+    :param path: the .log or .log.gz file
+    :param start_offset: uncompressed byte offset to start from. Should be the start of a record
+    :yields: (offset, (datetime, level, name, func, line, msg))
+    """
+    with open_log(path, start_offset) as f:
+        offset = start_offset
+        current = None
+        current_offset = 0
+        try:
+            for raw in f:
+                line = raw.decode(errors='replace').rstrip('\n')
+                if (parsed := parse_log_line(line)) is not None:
+                    if current is not None:
+                        yield current_offset, current
+                    current = parsed
+                    current_offset = offset
+                elif current is not None:
+                    current = current[:5] + (current[5] + '\n' + line,)
+                offset += len(raw)
+        except EOFError:
+            # a file that is still being written can end in an incomplete gzip member
+            pass
+        if current is not None:
+            yield current_offset, current
+
+
+class LogIndex(object):
+    """
+    A compact index over the log archive written by OutputHandler, which looks like
+    <root>/YYYY/MM.DD/<name>.log[.gz] with root = /global/logs/<experiment>.
+    Each day directory gets a gzipped JSON index with, for every file, the time span,
+    and for every (logger, level) the number of records, the first and last offsets and
+    the ids of the message templates seen. Searches use it to skip files that can't match,
+    and to stop reading a file once the interesting part is over. Files that aren't in the
+    index, or whose size or mtime changed since, are just scanned.
+    """
+    index_name = '.doberman_index.json.gz'
+    version = 2
+    checkpoint_every = 5000  # lines
+
+    def __init__(self, root):
+        """
+        :param root: the log directory of one experiment, ie /global/logs/<experiment>
+        """
+        self.root = root
+
+    def day_dir(self, date):
+        return os.path.join(self.root, f'{date.year}', f'{date.month:02d}.{date.day:02d}')
+
+    def days(self, start=None, end=None):
+        """
+        The day directories in the archive, oldest first
+        :yields: (date, path)
+        """
+        if not os.path.isdir(self.root):
+            return
+        for year in sorted(os.listdir(self.root)):
+            if not year.isdigit():
+                continue
+            for md in sorted(os.listdir(os.path.join(self.root, year))):
+                try:
+                    date = datetime.date(int(year), *map(int, md.split('.')))
+                except (ValueError, TypeError):
+                    continue
+                if start is not None and date < start.date():
+                    continue
+                if end is not None and date > end.date():
+                    continue
+                yield date, os.path.join(self.root, year, md)
+
+    @staticmethod
+    def log_files(path):
+        return sorted(fn for fn in os.listdir(path) if fn.endswith('.log') or fn.endswith('.log.gz'))
+
+    def load_day(self, path):
+        """
+        :returns: the index of a day directory, or None if there isn't a usable one
+        """
+        try:
+            with gzip.open(os.path.join(path, self.index_name), 'rt') as f:
+                doc = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if doc.get('version') != self.version:
+            return None
+        return doc
+
+    @staticmethod
+    def stat(path):
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns]
+
+    def index_file(self, path, templates):
+        """
+        Builds the index entry of one file
+        :param path: the log file
+        :param templates: dict of template: id, shared within the day. Will be added to
+        :returns: dict
+        """
+        loggers = {}
+        first = last = None
+        checkpoints = []
+        for i, (offset, (when, level, name, func, line, msg)) in enumerate(iter_records(path)):
+            ts = when.timestamp()
+            first = ts if first is None else first
+            last = ts
+            if i % self.checkpoint_every == 0:
+                checkpoints.append([ts, offset])
+            template_id = templates.setdefault(message_template(msg), len(templates))
+            entry = loggers.setdefault(name, {}).setdefault(level, [0, offset, offset, set()])
+            entry[0] += 1
+            entry[2] = offset
+            entry[3].add(template_id)
+        for by_level in loggers.values():
+            for entry in by_level.values():
+                entry[3] = sorted(entry[3])
+        return {'stat': self.stat(path), 'first': first, 'last': last,
+                'checkpoints': checkpoints, 'loggers': loggers}
+
+    def index_day(self, path, force=False):
+        """
+        (Re)builds the index of one day directory if anything in it changed
+        :param path: the day directory
+        :param force: rebuild even if nothing changed. Default False
+        :returns: the index
+        """
+        files = self.log_files(path)
+        doc = None if force else self.load_day(path)
+        if doc is not None and set(doc['files']) == set(files) and \
+                all(doc['files'][fn]['stat'] == self.stat(os.path.join(path, fn)) for fn in files):
+            return doc
+        templates = {}
+        doc = {'version': self.version, 'files': {}}
+        for fn in files:
+            doc['files'][fn] = self.index_file(os.path.join(path, fn), templates)
+        doc['templates'] = [t for t, _ in sorted(templates.items(), key=lambda kv: kv[1])]
+        tmp = os.path.join(path, self.index_name + '.tmp')
+        with gzip.open(tmp, 'wt') as f:
+            json.dump(doc, f, separators=(',', ':'))
+        os.replace(tmp, os.path.join(path, self.index_name))
+        return doc
+
+    def update(self, until=None, since=None):
+        """
+        Brings the index up to date. Days that haven't changed are skipped, so this is cheap to
+        call regularly (ie, whenever logs get compressed)
+        :param until: datetime.date, don't index days after this one. Default yesterday,
+            because today's files are still being written
+        :param since: datetime.date, don't index days before this one. Default None
+        :returns: number of day directories checked
+        """
+        until = until or datetime.date.today() - datetime.timedelta(days=1)
+        n = 0
+        for date, path in self.days():
+            if date > until:
+                break
+            if since is not None and date < since:
+                continue
+            self.index_day(path)
+            n += 1
+        return n
+
+    @staticmethod
+    def query_fragments(contains):
+        """
+        The parts of a search string that survive templating, to compare against the templates
+        """
+        return [f for f in (s.strip('.+-eE') for s in re.split(r'[0-9]+', contains)) if f]
+
+    def file_candidates(self, entry, path, templates, logger, min_level, fragments, start, end):
+        """
+        Uses one file's index entry to decide if it can hold matches
+        :param path: the file, to check that the entry is still current
+        :returns: None if it can't, otherwise (first offset, last offset or None) worth reading
+        """
+        if entry['stat'] != self.stat(path):
+            # changed since it was indexed, so the entry can't rule anything out
+            return 0, None
+        if entry['first'] is None:
+            return None
+        if (start is not None and entry['last'] < start) or (end is not None and entry['first'] > end):
+            return None
+        lo = hi = None
+        for name, by_level in entry['loggers'].items():
+            if logger is not None and name != logger:
+                continue
+            for level, (count, first, last, ids) in by_level.items():
+                if levels[level] < min_level:
+                    continue
+                if fragments and not any(all(f in templates[i] for f in fragments) for i in ids):
+                    continue
+                lo = first if lo is None else min(lo, first)
+                hi = last if hi is None else max(hi, last)
+        if lo is None:
+            return None
+        if start is not None:
+            # skip ahead using the checkpoints
+            for ts, offset in entry['checkpoints']:
+                if ts >= start:
+                    break
+                lo = max(lo, offset)
+            if lo > hi:
+                return None
+        return lo, hi
+
+    def search(self, start=None, end=None, logger=None, process=None, level=None, contains=None,
+               limit=None, reverse=False):
+        """
+        Finds log records
+
+        :param start: datetime, only records at or after this (local time, like the logs). Default None
+        :param end: datetime, only records before this. Default None
+        :param logger: the name in the third column (ie, a sensor or 'device'). Default None
+        :param process: the name of the log file (ie, 'hypervisor', 'Waveshare4'). Default None
+        :param level: the minimum level, ie 'WARNING'. Default None
+        :param contains: a substring of the message. Default None
+        :param limit: the most records to return. Default None
+        :param reverse: bool, newest first. Default False
+        :yields: LogRecord
+        """
+        t_start = start.timestamp() if start is not None else None
+        t_end = end.timestamp() if end is not None else None
+        min_level = levels[level.upper()] if level is not None else 0
+        fragments = self.query_fragments(contains) if contains else []
+        days = list(self.days(start, end))
+        if reverse:
+            days = days[::-1]
+        found = 0
+        for date, path in days:
+            doc = self.load_day(path)
+            files = self.log_files(path)
+            if reverse:
+                files = files[::-1]
+            for fn in files:
+                if process is not None and process_name(fn) != process:
+                    continue
+                full_path = os.path.join(path, fn)
+                span = (0, None)
+                if doc is not None and (entry := doc['files'].get(fn)) is not None:
+                    if (span := self.file_candidates(entry, full_path, doc['templates'], logger, min_level,
+                                                     fragments, t_start, t_end)) is None:
+                        continue
+                matches = self.scan_file(full_path, span, start, end, logger, min_level, contains)
+                if reverse:
+                    matches = reversed(list(matches))
+                for rec in matches:
+                    yield rec
+                    found += 1
+                    if limit is not None and found >= limit:
+                        return
+
+    @staticmethod
+    def scan_file(path, span, start, end, logger, min_level, contains):
+        first, last = span
+        for offset, (when, level, name, func, line, msg) in iter_records(path, first):
+            if last is not None and offset > last:
+                break
+            if start is not None and when < start:
+                continue
+            if end is not None and when >= end:
+                break
+            if logger is not None and name != logger:
+                continue
+            if levels[level] < min_level:
+                continue
+            if contains and contains not in msg:
+                continue
+            yield LogRecord(when, level, name, func, line, msg, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search the Doberman log archive')
+    parser.add_argument('--root', help='Log directory, default /global/logs/$DOBERMAN_EXPERIMENT_NAME')
+    parser.add_argument('--update', action='store_true', help='Update the index before searching')
+    parser.add_argument('--start', type=datetime.datetime.fromisoformat, help='Earliest time, ie 2024-11-08T12:00')
+    parser.add_argument('--end', type=datetime.datetime.fromisoformat, help='Latest time')
+    parser.add_argument('--logger', help='Logger name (third column)')
+    parser.add_argument('--process', help='Log file name, ie hypervisor')
+    parser.add_argument('--level', help='Minimum level, ie WARNING')
+    parser.add_argument('--contains', help='Substring of the message')
+    parser.add_argument('--limit', type=int, help='Maximum number of records')
+    parser.add_argument('--last', action='store_true', help='Newest first')
+    args = parser.parse_args()
+    root = args.root or f'/global/logs/{os.environ.get("DOBERMAN_EXPERIMENT_NAME", "")}'
+    index = LogIndex(root)
+    if args.update:
+        print(f'Checked {index.update()} days')
+    for rec in index.search(start=args.start, end=args.end, logger=args.logger, process=args.process,
+                            level=args.level, contains=args.contains, limit=args.limit, reverse=args.last):
+        print(f'{rec.time.isoformat(sep=" ")} | {rec.level} | {rec.name} | {rec.func} | {rec.line} | {rec.msg}')
+
+
+if __name__ == '__main__':
+    main()
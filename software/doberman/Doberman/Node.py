@@ -170,8 +170,12 @@ class InfluxSourceNode(SourceNode):
         self.req_headers = headers
         self.req_params = params
         self.last_time = 0
+        self.historian = kwargs.get('historian')
 
     def get_from_influx(self):
+        if self.historian is not None and (point := self.historian.last(self.input_var)) is not None:
+            # this sensor is read out on this host, no need to ask Influx
+            return int(point[0] * 1e9), point[1]
         response = requests.get(self.req_url, headers=self.req_headers, params=self.req_params)
         try:
             timestamp, val = response.content.decode().splitlines()[1].split(',')[-2:]
@@ -184,7 +188,8 @@ class InfluxSourceNode(SourceNode):
 
     def get_package(self):
         timestamp, val = self.get_from_influx()
-        if self.last_time == timestamp and not self.accept_old:
+        # sensors with a deadband only write when the value changes
+        if self.last_time == timestamp and not (self.accept_old or self.config.get('deadband')):
             # try again, in the 10ms or so a new value may have just arrived
             timestamp, val = self.get_from_influx()
             if self.last_time == timestamp:
@@ -407,12 +412,12 @@ class PolynomialNode(Node):
     :param transform: list of numbers, the little-endian-ordered coefficients. The
         calculation is done as a*v**i for i,a in enumerate(transform), so to output a 
         constant you would specity [value], to leave the input unchanged you would
-        specify [0, 1], a quadratic could be [c, b, a], etc
+        specify [0, 1], a quadratic could be [c, b, a], etc. Can also be any of the
+        other transforms get_transform understands
     """
 
     def process(self, package):
-        xform = self.config.get('transform', [0, 1])
-        return sum(a * package[self.input_var] ** i for i, a in enumerate(xform))
+        return Doberman.get_transform(self.config.get('transform', [0, 1]))(package[self.input_var])
 
 
 class InfluxSinkNode(Node):
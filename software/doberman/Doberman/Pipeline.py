@@ -112,7 +112,7 @@ class Pipeline(threading.Thread):
                                     ('error', self.last_error),
                                     ('rate', sum(timing.values()))])
         drift = max(drift, 0.001)  # min 1ms of drift
-        return max(d['readout_interval'] for d in sensor_docs.values()) + drift
+        return max(Doberman.utils.effective_interval(d) for d in sensor_docs.values()) + drift
 
     def build(self, config):
         """
@@ -177,14 +177,17 @@ class Pipeline(threading.Thread):
                         for field in fields:
                             setup_kwargs[field] = doc.get(field)
                     setup_kwargs['influx_cfg'] = influx_cfg
+                    setup_kwargs['historian'] = self.db.historian
                     setup_kwargs['write_to_influx'] = self.db.write_to_influx
                     setup_kwargs['log_alarm'] = getattr(self.monitor, 'log_alarm', None)
+                    setup_kwargs['alarm_state'] = getattr(self.monitor, 'alarm_state', None)
                     for k in 'escalation_config silence_duration silence_duration_cant_send max_reading_delay'.split():
                         setup_kwargs[k] = alarm_cfg[k]
                     setup_kwargs['get_pipeline_stats'] = self.db.get_pipeline_stats
                     setup_kwargs['set_sensor_setting'] = self.db.set_sensor_setting
                     setup_kwargs['get_sensor_setting'] = self.db.get_sensor_setting
                     setup_kwargs['distinct'] = self.db.distinct
+                    setup_kwargs['get_triggered_sensors'] = self.db.get_triggered_sensors
                     setup_kwargs['cv'] = getattr(self, 'cv', None)
                     try:
                         n.setup(**setup_kwargs)
@@ -266,6 +269,12 @@ class Pipeline(threading.Thread):
                     rd = sensor_docs[node.input_var]
                     for config_item in node.sensor_config_needed:
                         this_node_config[config_item] = rd[config_item]
+                    if 'readout_interval' in node.sensor_config_needed:
+                        # so the alarms don't fire when an adaptive sensor slows down or a
+                        # sensor with a deadband doesn't publish an unchanged value
+                        this_node_config['readout_interval'] = Doberman.utils.publish_interval(rd)
+                elif isinstance(node, Doberman.InfluxSourceNode) and node.input_var in sensor_docs:
+                    this_node_config['deadband'] = Doberman.utils.deadband_config(sensor_docs[node.input_var])
                 node.load_config(this_node_config)
 
     def silence_for(self, duration, level=-1):
@@ -20,6 +20,8 @@ class PipelineMonitor(Doberman.Monitor):
         if flavor not in 'alarm control convert'.split():
             raise ValueError(
                 f'Unknown pipeline monitor {self.name}, allowed are "pl_alarm", "pl_convert", "pl_control"')
+        # for reading recent values locally, the device monitors write it
+        self.db.open_historian()
         for name in self.db.get_pipelines(flavor):
             self.start_pipeline(name)
         if self.name == 'pl_control':
@@ -1,8 +1,44 @@
 import threading
 import time
+import collections
 import zmq
+import Doberman
 
-__all__ = 'Sensor MultiSensor'.split()
+__all__ = 'Sensor MultiSensor SnapshotSensor Deadband'.split()
+
+
+class Deadband(object):
+    """
+    Decides which readings get published. A reading goes out if it differs from the last
+    published value by more than the threshold, or if the heartbeat time has passed since.
+    When the value moves out of the deadband, the last reading that was held back is
+    published first, so that holding each value until the next point reproduces the
+    signal to within the threshold and the time of the step is exact.
+    """
+
+    def __init__(self):
+        self.last = {}  # name: [published value, published time, held (value, time) or None]
+
+    def filter(self, name, value, timestamp, config):
+        """
+        :param name: the sensor name
+        :param value: the new value
+        :param timestamp: its timestamp
+        :param config: (threshold, heartbeat) from utils.deadband_config, or None
+        :returns: list of (value, timestamp) to publish
+        """
+        if config is None:
+            return [(value, timestamp)]
+        threshold, heartbeat = config
+        if (last := self.last.get(name)) is None:
+            self.last[name] = [value, timestamp, None]
+            return [(value, timestamp)]
+        if (moved := abs(value - last[0]) > threshold) or timestamp - last[1] >= heartbeat:
+            ret = [last[2]] if moved and last[2] is not None else []
+            self.last[name] = [value, timestamp, None]
+            return ret + [(value, timestamp)]
+        last[2] = (value, timestamp)
+        return []
 
 
 class Sensor(threading.Thread):
@@ -20,7 +56,8 @@ class Sensor(threading.Thread):
         self.device_process = kwargs['device'].process_one_value
         self.schedule = kwargs['device'].add_to_schedule
         self.cv = threading.Condition()
-        doc = self.db.get_sensor_setting(name=self.name)
+        self.deadband = Deadband()
+        doc = self.get_config()
         self.setup(doc)
         self.update_config(doc)
         ctx = zmq.Context.instance()
@@ -32,13 +69,28 @@ class Sensor(threading.Thread):
         self.logger.info(f'Starting')
         while not self.event.is_set():
             loop_top = time.time()
-            doc = self.db.get_sensor_setting(name=self.name)
-            self.update_config(doc)
-            if doc['status'] == 'online':
-                self.do_one_measurement()
+            self.tick()
             self.event.wait(loop_top + self.readout_interval - time.time())
         self.logger.info(f'Returning')
 
+    def tick(self):
+        """
+        One readout cycle. Called by run() or, when this sensor doesn't get its own
+        thread, by the monitor's scheduler
+        :returns: the readout interval
+        """
+        doc = self.get_config()
+        self.update_config(doc)
+        if doc['status'] == 'online':
+            self.do_one_measurement()
+        return self.readout_interval
+
+    def get_config(self):
+        """
+        :returns: the sensor document from the database
+        """
+        return self.db.get_sensor_setting(name=self.name)
+
     def setup(self, config_doc):
         """
         Initial setup using whatever parameters are in the config doc
@@ -48,14 +100,46 @@ class Sensor(threading.Thread):
         self.topic = config_doc['topic']
         self.subsystem = config_doc['subsystem']
         self.readout_command = config_doc['readout_command']
+        # sensors with the same readout get the same phase so the device can coalesce them
+        self.phase_key = f'{self.device_name} {self.readout_command}'
+        self.readout_interval = None
+        self.last_value = None
+        self.last_time = None
+        self.published_interval = config_doc.get('effective_interval')
+        self.published_at = None
 
     def update_config(self, doc):
         """
         Updates runtime configs. This is called at the start of a measurement cycle.
         :param doc: the sensor document from the database
         """
-        self.readout_interval = doc['readout_interval']
-        self.xform = doc.get('value_xform', [0, 1])
+        self.xform = Doberman.get_transform(doc.get('value_xform', [0, 1]))
+        self.deadbands = {self.name: Doberman.utils.deadband_config(doc)}
+        self.base_interval = doc['readout_interval']
+        self.adaptive = doc.get('adaptive')
+        if not self.adaptive:
+            self.readout_interval = self.base_interval
+            return
+        # adaptive: {min_interval, max_interval, tolerance, min_tolerance, alarm_margin,
+        # publish_tolerance, publish_holdoff}, or just true for the defaults
+        cfg = self.adaptive if isinstance(self.adaptive, dict) else {}
+        self.min_interval = cfg.get('min_interval', self.base_interval / 4)
+        self.max_interval = cfg.get('max_interval', self.base_interval * 4)
+        self.tolerance = cfg.get('tolerance')
+        self.min_tolerance = cfg.get('min_tolerance', 1e-9)
+        self.alarm_margin = cfg.get('alarm_margin', 0.1)
+        self.publish_tolerance = cfg.get('publish_tolerance', 0.1)
+        self.publish_holdoff = cfg.get('publish_holdoff', 60)
+        # only a [low, high] pair counts, bitmask alarms keep (mask, target, msg) triples here
+        thresholds = doc.get('alarm_thresholds')
+        self.thresholds = None
+        if isinstance(thresholds, (list, tuple)) and len(thresholds) == 2 and \
+                all(isinstance(t, (int, float)) and not isinstance(t, bool) for t in thresholds) and \
+                thresholds[0] < thresholds[1]:
+            self.thresholds = (float(thresholds[0]), float(thresholds[1]))
+        if self.readout_interval is None:
+            self.readout_interval = self.published_interval or self.base_interval
+        self.readout_interval = min(self.max_interval, max(self.min_interval, self.readout_interval))
 
     def do_one_measurement(self):
         """
@@ -80,16 +164,74 @@ class Sensor(threading.Thread):
         if value is not None:
             value = self.more_processing(value)
             self.send_downstream(value, pkg['time'])
+            if self.adaptive:
+                self.adapt(value, pkg['time'])
         else:
             self.logger.error(f'Got None')
         return
 
+    def adapt(self, value, timestamp):
+        """
+        Works out the next readout interval for adaptive sensors. If the value moved by more
+        than the tolerance since the last reading the interval is halved, if it moved by less
+        than a quarter of that it grows by half. Close to the alarm thresholds, or when the
+        current rate of change would cross one before the next reading, it's the minimum.
+        The result is published to the sensor doc so the pipelines know what to expect, see
+        publish_interval.
+        """
+        if self.last_value is not None and timestamp > self.last_time:
+            tolerance = self.tolerance
+            if tolerance is None:
+                # 1% of the alarm band, or of the value
+                tolerance = 0.01 * (self.thresholds[1] - self.thresholds[0] if self.thresholds else abs(value))
+            # so a value sitting at 0 can still relax
+            tolerance = max(tolerance, self.min_tolerance)
+            change = abs(value - self.last_value)
+            interval = self.readout_interval
+            if change > tolerance:
+                interval /= 2
+            elif change < tolerance / 4:
+                interval *= 1.5
+            if self.thresholds:
+                low, high = self.thresholds
+                margin = self.alarm_margin * (high - low)
+                projected = value + (value - self.last_value) / (timestamp - self.last_time) * interval
+                if not (low + margin <= value <= high - margin) or not (low < projected < high):
+                    interval = self.min_interval
+            self.readout_interval = min(self.max_interval, max(self.min_interval, interval))
+        self.last_value, self.last_time = value, timestamp
+        self.publish_interval(timestamp)
+
+    def publish_interval(self, timestamp):
+        """
+        Writes the readout interval to the sensor doc, if it changed enough. The pipelines
+        use it as an upper bound (how long until a reading is late), so a longer interval
+        goes out as soon as it's more than publish_tolerance above the published one. A shorter
+        one has to be more than publish_tolerance below, and at most one goes out every
+        publish_holdoff seconds, so an interval that jumps around doesn't cost a write per reading.
+        """
+        published = self.published_interval
+        if published is not None:
+            if published * (1 - self.publish_tolerance) <= self.readout_interval <= \
+                    published * (1 + self.publish_tolerance):
+                return
+            if self.readout_interval < published and self.published_at is not None and \
+                    timestamp - self.published_at < self.publish_holdoff:
+                return
+        try:
+            self.db.set_sensor_setting(self.name, 'effective_interval', round(self.readout_interval, 3))
+        except Exception as e:
+            self.logger.info(f'Couldn\'t publish the readout interval: {type(e)}: {e}')
+            return
+        self.published_interval = round(self.readout_interval, 3)
+        self.published_at = timestamp
+
     def more_processing(self, value):
         """
         Does something interesting with the value. Should return a value
 
         """
-        value = sum(a * value ** i for i, a in enumerate(self.xform))
+        value = self.xform(value)
         value = int(value) if self.is_int else float(value)
         return value
 
@@ -98,9 +240,10 @@ class Sensor(threading.Thread):
         This function sends data downstream to wherever it should end up
         """
         tags = {'subsystem': self.subsystem, 'device': self.device_name, 'sensor': self.name}
-        fields = {'value': value}
-        self.db.write_to_influx(topic=self.topic, tags=tags, fields=fields, timestamp=timestamp)
-        self.socket.send_string(f'{self.name} {timestamp:.3f} {value}')
+        for value, timestamp in self.deadband.filter(self.name, value, timestamp, self.deadbands[self.name]):
+            fields = {'value': value}
+            self.db.write_to_influx(topic=self.topic, tags=tags, fields=fields, timestamp=timestamp)
+            self.socket.send_string(f'{self.name} {timestamp:.3f} {value}')
 
 
 class MultiSensor(Sensor):
@@ -136,30 +279,129 @@ class MultiSensor(Sensor):
 
     def update_config(self, doc):
         super().update_config(doc)
+        self.adaptive = None  # only single values can adapt
+        self.readout_interval = self.base_interval
         self.xform = {}
         for n in self.all_names:
             rdoc = self.db.get_sensor_setting(name=n)
-            self.xform[n] = rdoc.get('value_xform', [0, 1])
+            self.xform[n] = Doberman.get_transform(rdoc.get('value_xform', [0, 1]))
+            self.deadbands[n] = Doberman.utils.deadband_config(rdoc)
 
     def more_processing(self, values):
         """
-        Convert from a list to a dict here
+        Convert from a list to a dict here. Sensors with the same transform are done together
         """
-        _values = {}
+        groups = collections.defaultdict(list)  # transform: [(name, value)]
         for name, value in zip(self.all_names, values):
-            print(value)
-            if value is None:
-                continue
-            value = sum(a * value ** j for j, a in enumerate(self.xform[name]))
-            _values[name] = int(value) if self.is_int[name] else float(value)
+            if value is not None:
+                groups[self.xform[name]].append((name, value))
+        _values = {}
+        for xform, items in groups.items():
+            for (name, _), value in zip(items, xform.many([v for _, v in items])):
+                _values[name] = int(value) if self.is_int[name] else float(value)
         return _values
 
     def send_downstream(self, values, timestamp):
         """
         values is the dict we produce in more_processing
         """
-        for n, v in values.items():
+        for n, value in values.items():
             tags = {'sensor': n, 'subsystem': self.subsystem[n], 'device': self.device_name}
-            fields = {'value': v}
-            self.db.write_to_influx(topic=self.topics[n], tags=tags, fields=fields, timestamp=timestamp)
-            self.socket.send_string(f'{n} {timestamp:.3f} {v}')
+            for v, t in self.deadband.filter(n, value, timestamp, self.deadbands.get(n)):
+                fields = {'value': v}
+                self.db.write_to_influx(topic=self.topics[n], tags=tags, fields=fields, timestamp=t)
+                self.socket.send_string(f'{n} {t:.3f} {v}')
+
+
+class SnapshotSensor(MultiSensor):
+    """
+    Reads out many sensors of one device at once. The device copies all the inputs it
+    knows about in one go (the RevPi process image, see RevPiDevice.read_inputs) and the
+    values are handed out to the sensors with a shared timestamp. Each sensor keeps its
+    own status and readout_interval, the snapshot is taken at the shortest interval.
+    The readout_commands of the sensors have to look like 'r <variable>'.
+    The sensor documents are reloaded every config_period seconds rather than every snapshot.
+    """
+    config_period = 10
+
+    def __init__(self, **kwargs):
+        self.all_names = kwargs['sensor_names']
+        self.config_period = kwargs.get('config_period', self.config_period)
+        self.next_config = time.monotonic() + self.config_period
+        self.set_inputs = kwargs['device'].set_inputs
+        self.process_one = kwargs['device'].process_one_value
+        kwargs.setdefault('sensor_name', 'snapshot')
+        super().__init__(**kwargs)
+
+    def get_docs(self):
+        """
+        All the sensor documents in one query
+        """
+        return {doc['name']: doc for doc in self.db.read_from_db('sensors', {'name': {'$in': self.all_names}})}
+
+    def get_config(self):
+        # there's no document for the snapshot itself, setup and update_config use get_docs
+        return None
+
+    def setup(self, config_doc):
+        self.readout_command = 'snapshot'
+        self.variables = {}
+        self.topics = {}
+        self.is_int = {}
+        self.subsystem = {}
+        self.last = {}
+        for n, doc in self.get_docs().items():
+            self.variables[n] = doc['readout_command'].split()[1]
+            self.topics[n] = doc['topic']
+            self.is_int[n] = doc.get('is_int', False)
+            self.subsystem[n] = doc['subsystem']
+            self.last[n] = 0
+        self.set_inputs(sorted(set(self.variables.values())))
+
+    def update_config(self, doc):
+        self.intervals = {}
+        self.xform = {}
+        self.deadbands = {}
+        self.online = set()
+        for n, rdoc in self.get_docs().items():
+            self.intervals[n] = rdoc['readout_interval']
+            self.xform[n] = Doberman.get_transform(rdoc.get('value_xform', [0, 1]))
+            self.deadbands[n] = Doberman.utils.deadband_config(rdoc)
+            if rdoc['status'] == 'online':
+                self.online.add(n)
+        self.readout_interval = min(self.intervals.values(), default=1)
+
+    def tick(self):
+        if (now := time.monotonic()) >= self.next_config:
+            self.update_config(None)
+            self.next_config = now + self.config_period
+        if self.online:
+            self.do_one_measurement()
+        return self.readout_interval
+
+    def do_one_measurement(self):
+        """
+        Takes a snapshot and sends the values of the sensors that are due
+        """
+        pkg = {}
+        self.schedule(self.readout_command, ret=(pkg, self.cv))
+        with self.cv:
+            self.cv.wait_for(lambda: (len(pkg) > 0 or self.event.is_set()), self.readout_interval)
+        if not pkg.get('data'):
+            self.logger.error('Didn\'t get anything from the device!')
+            return
+        values = {}
+        for n in self.online:
+            # half an interval of slack so sensors don't skip a snapshot because of jitter
+            if pkg['time'] - self.last[n] < self.intervals[n] - 0.5 * self.readout_interval:
+                continue
+            try:
+                value = self.process_one(name=n, data=pkg['data'][self.variables[n]])
+                value = self.xform[n](value)
+            except (KeyError, ValueError, TypeError, ZeroDivisionError) as e:
+                self.logger.error(f'Got a {type(e)} while processing {n}: {e}')
+                continue
+            values[n] = int(value) if self.is_int[n] else float(value)
+            self.last[n] = pkg['time']
+        if values:
+            self.send_downstream(values, pkg['time'])
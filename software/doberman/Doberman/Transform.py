@@ -0,0 +1,171 @@
+try:
+    import numpy as np
+    has_numpy = True
+except ImportError:
+    has_numpy = False
+import bisect
+import json
+import math
+import threading
+
+__all__ = 'Transform Polynomial LookupTable CallendarVanDusen get_transform'.split()
+
+
+class Transform(object):
+    """
+    Base class for value transformations (calibrations). Calling the object transforms one
+    value, many() transforms a list of them, vectorized if numpy is available. Entries that
+    are None stay None.
+    """
+
+    def __call__(self, value):
+        raise NotImplementedError()
+
+    def many(self, values):
+        idx = [i for i, v in enumerate(values) if v is not None]
+        ret = [None] * len(values)
+        if not idx:
+            return ret
+        if has_numpy:
+            out = self.array(np.array([values[i] for i in idx], dtype=float)).tolist()
+        else:
+            out = [self(values[i]) for i in idx]
+        for i, v in zip(idx, out):
+            ret[i] = v
+        return ret
+
+    def array(self, x):
+        """
+        The vectorized version, x is a numpy array
+        """
+        return np.array([self(v) for v in x])
+
+
+class Polynomial(Transform):
+    """
+    A polynomial with little-endian coefficients, ie [c, b, a] is a*v**2 + b*v + c,
+    evaluated in Horner form
+    """
+
+    def __init__(self, coefficients):
+        self.coefficients = [float(a) for a in coefficients] or [0.]
+        self.reversed = self.coefficients[::-1]
+        self.is_identity = self.coefficients == [0., 1.]
+
+    def __call__(self, value):
+        if self.is_identity:
+            return value
+        ret = self.reversed[0]
+        for a in self.reversed[1:]:
+            ret = ret * value + a
+        return ret
+
+    def array(self, x):
+        ret = np.full_like(x, self.reversed[0])
+        for a in self.reversed[1:]:
+            ret *= x
+            ret += a
+        return ret
+
+
+class LookupTable(Transform):
+    """
+    Piecewise-linear interpolation in a calibration table. Outside the table the value
+    of the nearest end is used.
+    """
+
+    def __init__(self, x, y):
+        if len(x) != len(y) or len(x) < 2:
+            raise ValueError('A lookup table needs at least two points and as many x as y')
+        pairs = sorted(zip(map(float, x), map(float, y)))
+        self.x = [p[0] for p in pairs]
+        self.y = [p[1] for p in pairs]
+        if has_numpy:
+            self.xa = np.array(self.x)
+            self.ya = np.array(self.y)
+
+    def __call__(self, value):
+        if value <= self.x[0]:
+            return self.y[0]
+        if value >= self.x[-1]:
+            return self.y[-1]
+        i = bisect.bisect_right(self.x, value)
+        x0, x1, y0, y1 = self.x[i - 1], self.x[i], self.y[i - 1], self.y[i]
+        return y0 + (y1 - y0) * (value - x0) / (x1 - x0)
+
+    def array(self, x):
+        return np.interp(x, self.xa, self.ya)
+
+
+class CallendarVanDusen(Transform):
+    """
+    Converts the resistance of a platinum RTD into a temperature in degC using the
+    Callendar-Van Dusen equation, R = R0 (1 + A t + B t**2 + C (t - 100) t**3) with C = 0
+    above 0 degC. The default coefficients are those of IEC 60751.
+    """
+
+    def __init__(self, r0=100., a=3.9083e-3, b=-5.775e-7, c=-4.183e-12, iterations=4):
+        """
+        :param r0: resistance at 0 degC. Default 100 (PT100)
+        :param a, b, c: the coefficients
+        :param iterations: Newton steps below 0 degC, where there's no closed form. Default 4
+        """
+        self.r0 = float(r0)
+        self.a = float(a)
+        self.b = float(b)
+        self.c = float(c)
+        self.iterations = iterations
+
+    def __call__(self, value):
+        ratio = value / self.r0
+        # the closed form without C, exact above 0 and the starting point below
+        t = (-self.a + math.sqrt(self.a ** 2 - 4 * self.b * (1 - ratio))) / (2 * self.b)
+        if t < 0:
+            for _ in range(self.iterations):
+                f = 1 + t * (self.a + t * (self.b + self.c * (t - 100) * t)) - ratio
+                df = self.a + t * (2 * self.b + self.c * t * (4 * t - 300))
+                t -= f / df
+        return t
+
+    def array(self, x):
+        ratio = x / self.r0
+        t = (-self.a + np.sqrt(self.a ** 2 - 4 * self.b * (1 - ratio))) / (2 * self.b)
+        if (cold := t < 0).any():
+            tc, rc = t[cold], ratio[cold]
+            for _ in range(self.iterations):
+                f = 1 + tc * (self.a + tc * (self.b + self.c * (tc - 100) * tc)) - rc
+                df = self.a + tc * (2 * self.b + self.c * tc * (4 * tc - 300))
+                tc -= f / df
+            t[cold] = tc
+        return t
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def get_transform(config):
+    """
+    Turns a value_xform (or a PolynomialNode's transform) into a Transform. A list is a
+    polynomial, for the other types it's a dict:
+    {'type': 'table', 'x': [...], 'y': [...]}, or
+    {'type': 'cvd', 'r0': 100, 'a': ..., 'b': ..., 'c': ...} (all but type optional).
+    The Transforms are cached, so this only compiles anything when the config changes.
+
+    :param config: the config
+    :returns: a Transform
+    """
+    key = json.dumps(config, sort_keys=True)
+    if (ret := _cache.get(key)) is not None:
+        return ret
+    if isinstance(config, (list, tuple)):
+        ret = Polynomial(config)
+    elif config.get('type') == 'table':
+        ret = LookupTable(config['x'], config['y'])
+    elif config.get('type') == 'cvd':
+        ret = CallendarVanDusen(**{k: v for k, v in config.items() if k != 'type'})
+    else:
+        raise ValueError(f'Unknown transform {config}')
+    with _cache_lock:
+        _cache[key] = ret
+    return ret
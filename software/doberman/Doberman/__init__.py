@@ -6,7 +6,10 @@ from . import utils
 
 from .BaseMonitor import *
 from .BaseDevice import *
+from .LineProtocol import *
+from .Historian import *
 from .Database import *
+from .Transform import *
 from .DeviceMonitor import *
 from .PipelineMonitor import *
 from .AlarmMonitor import *
@@ -16,4 +19,6 @@ from .AlarmNode import *
 from .ControlNode import *
 from .Pipeline import *
 from .hypervisor import *
+from .LogIndex import *
+from .LogAnalyzer import *
 
@@ -6,6 +6,9 @@ import threading
 import json
 import datetime
 import zmq
+import itertools
+import math
+import collections
 from heapq import heappush, heappop
 
 dtnow = Doberman.utils.dtnow
@@ -45,14 +48,21 @@ class Hypervisor(Doberman.Monitor):
             self.last_pong[f'pl_{thing}'] = time.time()
             time.sleep(0.1)
         # now start the rest of the things
-        self.known_devices = self.db.distinct('devices', 'name')
+        self.known_devices = []
+        self._known_devices_time = 0
+        self.get_known_devices(refresh=True)
         self.cv = threading.Condition()
+        ack_cfg = self.config.get('command_ack', {})
+        self.acks = AckTracker(timeout=ack_cfg.get('timeout', 5), retries=ack_cfg.get('retries', 0),
+                               targets=ack_cfg.get('targets', {}))
         self.dispatcher = threading.Thread(target=self.dispatch)
         self.dispatcher.start()  # TODO get this registered somehow
         self.broker_context = zmq.Context.instance()
         self.broker = threading.Thread(target=self.data_broker, args=(self.broker_context,))
         self.broker.start()
         self.register(obj=self.compress_logs, period=86400, name='log_compactor', _no_stop=True)
+        self.register(obj=self.report_ack_latency, period=ack_cfg.get('report_period', 3600), name='ack_latency',
+                      _no_stop=True)
         rhbs = self.config.get('remote_heartbeat', [])
         print(rhbs)
         for rhb in rhbs:
@@ -63,14 +73,17 @@ class Hypervisor(Doberman.Monitor):
         self.db.delete_documents('sensors', {'name': {'$regex': '^X_SYNC'}})
         periods = self.config.get('sync_periods', [5, 10, 15, 30, 60])
         for i in periods:
-            if self.db.get_sensor_setting(name=f'X_SYNC_{i}') is None:
+            if self.db.get_sensor_setting(name=f'X_SYNC_{i:g}') is None:
                 self.db.insert_into_db('sensors',
-                                       {'name': f'X_SYNC_{i}', 'description': 'Sync signal', 'readout_interval': i,
+                                       {'name': f'X_SYNC_{i:g}', 'description': 'Sync signal', 'readout_interval': i,
                                         'status': 'offline', 'topic': 'other',
                                         'subsystem': 'sync', 'pipelines': [], 'device': 'hypervisor', 'units': '',
                                         'readout_command': ''})
+        self.sync_jitter = collections.deque(maxlen=100000)
         self.sync = threading.Thread(target=self.sync_signals, args=(periods,))
         self.sync.start()
+        self.register(obj=self.report_sync_jitter, period=self.config.get('sync_jitter_report', 60),
+                      name='sync_jitter', _no_stop=True)
 
         time.sleep(1)
         self.register(obj=self.hypervise, period=self.config['period'], name='hypervise', _no_stop=True)
@@ -91,18 +104,54 @@ class Hypervisor(Doberman.Monitor):
         self.sync.join(timeout=5)
 
     def sync_signals(self, periods: list) -> None:
+        """
+        Sends the X_SYNC_<period> signals. Ticks are phase-locked to integer multiples of
+        each period and scheduled on the monotonic clock, so they don't accumulate drift and
+        don't care about the wall clock getting adjusted. Periods can be fractions of a second.
+        How late each tick went out is queued in sync_jitter, and report_sync_jitter writes it
+        to Influx from the scheduler, so the network never delays a tick.
+        :param periods: list of periods in seconds
+        """
         ctx = zmq.Context.instance()
         socket = ctx.socket(zmq.PUB)
         host, ports = self.db.get_comms_info('data')
         socket.connect(f'tcp://{host}:{ports["send"]}')
-        now = time.time()
-        q = [(now + p, p) for p in sorted(periods)]
+        wall, mono = time.time(), time.monotonic()
+        # (monotonic deadline, tick number, period), where the tick's nominal unix time is number * period
+        q = []
+        for p in sorted(set(periods)):
+            k = math.floor(wall / p) + 1
+            heappush(q, (mono + k * p - wall, k, p))
         while not self.event.is_set():
-            self.event.wait(q[0][0] - time.time())
-            _, p = heappop(q)
-            now = time.time()
-            socket.send_string(f'X_SYNC_{p} {now:.3f} 0')
-            heappush(q, (now + p, p))
+            deadline, k, p = q[0]
+            if (dt := deadline - time.monotonic()) > 0:
+                self.event.wait(dt)
+                continue
+            heappop(q)
+            late = time.monotonic() - deadline
+            socket.send_string(f'X_SYNC_{p:g} {k * p:.3f} 0')
+            self.sync_jitter.append((p, late))
+            # if we fell more than a period behind, skip the missed ticks rather than bursting them out
+            skip = math.floor(late / p) + 1
+            if skip > 1:
+                self.logger.warning(f'X_SYNC_{p:g} fell {late:.3f} s behind, skipping {skip - 1} ticks')
+            heappush(q, (deadline + skip * p, k + skip, p))
+
+    def report_sync_jitter(self) -> None:
+        """
+        Writes the mean and max jitter (in ms) of each sync signal since the last report to Influx
+        """
+        jitter = collections.defaultdict(list)
+        while self.sync_jitter:
+            p, late = self.sync_jitter.popleft()
+            jitter[p].append(late)
+        for p, values in jitter.items():
+            tags = {'subsystem': 'sync', 'device': 'hypervisor', 'sensor': f'X_SYNC_{p:g}'}
+            fields = {'jitter_mean': 1000 * sum(values) / len(values), 'jitter_max': 1000 * max(values)}
+            try:
+                self.db.write_to_influx(topic='other', tags=tags, fields=fields)
+            except Exception as e:
+                self.logger.debug(f'Couldn\'t write sync jitter: {type(e)}: {e}')
 
     def update_config(self, unmanage=None, manage=None, activate=None, deactivate=None, heartbeat=None,
                       status=None) -> None:
@@ -122,37 +171,62 @@ class Hypervisor(Doberman.Monitor):
         if updates:
             self.db.update_db('experiment_config', {'name': 'hypervisor'}, updates)
 
+    def get_known_devices(self, refresh=False) -> list:
+        """
+        The names of all devices in the database. This is cached, and only re-read if asked
+        or if the cache is older than `known_devices_ttl` seconds (default 300)
+        :param refresh: bool, force a re-read. Default False
+        :returns: list of device names
+        """
+        if refresh or time.time() - self._known_devices_time > self.config.get('known_devices_ttl', 300):
+            self.known_devices = self.db.distinct('devices', 'name')
+            self._known_devices_time = time.time()
+        return self.known_devices
+
+    def is_known_device(self, name: str) -> bool:
+        """
+        Checks if a device exists. A miss invalidates the cache once, in case the device is new
+        """
+        if name in self.get_known_devices():
+            return True
+        return name in self.get_known_devices(refresh=True)
+
     def hypervise(self) -> None:
         while not self.event.is_set():
             self.logger.debug('Hypervising')
             self.config = self.db.get_experiment_config('hypervisor')
             managed = self.config['processes']['managed']
             active = self.config['processes']['active']
-            self.known_devices = self.db.distinct('devices', 'name')
+            self.get_known_devices()
             path = self.config['path']
             for pl in 'alarm control convert'.split():
                 if time.time() - self.last_pong.get(f'pl_{pl}', 100) > 30:
                     self.logger.warning(f'Failed to ping pl_{pl}, restarting it')
                     self.run_locally(f'cd {path} && ./start_process.sh --{pl}{self.debug_flag}')
+            # one query for everything rather than one per device
+            heartbeats = self.db.get_heartbeats(managed)
+            now = dtnow()
             for device in managed:
+                heartbeat, host = heartbeats.get(device, (None, None))
+                dt = (now - heartbeat).total_seconds() if heartbeat is not None else None
                 if device not in active:
                     # device isn't running and it's supposed to be
                     self.logger.info(f'{device} is managed but not active. I will start it.')
-                    if self.start_device(device):
+                    if self.start_device(device, host=host):
                         # nonzero return code, probably something didn't work
                         self.logger.error(f'Problem starting {device}, check the logs')
-                elif (dt := (dtnow() - self.db.get_heartbeat(device=device)).total_seconds()) > 2 * \
-                        self.config['period']:
+                elif dt is None or dt > 2 * self.config['period']:
                     # device claims to be active but hasn't heartbeated recently
-                    self.logger.error(f'{device} had no heartbeat for {int(dt)} seconds, it\'s getting restarted')
-                    if self.start_device(device):
+                    since = 'ever' if dt is None else f'{int(dt)} seconds'
+                    self.logger.error(f'{device} had no heartbeat for {since}, it\'s getting restarted')
+                    if self.start_device(device, host=host):
                         # nonzero return code, probably something didn't work
                         self.logger.error(f'Problem starting {device}, check the logs')
                     else:
                         self.logger.info(f'{device} restarted')
                 elif time.time() - self.last_pong.get(device, 100) > 30:
                     self.logger.error(f'Failed to ping {device}, restarting it')
-                    self.start_device(device)
+                    self.start_device(device, host=host)
                 else:
                     # claims to be active and has heartbeated recently
                     self.logger.debug(f'{device} last heartbeat {int(dt)} seconds ago')
@@ -213,11 +287,11 @@ class Hypervisor(Doberman.Monitor):
         time.sleep(1)
         return cp.returncode
 
-    def start_device(self, device: str) -> int:
+    def start_device(self, device: str, host=None) -> int:
         print("hypervisor.start_device()")
         path = self.config['path']
-        doc = self.db.get_device_setting(device)
-        host = doc['host']
+        if host is None:
+            host = self.db.get_device_setting(device, field='host')
         self.update_config(manage=device)
         command = f"cd {path} && ./start_process.sh -d {device}{self.debug_flag}"
         if host == self.localhost:
@@ -236,8 +310,25 @@ class Hypervisor(Doberman.Monitor):
     def compress_logs(self) -> None:
         then = dtnow() - datetime.timedelta(days=7)
         self.logger.info(f'Compressing logs from {then.year}-{then.month:02d}-{then.day:02d}')
-        p = self.logger.handlers[0].oh.get_logdir(dtnow() - datetime.timedelta(days=7))
-        self.run_locally(f'cd {p} && gzip --best *.log')
+        oh = self.logger.handlers[0].oh
+        p = oh.get_logdir(then)
+        # the log writers compress their own files when they rotate, this catches whatever
+        # was left behind by processes that didn't shut down cleanly
+        if os.path.isdir(p):
+            for fn in os.listdir(p):
+                if fn.endswith('.log'):
+                    try:
+                        Doberman.utils.compress_log(os.path.join(p, fn), oh.rotation_config('level', 9))
+                    except Exception as e:
+                        self.logger.error(f'Couldn\'t compress {fn}: {type(e)}: {e}')
+        # (re)index the week up to yesterday, which covers the day we just compressed and
+        # anything written late. Days that haven't changed only cost a stat per file, and the
+        # older ones aren't touched: a pass over the whole archive takes minutes and would hold
+        # up the other scheduled work. Searches scan whatever isn't indexed or changed since
+        try:
+            Doberman.LogIndex(os.path.dirname(os.path.dirname(p))).update(since=then.date())
+        except Exception as e:
+            self.logger.error(f'Couldn\'t index the logs: {type(e)}: {e}')
 
     def data_broker(self, ctx) -> None:
         """
@@ -277,10 +368,10 @@ class Hypervisor(Doberman.Monitor):
 
             last_ping = time.time()
             queue = []
-            cmd_ack = {}
+            acks = self.acks
 
             while not self.event.is_set():
-                timeout_ms = self.calculate_timeout_ms(queue, last_ping, ping_period)
+                timeout_ms = self.calculate_timeout_ms(queue, last_ping, ping_period, acks)
                 socks = dict(poller.poll(timeout=int(timeout_ms)))
 
                 if (now := time.time()) - last_ping > ping_period or not len(socks):
@@ -288,19 +379,22 @@ class Hypervisor(Doberman.Monitor):
                     last_ping = now
 
                 if socks.get(incoming) == zmq.POLLIN:
-                    self.handle_incoming_message(incoming, queue, cmd_ack, now)
+                    self.handle_incoming_message(incoming, queue, acks, now)
 
                 if self.is_time_for_next_command(queue, now):
-                    self.process_next_command(queue, outgoing, cmd_ack, now)
+                    self.process_next_command(queue, outgoing, acks, now)
 
-                self.remove_stale_acknowledgements(cmd_ack)
+                self.remove_stale_acknowledgements(acks, outgoing)
 
-    def calculate_timeout_ms(self, queue, last_ping, ping_period):
+    def calculate_timeout_ms(self, queue, last_ping, ping_period, acks=None):
         next_ping = last_ping + ping_period - time.time()
         next_command = queue[0][0] - time.time() if queue else ping_period
-        return min(next_ping, next_command) * 1000
+        next_deadline = acks.time_to_next_deadline() if acks is not None else None
+        if next_deadline is None:
+            next_deadline = ping_period
+        return max(min(next_ping, next_command, next_deadline), 0) * 1000
 
-    def handle_incoming_message(self, incoming, queue, cmd_ack, now):
+    def handle_incoming_message(self, incoming, queue, acks, now):
         msg = incoming.recv_string()
         incoming.send_string("")  # Must reply
 
@@ -310,7 +404,7 @@ class Hypervisor(Doberman.Monitor):
         elif msg.startswith('{'):
             self.process_external_command(msg, queue)
         elif msg.startswith('ack'):
-            self.process_acknowledgement(msg, cmd_ack)
+            self.process_acknowledgement(msg, acks)
         else:
             self.process_command(msg)
 
@@ -321,49 +415,55 @@ class Hypervisor(Doberman.Monitor):
         except Exception as e:
             self.logger.error(f'Error processing "{msg}": {e}')
 
-    def process_acknowledgement(self, msg, cmd_ack):
+    def process_acknowledgement(self, msg, acks):
         try:
-            _, name, cmd_hash = msg.split(' ')
-            del cmd_ack[cmd_hash]
-        except KeyError:
-            self.logger.error(f'Unknown hash: {msg}')
+            _, name, cmd_id = msg.split(' ')
+            if not acks.ack(cmd_id):
+                self.logger.error(f'Unknown command id: {msg}')
         except Exception as e:
             self.logger.error(f'Error processing "{msg}": {e}')
 
     def is_time_for_next_command(self, queue, now):
         return len(queue) > 0 and queue[0][0] - now < 0.001
 
-    def process_next_command(self, queue, outgoing, cmd_ack, now):
+    def process_next_command(self, queue, outgoing, acks, now):
         _, to, cmd = heappop(queue)
         if to == 'hypervisor':
             self.process_command(cmd)
         else:
-            cmd_hash = Doberman.utils.make_hash(now, to, cmd, hash_length=6)
-            outgoing.send_string(f'{to} {cmd_hash} {cmd}')
-            cmd_ack[cmd_hash] = (to, dtnow())
-
-    def remove_stale_acknowledgements(self, cmd_ack):
-        keys_to_pop = []
-        for key, (name, timestamp) in cmd_ack.items():
-            if (dtnow() - timestamp).total_seconds() > 5:
-                self.logger.error(f"Command to {name} hasn't been ack'd in over 5 seconds")
-                keys_to_pop.append(key)
-        for key in keys_to_pop:
-            cmd_ack.pop(key, None)
+            cmd_id = acks.add(to, cmd)
+            outgoing.send_string(f'{to} {cmd_id} {cmd}')
+
+    def remove_stale_acknowledgements(self, acks, outgoing=None):
+        for cmd_id, to, cmd, attempt, retry in acks.expired():
+            if retry and outgoing is not None:
+                self.logger.warning(f"Command to {to} hasn't been ack'd, resending (attempt {attempt + 1})")
+                outgoing.send_string(f'{to} {cmd_id} {cmd}')
+            else:
+                self.logger.error(f"Command to {to} hasn't been ack'd after {attempt} "
+                                  f"attempt{'s' if attempt > 1 else ''}")
+
+    def report_ack_latency(self) -> None:
+        """
+        Logs the command acknowledgement latency percentiles for each target
+        """
+        for to, (n, p50, p90, p99) in self.acks.latency_summary().items():
+            self.logger.info(f'Ack latency for {to} over {n} commands: p50 {p50*1000:.1f} ms, '
+                             f'p90 {p90*1000:.1f} ms, p99 {p99*1000:.1f} ms')
 
     def process_command(self, command: str) -> None:
         self.logger.info(f'Processing {command}')
         if command.startswith('start'):
             _, target = command.split(' ', maxsplit=1)
             self.logger.info(f'Hypervisor starting {target}')
-            if target in self.known_devices:
+            if self.is_known_device(target):
                 self.start_device(target)
             else:
                 self.logger.error(f'Don\'t know what "{target}" is, can\'t start it')
 
         elif command.startswith('manage'):
             _, device = command.split(' ', maxsplit=1)
-            if device not in self.known_devices:
+            if not self.is_known_device(device):
                 # unlikely but you can never trust users
                 self.logger.error(f'Hypervisor can\'t manage {device}')
                 return
@@ -372,7 +472,7 @@ class Hypervisor(Doberman.Monitor):
 
         elif command.startswith('unmanage'):
             _, device = command.split(' ', maxsplit=1)
-            if device not in self.known_devices:
+            if not self.is_known_device(device):
                 # unlikely but you can never trust users
                 self.logger.error(f'Hypervisor can\'t unmanage {device}')
                 return
@@ -382,7 +482,7 @@ class Hypervisor(Doberman.Monitor):
         elif command.startswith('kill'):
             # I'm sure this will be useful at some point
             _, thing = command.split(' ', maxsplit=1)
-            if thing in self.known_devices:
+            if self.is_known_device(thing):
                 host = self.db.get_device_setting(thing, field='host')
                 self.run_over_ssh(host, f"screen -S {thing} -X quit")
             else:
@@ -391,3 +491,108 @@ class Hypervisor(Doberman.Monitor):
 
         else:
             self.logger.error(f'Command "{command}" not understood')
+
+
+class AckTracker(object):
+    """
+    Keeps track of the commands the dispatcher is waiting to have acknowledged.
+    Deadlines live in a heap on the monotonic clock, so checking for expired commands
+    only looks at the front of the heap. Acknowledged commands are dropped from the heap
+    lazily when they reach the front. The latencies are read from other threads, so they
+    are only touched under the lock.
+    """
+
+    def __init__(self, timeout=5, retries=0, targets=None, history=200):
+        """
+        :param timeout: seconds to wait for an ack before giving up or retrying. Default 5
+        :param retries: how many times to resend an unacknowledged command. Default 0
+        :param targets: dict of per-target overrides, {name: {'timeout': float, 'retries': int}}
+        :param history: how many latencies to keep per target for the percentiles. Default 200
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.targets = targets or {}
+        self._counter = itertools.count()
+        self._heap = []  # (deadline, cmd_id)
+        self._pending = {}  # cmd_id: [to, cmd, first sent, deadline, attempts]
+        self.latency = collections.defaultdict(lambda: collections.deque(maxlen=history))
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def get_setting(self, to, name):
+        return self.targets.get(to, {}).get(name, getattr(self, name))
+
+    def add(self, to, cmd):
+        """
+        Starts tracking a command
+        :param to: the name of the target
+        :param cmd: the command
+        :returns: the id to send along with the command
+        """
+        cmd_id = f'{next(self._counter):x}'
+        now = time.monotonic()
+        deadline = now + self.get_setting(to, 'timeout')
+        self._pending[cmd_id] = [to, cmd, now, deadline, 1]
+        heappush(self._heap, (deadline, cmd_id))
+        return cmd_id
+
+    def ack(self, cmd_id):
+        """
+        Marks a command as acknowledged
+        :returns: True if the command was known, False otherwise
+        """
+        if (entry := self._pending.pop(cmd_id, None)) is None:
+            return False
+        with self.lock:
+            self.latency[entry[0]].append(time.monotonic() - entry[2])
+        return True
+
+    def time_to_next_deadline(self):
+        """
+        Seconds until the earliest outstanding deadline, or None if nothing is outstanding
+        """
+        while self._heap and self._heap[0][1] not in self._pending:
+            heappop(self._heap)
+        if not self._heap:
+            return None
+        return self._heap[0][0] - time.monotonic()
+
+    def expired(self):
+        """
+        Generates the commands whose deadline has passed. Commands with retries
+        left are re-armed, the rest are forgotten.
+        :yields: (cmd_id, to, cmd, attempts so far, bool should this be resent)
+        """
+        now = time.monotonic()
+        while self._heap and self._heap[0][0] <= now:
+            deadline, cmd_id = heappop(self._heap)
+            if (entry := self._pending.get(cmd_id)) is None or entry[3] != deadline:
+                # already ack'd, or superseded by a retry
+                continue
+            to, cmd, _, _, attempts = entry
+            if attempts <= self.get_setting(to, 'retries'):
+                entry[3] = now + self.get_setting(to, 'timeout')
+                entry[4] += 1
+                heappush(self._heap, (entry[3], cmd_id))
+                yield cmd_id, to, cmd, attempts, True
+            else:
+                del self._pending[cmd_id]
+                yield cmd_id, to, cmd, attempts, False
+
+    def latency_summary(self):
+        """
+        Ack latency percentiles for each target
+        :returns: dict, keys = target names, values = (count, p50, p90, p99) in seconds
+        """
+        with self.lock:
+            latency = {to: list(values) for to, values in self.latency.items()}
+        ret = {}
+        for to, values in latency.items():
+            values = sorted(values)
+            if not values:
+                continue
+            n = len(values)
+            ret[to] = (n, *[values[min(n - 1, int(q * n))] for q in (0.5, 0.9, 0.99)])
+        return ret
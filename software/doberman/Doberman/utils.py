@@ -8,9 +8,23 @@ import logging
 import logging.handlers
 from pytz import utc
 import threading
+import queue
+import atexit
+import time
 import hashlib
+import gzip
+import shutil
 from math import floor, log10
 import itertools
+import re
+import weakref
+import struct
+import json
+try:
+    import msgpack
+    has_msgpack = True
+except ImportError:
+    has_msgpack = False
 
 number_regex = r'[\-+]?[0-9]+(?:\.[0-9]+)?(?:[eE][\-+]?[0-9]+)?'
 
@@ -76,8 +90,12 @@ class SignalHandler(object):
 
 class DobermanLogger(logging.Handler):
     """
-    A custom logging handler.
+    A custom logging handler. emit() runs on whatever thread did the logging, so
+    it only resolves the message and hands the record to the OutputHandler's queue.
+    Formatting, file/stdout output, and database inserts happen on the writer thread.
+    Tracebacks are written on the lines after the message.
     """
+    exc_formatter = logging.Formatter()
 
     def __init__(self, db, name, output_handler):
         logging.Handler.__init__(self)
@@ -85,27 +103,357 @@ class DobermanLogger(logging.Handler):
         self.name = name
         self.collection_name = 'logs'
         self.oh = output_handler
+        cfg = output_handler.config.get('suppression', {})
+        window = cfg.get(name, cfg.get('default', {})).get('window', 60)
+        self.suppressor = LogSuppressor(window) if window > 0 else None
+        output_handler.handlers.add(self)
 
     def emit(self, record):
+        # resolve the message now, the arguments might change before the writer gets to it
+        record.message = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.exc_formatter.formatException(record.exc_info)
+        record.exc_info = None
+        if self.suppressor is not None:
+            send, summary = self.suppressor.check(record)
+            if summary is not None:
+                self.oh.submit(self, summary)
+            if not send:
+                return
+        self.oh.submit(self, record)
+
+    def sweep(self):
+        """
+        Called by the writer thread. Sends the summaries of repeats that have gone quiet
+        """
+        if self.suppressor is None:
+            return
+        self.acquire()
+        try:
+            summaries = self.suppressor.sweep()
+        finally:
+            self.release()
+        for summary in summaries:
+            self.oh.submit(self, summary)
+
+    def process_record(self, record):
+        """
+        Called by the writer thread. Turns a record into the line for the file and
+        (for WARNING and above) the document for the database
+        :returns: (message, date, document or None)
+        """
         msg_datetime = datetime.datetime.fromtimestamp(record.created)
         msg_date = datetime.date(msg_datetime.year, msg_datetime.month, msg_datetime.day)
-        m = self.format_message(msg_datetime, record.levelname, record.funcName, record.lineno, record.getMessage())
-        self.oh.write(m, msg_date)
+        msg = record.message
+        if record.exc_text:
+            msg += '\n' + record.exc_text
+        m = self.format_message(msg_datetime, record.levelname, record.funcName, record.lineno, msg)
+        rec = None
         if record.levelno > logging.INFO:
             rec = dict(
-                msg=record.getMessage(),
+                msg=record.message,
                 level=record.levelno,
                 name=record.name,
                 funcname=record.funcName,
                 lineno=record.lineno,
                 date=msg_datetime,
             )
-            self.db.insert_into_db(self.collection_name, rec)
+        return m, msg_date, rec
 
     def format_message(self, when, level, func_name, lineno, msg):
         return f'{when.isoformat(sep=" ")} | {str(level).upper()} | {self.name} | {func_name} | {lineno} | {msg}'
 
 
+class LogSuppressor(object):
+    """
+    Collapses repeated messages. The first record with a given level and message
+    template (the message with the numbers taken out) goes through, and identical ones in
+    the following `window` seconds are counted instead. Once the window is over a single
+    "<message> (repeated N times in S s)" summary is sent. Tools reading the logs should use
+    parse_summary() rather than matching that text themselves.
+    """
+    template_regex = re.compile(number_regex)
+    summary_regex = re.compile(r'^(?P<msg>.*) \(repeated (?P<count>[0-9]+) times? in (?P<seconds>[0-9]+) s\)$',
+                               re.DOTALL)
+
+    def __init__(self, window=60, max_keys=1000):
+        """
+        :param window: seconds over which to collapse repeats. Default 60
+        :param max_keys: the most distinct messages to keep track of. Default 1000
+        """
+        self.window = window
+        self.max_keys = max_keys
+        self.seen = {}  # (level, funcName, template): [window start, repeats, last record]
+
+    def summarize(self, start, count, record):
+        summary = logging.makeLogRecord(record.__dict__)
+        # the first one went out with its traceback, and the summary has to stay one line for parse_summary
+        summary.exc_text = None
+        summary.message = f'{record.message} (repeated {count} time{"s" if count > 1 else ""} ' \
+                          f'in {int(record.created - start)} s)'
+        return summary
+
+    @classmethod
+    def parse_summary(cls, msg):
+        """
+        Undoes summarize()
+        :param msg: a logged message
+        :returns: (the original message, how many records this stands for, seconds they were spread over)
+        """
+        if (m := cls.summary_regex.match(msg)) is None:
+            return msg, 1, 0
+        return m.group('msg'), int(m.group('count')), int(m.group('seconds'))
+
+    def check(self, record):
+        """
+        :param record: the record, with the message already resolved
+        :returns: (bool, should this record be sent; summary record of expired repeats or None)
+        """
+        key = (record.levelno, record.funcName, self.template_regex.sub('#', record.message))
+        summary = None
+        if (entry := self.seen.get(key)) is not None:
+            start, count, last = entry
+            if record.created - start < self.window:
+                entry[1] += 1
+                entry[2] = record
+                return False, None
+            if count > 0:
+                summary = self.summarize(start, count, last)
+        elif len(self.seen) >= self.max_keys:
+            return True, None
+        self.seen[key] = [record.created, 0, record]
+        return True, summary
+
+    def sweep(self, now=None):
+        """
+        Forgets windows that are over
+        :returns: list of summary records for the ones that had repeats
+        """
+        now = now or time.time()
+        ret = []
+        for key, (start, count, last) in list(self.seen.items()):
+            if now - start >= self.window:
+                if count > 0:
+                    ret.append(self.summarize(start, count, last))
+                del self.seen[key]
+        return ret
+
+
+def compress_log(path, level=9, remove=True):
+    """
+    Gzips a log file in-process. If the .gz already exists the data is appended as another
+    gzip member, which every gzip reader handles transparently.
+    :param path: the file to compress
+    :param level: zlib compression level, 1 (fast) to 9 (best). Default 9
+    :param remove: bool, delete the uncompressed file afterwards. Default True
+    :returns: path of the compressed file
+    """
+    gz_path = path + '.gz'
+    with open(path, 'rb') as fin, open(gz_path, 'ab') as raw:
+        with gzip.GzipFile(filename='', mode='wb', fileobj=raw, compresslevel=level) as fout:
+            shutil.copyfileobj(fin, fout, 1 << 20)
+    if remove:
+        os.remove(path)
+    return gz_path
+
+
+class LogCompressor(threading.Thread):
+    """
+    Compresses closed log files in the background so the log writer never waits for it
+    """
+
+    def __init__(self, level=9):
+        threading.Thread.__init__(self, name='log-compressor', daemon=True)
+        self.level = level
+        self.queue = queue.Queue()
+
+    def submit(self, path):
+        if not self.is_alive():
+            self.start()
+        self.queue.put(path)
+
+    def run(self):
+        while (path := self.queue.get()) is not None:
+            try:
+                compress_log(path, self.level)
+            except Exception as e:
+                print(f'Couldn\'t compress {path}: {type(e)}: {e}')
+
+    def close(self):
+        if self.is_alive():
+            self.queue.put(None)
+            self.join(timeout=60)
+
+
+class BlockGzipWriter(object):
+    """
+    Writes text as a series of independent gzip members ("blocks"), so the file is always
+    compressed and still readable by anything that reads gzip. The uncompressed offset of every
+    block is recorded in <path>.blocks as "compressed_offset uncompressed_offset length" lines,
+    so readers can start decompressing at the block that holds the offset they want.
+    """
+
+    def __init__(self, path, level=6, block_size=1 << 16, max_age=10):
+        """
+        :param path: the .gz file, appended to if it exists
+        :param level: zlib compression level. Default 6
+        :param block_size: uncompressed bytes per block. Default 64 kB
+        :param max_age: flush() writes a partial block if the buffer is older than this many seconds. Default 10
+        """
+        self.path = path
+        self.level = level
+        self.block_size = block_size
+        self.max_age = max_age
+        self.uoffset = 0
+        if os.path.exists(path + '.blocks'):
+            with open(path + '.blocks') as f:
+                for line in f:
+                    _, uoffset, length = map(int, line.split())
+                    self.uoffset = uoffset + length
+        elif os.path.exists(path):
+            with gzip.open(path, 'rb') as f:
+                while chunk := f.read(1 << 20):
+                    self.uoffset += len(chunk)
+        self.f = open(path, 'ab')
+        self.blocks = open(path + '.blocks', 'a')
+        self.buf = []
+        self.buf_len = 0
+        self.buf_since = 0
+
+    def write(self, s):
+        if not self.buf:
+            self.buf_since = time.monotonic()
+        s = s.encode()
+        self.buf.append(s)
+        self.buf_len += len(s)
+        if self.buf_len >= self.block_size:
+            self.write_block()
+
+    def tell(self):
+        return self.uoffset + self.buf_len
+
+    def write_block(self):
+        data = b''.join(self.buf)
+        self.buf = []
+        self.buf_len = 0
+        if not data:
+            return
+        coffset = self.f.tell()
+        self.f.write(gzip.compress(data, compresslevel=self.level, mtime=0))
+        self.f.flush()
+        self.blocks.write(f'{coffset} {self.uoffset} {len(data)}\n')
+        self.blocks.flush()
+        self.uoffset += len(data)
+
+    def flush(self, force=False):
+        """
+        Writes the buffer out if it is old enough (or if forced). Flushing every time would make
+        lots of tiny blocks that don't compress well
+        """
+        if self.buf and (force or time.monotonic() - self.buf_since > self.max_age):
+            self.write_block()
+
+    def close(self):
+        self.write_block()
+        self.f.close()
+        self.blocks.close()
+
+
+class StructuredLogWriter(object):
+    """
+    Writes log records with typed fields rather than as text, so tools can filter by
+    field without parsing. Each record is a 4-byte little-endian length followed by the
+    payload, whose first byte says how the rest is encoded ('m' msgpack, 'j' json). Fields:
+    t (epoch ns), lvl (int), logger, func, line (int), and either tmpl + args (the message
+    with its numbers replaced by '#', and the numbers as strings) or msg if the message has
+    a '#' of its own, and exc with the traceback if there is one. Records are buffered and
+    written in batches.
+    """
+    magic = b'DBLG\x01'
+    number = re.compile(number_regex)
+
+    def __init__(self, path, fmt='msgpack', batch_bytes=1 << 16):
+        """
+        :param path: the file, appended to if it exists
+        :param fmt: 'msgpack' or 'json'. Falls back to json if msgpack isn't installed. Default 'msgpack'
+        :param batch_bytes: write once this many bytes are buffered. Default 64 kB
+        """
+        self.use_msgpack = fmt == 'msgpack' and has_msgpack
+        self.batch_bytes = batch_bytes
+        self.f = open(path, 'ab')
+        if self.f.tell() == 0:
+            self.f.write(self.magic)
+        self.buf = bytearray()
+
+    @classmethod
+    def to_fields(cls, record):
+        doc = {'t': int(record.created * 1e9), 'lvl': record.levelno, 'logger': record.name,
+               'func': record.funcName, 'line': record.lineno}
+        if '#' in record.message:
+            doc['msg'] = record.message
+        else:
+            doc['tmpl'] = cls.number.sub('#', record.message)
+            doc['args'] = cls.number.findall(record.message)
+        if record.exc_text:
+            doc['exc'] = record.exc_text
+        return doc
+
+    def write(self, record):
+        doc = self.to_fields(record)
+        if self.use_msgpack:
+            payload = b'm' + msgpack.packb(doc)
+        else:
+            payload = b'j' + json.dumps(doc, separators=(',', ':')).encode()
+        self.buf += struct.pack('<I', len(payload))
+        self.buf += payload
+        if len(self.buf) >= self.batch_bytes:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            self.f.write(self.buf)
+            self.f.flush()
+            self.buf = bytearray()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+
+def iter_structured(path):
+    """
+    Reads a file written by StructuredLogWriter one record at a time
+    :param path: the file
+    :yields: dict of fields, with 'msg' always filled in
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(StructuredLogWriter.magic)) != StructuredLogWriter.magic:
+            raise ValueError(f'{path} isn\'t a structured log')
+        while len(header := f.read(4)) == 4:
+            payload = f.read(struct.unpack('<I', header)[0])
+            if payload[:1] == b'm':
+                if not has_msgpack:
+                    raise ValueError('This file needs msgpack to be read')
+                doc = msgpack.unpackb(payload[1:])
+            else:
+                doc = json.loads(payload[1:])
+            if 'msg' not in doc:
+                args = iter(doc['args'])
+                doc['msg'] = re.sub('#', lambda _: next(args), doc['tmpl'])
+            yield doc
+
+
+def structured_to_text(doc):
+    """
+    Converts a structured record back into the line DobermanLogger would have written
+    """
+    when = datetime.datetime.fromtimestamp(doc['t'] / 1e9)
+    level = logging.getLevelName(doc['lvl'])
+    msg = doc['msg'] + ('\n' + doc['exc'] if doc.get('exc') else '')
+    return f'{when.isoformat(sep=" ")} | {level} | {doc["logger"]} | {doc["func"]} | {doc["line"]} | {msg}'
+
+
 class OutputHandler(object):
     """
     We need a single object that owns the file we log to,
@@ -113,51 +461,236 @@ class OutputHandler(object):
     I don't know how to do c++-style static class members,
     so this is how I solve this problem.
     Files go to /global/logs/<experiment>/YYYY/MM.DD, folders being created as necessary.
+    Records come in through a bounded queue and are written out by one background thread,
+    which also batches the database inserts. If the queue is full records are dropped and counted,
+    and the next line written says how many.
+    Files are rotated at midnight and (optionally) once they get bigger than `max_bytes`,
+    and the closed files get compressed in the background. The 'rotation' section of the
+    logging config controls this:
+    {'max_bytes': 0 (no size limit), 'compress': True, 'level': 9, 'block_gzip': False, 'block_size': 65536}
+    With block_gzip the log is written straight into a BlockGzipWriter as <name>.log.gz.
+    Size-rotated files are called <name>.<n>.log(.gz).
+    The 'structured' section turns on a StructuredLogWriter next to the text file:
+    {'enabled': False, 'format': 'msgpack', 'batch_bytes': 65536}, written to <name>.dblog
     """
-    __slots__ = ('mutex', 'filename', 'experiment', 'f', 'today', 'flush_cycle', 'debug')
+    __slots__ = ('mutex', 'filename', 'experiment', 'f', 'today', 'debug', 'db', 'queue',
+                 'writer', 'stdout', 'dropped', 'dropped_reported', 'drop_lock', 'db_batch_size', 'db_flush_interval',
+                 'config', 'handlers', 'next_sweep', 'path', 'size', 'compressor', 'sink')
 
-    def __init__(self, name, experiment, debug=False):
+    def __init__(self, name, experiment, debug=False, db=None, stdout=True, queue_size=10000,
+                 db_batch_size=50, db_flush_interval=1.0, config=None):
+        """
+        :param name: the name of the log file (without .log)
+        :param experiment: the experiment name
+        :param debug: bool, are DEBUG messages wanted. Default False
+        :param db: the Database to insert WARNING+ records into. Default None (no inserts)
+        :param stdout: bool, should messages also be printed. Default True
+        :param queue_size: how many records can wait for the writer. Default 10000
+        :param db_batch_size: insert into the database once this many records are waiting. Default 50
+        :param db_flush_interval: or once the oldest has waited this many seconds. Default 1
+        :param config: dict, the 'logging' experiment config. Default None
+        """
         self.mutex = threading.Lock()
         self.filename = f'{name}.log'
         self.experiment = experiment
         self.f = None
-        self.flush_cycle = 0
-        self.rotate()
+        self.sink = None
+        self.path = None
+        self.size = 0
         self.debug = debug
+        self.db = db
+        self.stdout = stdout
+        self.dropped = 0
+        self.dropped_reported = 0
+        self.drop_lock = threading.Lock()
+        self.db_batch_size = db_batch_size
+        self.db_flush_interval = db_flush_interval
+        self.config = config or {}
+        self.compressor = LogCompressor(self.rotation_config('level', 9))
+        self.rotate()
+        self.handlers = weakref.WeakSet()
+        self.next_sweep = 0
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.writer = threading.Thread(target=self.run, name=f'{name}-log-writer', daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
 
-    def rotate(self):
+    def rotation_config(self, key, default):
+        return self.config.get('rotation', {}).get(key, default)
+
+    def rotate(self, by_size=False):
+        """
+        Closes the current file (if any) and opens the next one
+        :param by_size: bool, is this because the file is too big (rather than a new day). Default False
+        """
+        block_gzip = self.rotation_config('block_gzip', False)
         if self.f is not None:
+            if not by_size and datetime.date.today() <= self.today:
+                # still the same day, so the current file stays open (and away from the compressor)
+                return
             self.f.close()
+            closed = self.path
+            if by_size:
+                # move it out of the way as <name>.<n>.log(.gz)
+                logdir, fn = os.path.split(closed)
+                stem, ext = os.path.splitext(fn) if fn.endswith('.gz') else (fn, '')
+                base = os.path.join(logdir, os.path.splitext(stem)[0])
+                n = 1
+                while os.path.exists(f'{base}.{n}.log{ext}') or os.path.exists(f'{base}.{n}.log{ext}.gz'):
+                    n += 1
+                closed = f'{base}.{n}.log{ext}'
+                os.rename(self.path, closed)
+                if os.path.exists(self.path + '.blocks'):
+                    os.rename(self.path + '.blocks', closed + '.blocks')
+            if not closed.endswith('.gz') and self.rotation_config('compress', True):
+                self.compressor.submit(closed)
         self.today = datetime.date.today()
-        logdir = f'/global/logs/{self.experiment}/{self.today.year}/{self.today.month:02d}.{self.today.day:02d}'
+        logdir = self.get_logdir(self.today)
         os.makedirs(logdir, exist_ok=True)
-        full_path = os.path.join(logdir, self.filename)
-        self.f = open(full_path, 'a')
+        self.path = os.path.join(logdir, self.filename)
+        if block_gzip:
+            self.path += '.gz'
+            self.f = BlockGzipWriter(self.path, level=self.rotation_config('level', 6),
+                                     block_size=self.rotation_config('block_size', 1 << 16))
+        else:
+            self.f = open(self.path, 'a', encoding='utf-8')
+        self.size = self.f.tell()
+        structured = self.config.get('structured', {})
+        if structured.get('enabled', False) and (self.sink is None or not by_size):
+            if self.sink is not None:
+                self.sink.close()
+            self.sink = StructuredLogWriter(os.path.join(logdir, self.filename[:-4] + '.dblog'),
+                                            fmt=structured.get('format', 'msgpack'),
+                                            batch_bytes=structured.get('batch_bytes', 1 << 16))
+
+    def submit(self, handler, record):
+        """
+        Queues one record for the writer thread. Never blocks.
+        """
+        try:
+            self.queue.put_nowait((handler, record))
+        except queue.Full:
+            with self.drop_lock:
+                self.dropped += 1
 
-    def write(self, message, date):
+    def run(self):
+        """
+        The writer thread. Returns when it gets None from the queue
+        """
+        batch = []
+        oldest = 0
+        while True:
+            timeout = max(0., self.next_sweep - time.monotonic())
+            if batch:
+                timeout = min(timeout, max(0., oldest + self.db_flush_interval - time.monotonic()))
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+            if item is None:
+                break
+            if item:
+                handler, record = item
+                try:
+                    message, date, doc = handler.process_record(record)
+                    self.write(message, date, record)
+                except Exception as e:
+                    print(f'Log writer caught a {type(e)}: {e}')
+                    doc = None
+                if doc is not None and self.db is not None:
+                    if not batch:
+                        oldest = time.monotonic()
+                    batch.append(doc)
+            if time.monotonic() > self.next_sweep:
+                self.next_sweep = time.monotonic() + 1
+                for handler in list(self.handlers):
+                    handler.sweep()
+            if batch and (len(batch) >= self.db_batch_size or time.monotonic() - oldest > self.db_flush_interval):
+                self.insert_batch(batch)
+                batch = []
+            if self.queue.empty():
+                self.flush()
+        if batch:
+            self.insert_batch(batch)
+        self.flush()
+
+    def flush(self):
+        with self.mutex:
+            if self.f is not None:
+                self.f.flush()
+            if self.sink is not None:
+                self.sink.flush()
+
+    def insert_batch(self, batch):
+        try:
+            self.db.insert_into_db('logs', batch, ordered=False)
+        except Exception as e:
+            # we can't log this, that would end up back in this queue
+            print(f'Couldn\'t insert {len(batch)} log records: {type(e)}: {e}')
+
+    def close(self):
+        """
+        Drains the queue and stops the writer thread
+        """
+        if self.writer.is_alive():
+            for handler in list(self.handlers):
+                handler.sweep()
+            self.queue.put(None)
+            self.writer.join(timeout=10)
+        with self.mutex:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+            if self.sink is not None:
+                self.sink.close()
+                self.sink = None
+        self.compressor.close()
+
+    def write(self, message, date, record=None):
         with self.mutex:
             # we wrap anything hitting files or stdout with a mutex because logging happens from
             # multiple threads, and files aren't thread-safe
-            if date != self.today:
+            if date > self.today:
                 # it's a brand-new day, and the sun is high...
+                # (records from yesterday that show up late just go into today's file)
                 self.rotate()
             if message[-1] == '\n':
                 message = message[:-1]
-            print(message)
-            self.f.write(f'{message}\n')
-            self.flush_cycle += 1
-            if self.flush_cycle > 3:
-                # if we don't regularly flush the buffers, messages will sit around in memory rather than actually
-                # get pushed to disk, and we don't want this. If we do it too frequently it's slow
-                self.f.flush()
-                self.flush_cycle = 0
+            if (dropped := self.dropped - self.dropped_reported) > 0:
+                self.dropped_reported += dropped
+                message = f'{datetime.datetime.now().isoformat(sep=" ")} | WARNING | {self.filename[:-4]} | ' \
+                          f'write | 0 | Log queue full, dropped {dropped} messages\n{message}'
+            if self.stdout:
+                print(message)
+            if self.f is None:
+                return
+            if record is not None and self.sink is not None:
+                self.sink.write(record)
+            line = f'{message}\n'
+            self.f.write(line)
+            self.size += len(line.encode())
+            if 0 < self.rotation_config('max_bytes', 0) < self.size:
+                self.rotate(by_size=True)
 
     def get_logdir(self, date):
         return f'/global/logs/{self.experiment}/{date.year}/{date.month:02d}.{date.day:02d}'
 
 
-def get_logger(name, db, debug=False):
-    oh = OutputHandler(name, db.experiment_name, debug)
+def get_log_config(db):
+    """
+    The 'logging' experiment config, or an empty dict if there isn't one. For example:
+    {'name': 'logging', 'suppression': {'default': {'window': 60}, '<logger name>': {'window': 0}}}
+    where a window of 0 turns off repeat suppression for that logger
+    """
+    try:
+        return db.get_experiment_config('logging') or {}
+    except Exception as e:
+        print(f'Couldn\'t load the logging config: {type(e)}: {e}')
+        return {}
+
+
+def get_logger(name, db, debug=False, stdout=True):
+    oh = OutputHandler(name, db.experiment_name, debug, db=db, stdout=stdout, config=get_log_config(db))
     logger = logging.getLogger(name)
     logger.addHandler(DobermanLogger(db, name, oh))
     if debug:
@@ -209,6 +742,44 @@ def sensible_sig_figs(value, lowlim, upplim, defaultsigfigs=3):
     return f'{value:.{sfs}g}'
 
 
+def effective_interval(doc):
+    """
+    The interval a sensor is actually read out at. Adaptive sensors publish theirs as
+    effective_interval, everything else uses readout_interval
+    :param doc: the sensor document
+    :returns: float
+    """
+    if doc.get('adaptive'):
+        return doc.get('effective_interval', doc['readout_interval'])
+    return doc['readout_interval']
+
+
+def deadband_config(doc):
+    """
+    The deadband settings of a sensor. The deadband field is either a number (the
+    threshold) or a dict {threshold, heartbeat}
+    :param doc: the sensor document
+    :returns: (threshold, heartbeat), or None if the sensor publishes every reading
+    """
+    if (cfg := doc.get('deadband')) is None:
+        return None
+    if not isinstance(cfg, dict):
+        cfg = {'threshold': cfg}
+    return cfg.get('threshold', 0), cfg.get('heartbeat', 60)
+
+
+def publish_interval(doc):
+    """
+    The longest a sensor can go without publishing a value
+    :param doc: the sensor document
+    :returns: float
+    """
+    interval = effective_interval(doc)
+    if (deadband := deadband_config(doc)) is not None:
+        return max(interval, deadband[1])
+    return interval
+
+
 class SortedBuffer(object):
     """
     A custom semi-fixed-width buffer that keeps itself sorted
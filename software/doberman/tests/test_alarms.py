@@ -0,0 +1,649 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from Doberman.AlarmMonitor import AlarmAggregator, AlarmDelivery, AlarmMonitor, AlarmStateTable, \
+    ContactDirectory, NotificationDispatcher
+from Doberman.AlarmNode import AlarmNode, TriggeredAlarmsNode
+
+
+class Logger(object):
+
+    def __init__(self):
+        self.lines = []
+
+    def __getattr__(self, level):
+        return lambda msg: self.lines.append((level, msg))
+
+
+class Outcomes(object):
+    """
+    Collects what the dispatcher reports through on_done
+    """
+
+    def __init__(self, expect=1):
+        self.results = []
+        self.expect = expect
+        self.event = threading.Event()
+
+    def __call__(self, ok, error=None):
+        self.results.append((ok, error))
+        if len(self.results) >= self.expect:
+            self.event.set()
+
+    def wait(self, timeout=5):
+        assert self.event.wait(timeout)
+        return self.results
+
+
+class Connection(object):
+
+    def __init__(self):
+        self.stale = False
+        self.closed = False
+
+    def quit(self):
+        self.closed = True
+
+
+@pytest.fixture
+def dispatch():
+    made = []
+
+    def make(senders, **kwargs):
+        kwargs.setdefault('backoff', 0.01)
+        made.append(NotificationDispatcher(Logger(), senders, **kwargs))
+        return made[-1]
+
+    yield make
+    for d in made:
+        d.close(timeout=1)
+
+
+def test_retry_until_sent(dispatch):
+    calls = []
+
+    def send(recipients, conn=None, timeout=None, message=None):
+        calls.append(time.monotonic())
+        if len(calls) < 3:
+            raise OSError('busy')
+
+    outcomes = Outcomes()
+    d = dispatch({'email': send}, retries=2)
+    assert d.submit('email', ['a@b'], on_done=outcomes, message='hi') == 1
+    assert outcomes.wait() == [(True, None)]
+    assert len(calls) == 3
+    # the backoff doubles between attempts
+    assert calls[2] - calls[1] >= 0.02 - 1e-3
+
+
+def test_give_up_after_retries(dispatch):
+    calls = []
+
+    def send(recipients, conn=None, timeout=None, message=None):
+        calls.append(recipients)
+        raise OSError('down')
+
+    outcomes = Outcomes()
+    d = dispatch({'email': send}, retries=1)
+    d.submit('email', ['a@b'], on_done=outcomes, message='hi')
+    [(ok, error)] = outcomes.wait()
+    assert not ok and isinstance(error, OSError)
+    assert len(calls) == 2
+
+
+def test_deadline_expiry(dispatch):
+    release = threading.Event()
+    sent = []
+
+    def send(recipients, conn=None, timeout=None, message=None):
+        release.wait(5)
+        sent.append(message)
+
+    first, second = Outcomes(), Outcomes()
+    d = dispatch({'email': send}, deadline=0.05)
+    d.submit('email', ['a@b'], on_done=first, message='first')
+    d.submit('email', ['a@b'], on_done=second, message='second')
+    # the only worker is stuck on the first message until the second one's deadline passed
+    time.sleep(0.1)
+    release.set()
+    assert first.wait() == [(True, None)]
+    [(ok, error)] = second.wait()
+    assert not ok and isinstance(error, TimeoutError)
+    assert sent == ['first']
+
+
+def test_connection_reuse(dispatch):
+    connections = []
+    used = []
+
+    def connect(timeout=None):
+        connections.append(Connection())
+        return connections[-1]
+
+    def send(recipients, conn=None, timeout=None, message=None):
+        if conn.stale:
+            raise ConnectionError('gone')
+        used.append(conn)
+
+    d = dispatch({'email': send}, connectors={'email': connect})
+    for i in range(3):
+        outcomes = Outcomes()
+        d.submit('email', ['a@b'], on_done=outcomes, message=str(i))
+        assert outcomes.wait() == [(True, None)]
+    assert len(connections) == 1
+    assert used == connections * 3
+
+    # a kept connection that went stale is replaced without using up a retry
+    connections[0].stale = True
+    outcomes = Outcomes()
+    d.submit('email', ['a@b'], on_done=outcomes, message='again')
+    assert outcomes.wait() == [(True, None)]
+    assert len(connections) == 2
+    assert connections[0].closed
+    assert used[-1] is connections[1]
+
+
+def test_fan_out_reports_each_job(dispatch):
+    sent = []
+
+    def send(recipients, conn=None, timeout=None, message=None):
+        if recipients == ['2']:
+            raise OSError('no signal')
+        sent.append(recipients)
+
+    outcomes = Outcomes(expect=3)
+    d = dispatch({'sms': send}, retries=0)
+    assert d.submit('sms', ['1', '2', '3'], on_done=outcomes, message='hi') == 3
+    assert sorted(ok for ok, _ in outcomes.wait()) == [False, True, True]
+    assert sorted(sent) == [['1'], ['3']]
+
+
+def test_delivery_success_fires_once():
+    calls = []
+    delivery = AlarmDelivery(lambda *args: calls.append(args))
+    delivery.expect(2)
+    delivery.result(False, OSError('a'))
+    assert calls == []
+    delivery.result(True)
+    delivery.seal()
+    assert calls == [(True, None)]
+
+
+def test_delivery_failure_waits_for_seal():
+    calls = []
+    error = OSError('b')
+    delivery = AlarmDelivery(lambda *args: calls.append(args))
+    # the dispatcher can report before the submitter counted the job
+    delivery.result(False, error)
+    delivery.expect(1)
+    assert calls == []
+    delivery.seal()
+    assert calls == [(False, error)]
+
+    calls.clear()
+    delivery = AlarmDelivery(lambda *args: calls.append(args))
+    delivery.expect(1)
+    delivery.seal()
+    assert calls == []
+    delivery.result(False, error)
+    assert calls == [(False, error)]
+
+
+def test_delivery_nothing_queued():
+    calls = []
+    delivery = AlarmDelivery(lambda *args: calls.append(args))
+    delivery.seal(ValueError('no recipients'))
+    [(ok, error)] = calls
+    assert not ok and isinstance(error, ValueError)
+
+
+@pytest.fixture
+def monitor(dispatch):
+
+    def make(senders, **kwargs):
+        m = AlarmMonitor.__new__(AlarmMonitor)
+        m.logger = Logger()
+        m.db = SimpleNamespace(experiment_name='test')
+        m.aggregator = None
+        m.dispatcher = dispatch(senders, retries=0, **kwargs)
+        m.directory = SimpleNamespace(addresses=lambda level: {'email': ['a@b'], 'sms': ['1', '2']})
+        return m
+
+    return make
+
+
+def send_email(addresses, subject, message, level, pipeline, conn=None, timeout=None):
+    raise OSError('smtp down')
+
+
+def test_log_alarm_reports_any_delivery(monitor):
+    sms = []
+    m = monitor({'email': send_email, 'sms': lambda numbers, message, **kw: sms.append(numbers)})
+    outcomes = Outcomes()
+    m.log_alarm(level=0, message='too hot', pipeline='p', on_delivery=outcomes)
+    assert outcomes.wait() == [(True, None)]
+    time.sleep(0.05)
+    assert outcomes.results == [(True, None)]
+    assert sorted(sms) == [['1'], ['2']]
+
+
+def test_log_alarm_reports_failure(monitor):
+
+    def send_sms(numbers, message, conn=None, timeout=None):
+        raise OSError('no credit')
+
+    m = monitor({'email': send_email, 'sms': send_sms})
+    outcomes = Outcomes()
+    m.log_alarm(level=0, message='too hot', pipeline='p', on_delivery=outcomes)
+    [(ok, error)] = outcomes.wait()
+    assert not ok and isinstance(error, OSError)
+
+
+def test_log_alarm_without_callback_raises(monitor):
+    m = monitor({'email': send_email})
+    # sms is an unknown protocol here, so it can't even be queued
+    with pytest.raises(ValueError):
+        m.log_alarm(level=0, message='too hot', pipeline='p')
+    outcomes = Outcomes()
+    m.log_alarm(level=0, message='too hot', pipeline='p', on_delivery=outcomes)
+    [(ok, error)] = outcomes.wait()
+    assert not ok
+
+
+class Pipeline(object):
+
+    def __init__(self):
+        self.name = 'pl_test'
+        self.silenced_at_level = -1
+        self.silences = []
+
+    def silence_for(self, duration, level=-1):
+        self.silences.append(duration)
+        self.silenced_at_level = level
+
+
+def make_node(log_alarm):
+    node = AlarmNode(pipeline=Pipeline(), name='alarm', logger=Logger(), _upstream=[], input_var='temp')
+    node.setup(set_sensor_setting=lambda *args: None, description='Temperature', device='dev',
+               log_alarm=log_alarm, max_reading_delay=10, escalation_config=[1, 1, 1],
+               silence_duration=[60, 120, 240], silence_duration_cant_send=5)
+    node.config = {'alarm_level': 0}
+    node.is_silent = False
+    return node
+
+
+def test_node_counts_only_delivered_messages():
+    queued = []
+    node = make_node(lambda **kwargs: queued.append(kwargs['on_delivery']))
+    node.log_alarm('too hot', ts=1)
+    # until we hear back, the short silence applies and nothing counts towards escalation
+    assert node.pipeline.silences == [5]
+    assert node.messages_this_level == 0
+    queued[-1](False, OSError('down'))
+    assert node.pipeline.silences == [5, 5]
+    assert node.messages_this_level == 0
+    for _ in range(2):
+        node.log_alarm('too hot', ts=1)
+        queued[-1](True)
+    assert node.pipeline.silences[-1] == 60
+    assert node.messages_this_level == 2
+    # the next message escalates
+    node.log_alarm('too hot', ts=1)
+    assert node.escalation_level == 1
+    assert node.messages_this_level == 0
+    queued[-1](True)
+    assert node.pipeline.silences[-1] == 120
+
+
+def test_node_ignores_deliveries_of_old_alarms():
+    queued = []
+    node = make_node(lambda **kwargs: queued.append(kwargs['on_delivery']))
+    node.log_alarm('too hot', ts=1)
+    node.reset_alarm()
+    node.log_alarm('too hot', ts=2)
+    queued[0](True)
+    assert node.messages_this_level == 0
+    queued[1](True)
+    assert node.messages_this_level == 1
+
+
+def test_node_cant_queue():
+
+    def log_alarm(**kwargs):
+        raise ValueError('no protocols')
+
+    node = make_node(log_alarm)
+    node.log_alarm('too hot', ts=1)
+    assert node.pipeline.silences == [5, 5]
+    assert node.messages_this_level == 0
+
+
+class ContactsDB(object):
+    """
+    Serves the alarm config and the contacts, and counts how often it's asked
+    """
+
+    def __init__(self):
+        self.config = {'_id': 1, 'protocols': [['email'], ['email', 'sms']],
+                       'recipients': [['shifters'], ['shifters', 'experts']]}
+        self.contacts = [
+            {'name': 'bob', 'email': 'bob@x', 'sms': '2', 'on_shift': False, 'expert': True},
+            {'name': 'alice', 'email': 'alice@x', 'sms': '1', 'on_shift': True, 'expert': False},
+            {'name': 'carol', 'email': 'carol@x', 'on_shift': False, 'expert': False},
+        ]
+        self.reads = 0
+
+    def get_experiment_config(self, name):
+        self.reads += 1
+        return dict(self.config)
+
+    def read_from_db(self, collection, projection=None):
+        self.reads += 1
+        return [dict(doc) for doc in self.contacts]
+
+
+@pytest.fixture
+def directory():
+    d = ContactDirectory(ContactsDB(), Logger())
+    assert d.refresh()
+    return d
+
+
+def test_directory_lookup(directory):
+    reads = directory.db.reads
+    assert directory.shifters == ['alice']
+    assert directory.addresses(0) == {'email': ['alice@x']}
+    assert directory.addresses(1) == {'email': ['alice@x', 'bob@x'], 'sms': ['1', '2']}
+    # levels above the config use the highest protocols defined, and go to everyone
+    assert directory.addresses(3) == {'email': ['alice@x', 'bob@x', 'carol@x'], 'sms': ['1', '2']}
+    assert directory.addresses(0, shifters=['carol']) == {'email': ['carol@x']}
+    # raising an alarm doesn't touch the database
+    assert directory.db.reads == reads
+
+
+def test_directory_returns_copies(directory):
+    directory.addresses(0)['email'].append('mallory@x')
+    assert directory.addresses(0) == {'email': ['alice@x']}
+
+
+def test_directory_missing_details(directory):
+    directory.db.config['recipients'] = [['everyone']]
+    directory.db.config['protocols'] = [['sms']]
+    assert directory.refresh()
+    # carol has no phone number, level 1 has no recipients defined so everyone gets it
+    assert directory.addresses(0) == {'sms': ['1', '2']}
+    assert directory.addresses(1) == {'sms': ['1', '2']}
+    assert any('carol' in msg for level, msg in directory.logger.lines if level == 'error')
+
+
+def test_directory_refresh_only_on_change(directory):
+    table = directory.table
+    assert not directory.refresh()
+    assert directory.table is table
+
+    # a shift change
+    directory.db.contacts[0]['on_shift'] = True
+    directory.db.contacts[1]['on_shift'] = False
+    assert directory.refresh()
+    assert directory.shifters == ['bob']
+    assert directory.addresses(0) == {'email': ['bob@x']}
+    assert not directory.refresh()
+
+    # a config change
+    directory.db.config['protocols'] = [['sms'], ['email', 'sms']]
+    assert directory.refresh()
+    assert directory.addresses(0) == {'sms': ['2']}
+
+    # a new contact
+    directory.db.contacts.append({'name': 'dave', 'email': 'dave@x', 'on_shift': True})
+    assert directory.refresh()
+    assert directory.shifters == ['bob', 'dave']
+    assert directory.addresses(0) == {'sms': ['2']}
+    assert directory.addresses(1)['email'] == ['bob@x', 'dave@x']
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    return now
+
+
+def alarm(level, message, pipeline='p'):
+    return (level, message, pipeline)
+
+
+def test_aggregator_window(clock):
+    agg = AlarmAggregator(window=10)
+    prd = {'email': ['a@b']}
+    assert agg.add('dev', alarm(0, 'one'), prd) == [(alarm(0, 'one'), prd, None)]
+    assert agg.add('dev', alarm(0, 'two'), prd) == []
+    assert agg.add('dev', alarm(0, 'three'), prd) == []
+    # other devices have their own window
+    assert len(agg.add('other', alarm(0, 'four'), prd)) == 1
+    clock[0] += 9.9
+    assert agg.due() == []
+    clock[0] += 0.1
+    assert [a[0][1] for a in agg.due()] == ['two', 'three']
+    # the digest opened a new window
+    assert agg.add('dev', alarm(0, 'five'), prd) == []
+    clock[0] += 10
+    assert [a[0][1] for a in agg.due()] == ['five']
+    # a quiet window closes the group
+    clock[0] += 10
+    assert agg.due() == []
+    assert agg.groups == {}
+    assert len(agg.add('dev', alarm(0, 'six'), prd)) == 1
+
+
+def test_aggregator_held_alarms_outlive_window(clock):
+    agg = AlarmAggregator(window=10)
+    agg.add('dev', alarm(0, 'one'), {})
+    agg.add('dev', alarm(0, 'two'), {})
+    clock[0] += 20
+    # due() hasn't run yet, so this still waits for the digest rather than overtaking it
+    assert agg.add('dev', alarm(0, 'three'), {}) == []
+    assert [a[0][1] for a in agg.due()] == ['two', 'three']
+
+
+def test_aggregator_flush_on_escalation(clock):
+    agg = AlarmAggregator(window=10)
+    agg.add('dev', alarm(0, 'one'), {})
+    agg.add('dev', alarm(0, 'two'), {})
+    # escalating doesn't wait for the window and takes the held back alarm along
+    assert [a[0][1] for a in agg.add('dev', alarm(1, 'three'), {})] == ['two', 'three']
+    assert agg.add('dev', alarm(1, 'four'), {}) == []
+    assert agg.add('dev', alarm(0, 'five'), {}) == []
+    assert len(agg.add('dev', alarm(2, 'six'), {})) == 3
+    clock[0] += 10
+    assert agg.due() == []
+
+
+class FakeDispatcher(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def submit(self, protocol, recipients, on_done=None, **kwargs):
+        self.sent.append((protocol, sorted(recipients), kwargs['message']))
+        if on_done is not None:
+            on_done(True)
+        return 1
+
+
+@pytest.fixture
+def digest_monitor(clock):
+    m = AlarmMonitor.__new__(AlarmMonitor)
+    m.logger = Logger()
+    m.db = SimpleNamespace(experiment_name='test')
+    m.aggregator = AlarmAggregator(window=10)
+    m.dispatcher = FakeDispatcher()
+    m.directory = SimpleNamespace(addresses=lambda level: {'sms': ['1', '2'] if level else ['1']})
+    return m
+
+
+def test_digests(digest_monitor, clock):
+    m = digest_monitor
+    outcomes = [Outcomes() for _ in range(3)]
+    for i, msg in enumerate(['dev down', 'temp stale', 'pressure stale']):
+        m.log_alarm(level=0, message=msg, pipeline=f'p{i}', device='dev', on_delivery=outcomes[i])
+    m.log_alarm(level=0, message='other', pipeline='p', device='other')
+    assert m.dispatcher.sent == [('sms', ['1'], 'TEST dev down'), ('sms', ['1'], 'TEST other')]
+    assert outcomes[0].results == [(True, None)]
+    # held back alarms only hear back once their digest went out
+    assert outcomes[1].results == outcomes[2].results == []
+    m.send_digests()
+    assert len(m.dispatcher.sent) == 2
+    clock[0] += 10
+    m.send_digests()
+    assert m.dispatcher.sent[2:] == [('sms', ['1'], 'TEST 2 alarms: temp stale; pressure stale')]
+    assert outcomes[1].results == outcomes[2].results == [(True, None)]
+
+
+def test_digest_on_escalation(digest_monitor):
+    m = digest_monitor
+    m.log_alarm(level=0, message='dev down', pipeline='p0', device='dev')
+    m.log_alarm(level=0, message='temp stale', pipeline='p1', device='dev')
+    outcome = Outcomes()
+    m.log_alarm(level=1, message='dev still down', pipeline='p0', device='dev', on_delivery=outcome)
+    # the escalated alarm goes out now, and whoever only gets the higher level only sees that one
+    assert sorted(m.dispatcher.sent[1:]) == [('sms', ['1'], 'TEST 2 alarms: temp stale; dev still down'),
+                                             ('sms', ['2'], 'TEST dev still down')]
+    assert outcome.results == [(True, None)]
+
+
+class SensorsDB(object):
+
+    def __init__(self, fail=False):
+        self.docs = {'temp': {'name': 'temp', 'alarm_is_triggered': True}, 'pres': {'name': 'pres'}}
+        self.writes = []
+        self.fail = fail
+
+    def read_from_db(self, collection, projection=None):
+        return list(self.docs.values())
+
+    def update_db(self, collection, cuts, updates):
+        if self.fail:
+            raise ConnectionError('no db')
+        self.writes.append((sorted(cuts['name']['$in']), updates['$set']['alarm_is_triggered']))
+
+
+def test_state_table_writes_transitions(clock):
+    db = SensorsDB()
+    table = AlarmStateTable(db, Logger(), resync=60)
+    assert table.triggered() == ['temp']
+    # the first evaluation is written even if it agrees with what we read at startup
+    table.set('temp', True)
+    table.set('pres', False)
+    table.flush()
+    assert db.writes == [(['temp'], True), (['pres'], False)]
+    db.writes.clear()
+    for _ in range(3):
+        table.set('temp', True)
+        table.set('pres', False)
+        table.flush()
+    assert db.writes == []
+    table.set('pres', True)
+    table.set('temp', False)
+    table.set('temp', True)
+    table.flush()
+    assert db.writes == [(['pres', 'temp'], True)]
+    assert table.get('pres') and not table.get('other')
+
+
+def test_state_table_resync(clock):
+    db = SensorsDB()
+    table = AlarmStateTable(db, Logger(), resync=60)
+    table.set('temp', False)
+    table.flush()
+    db.writes.clear()
+    clock[0] += 59
+    table.flush()
+    assert db.writes == []
+    # level triggered, in case a write got lost or someone else touched the documents
+    clock[0] += 1
+    table.flush()
+    assert db.writes == [(['temp'], False)]
+    table.flush()
+    assert db.writes == [(['temp'], False)]
+
+
+def test_state_table_retries_failed_writes(clock):
+    db = SensorsDB(fail=True)
+    table = AlarmStateTable(db, Logger(), resync=0)
+    table.set('temp', False)
+    table.flush()
+    assert table.dirty == {'temp': False}
+    db.fail = False
+    table.flush()
+    assert db.writes == [(['temp'], False)]
+    clock[0] += 1000
+    table.flush()
+    assert db.writes == [(['temp'], False)]
+
+
+def test_node_alarm_state():
+    writes = []
+    node = make_node(lambda **kwargs: None)
+    node.set_sensor_setting = lambda *args: writes.append(args)
+    # without the monitor's table, the node writes its first state and then only changes
+    for _ in range(2):
+        node.reset_alarm()
+    node.log_alarm('too hot', ts=1)
+    node.log_alarm('too hot', ts=1)
+    assert writes == [('temp', 'alarm_is_triggered', False), ('temp', 'alarm_is_triggered', True)]
+
+    node.alarm_state = AlarmStateTable(SensorsDB(), Logger())
+    node.reset_alarm()
+    assert node.alarm_state.dirty == {'temp': False}
+    assert len(writes) == 2
+
+
+def make_triggered_node(sensors_to_check='any', alarm_state=None):
+    queries = []
+
+    def get_triggered_sensors(names=None):
+        queries.append(names)
+        return [name for name in ['temp', 'flow'] if names is None or name in names]
+
+    node = TriggeredAlarmsNode(pipeline=Pipeline(), name='triggered', logger=Logger(), _upstream=[],
+                               output_var='any_alarm')
+    node.setup(get_triggered_sensors=get_triggered_sensors, alarm_state=alarm_state)
+    node.config = {'sensors_to_check': sensors_to_check}
+    return node, queries
+
+
+@pytest.mark.parametrize('source', ['db', 'alarm_state'])
+def test_triggered_alarms(source):
+    table = None
+    if source == 'alarm_state':
+        table = AlarmStateTable(SensorsDB(), Logger())
+        table.set('flow', True)
+    node, queries = make_triggered_node(alarm_state=table)
+    package = node.process({'time': 1})
+    assert package == {'time': 1, 'any_alarm': 1, 'triggered_sensors': ['temp', 'flow']}
+
+    node.config['sensors_to_check'] = ['pres', 'flow']
+    assert node.process({'time': 2})['triggered_sensors'] == ['flow']
+    node.config['sensors_to_check'] = ['pres']
+    assert node.process({'time': 3}) == {'time': 3, 'any_alarm': 0, 'triggered_sensors': []}
+    # only the fallback asks the database
+    assert queries == ([None, ['pres', 'flow'], ['pres']] if source == 'db' else [])
+
+
+def test_triggered_alarms_follow_the_table():
+    table = AlarmStateTable(SensorsDB(), Logger())
+    node, _ = make_triggered_node(alarm_state=table)
+    table.set('temp', False)
+    assert node.process({})['any_alarm'] == 0
+    table.set('pres', True)
+    assert node.process({})['triggered_sensors'] == ['pres']
+
+
+def test_triggered_alarms_bad_config():
+    node, queries = make_triggered_node(sensors_to_check='temp')
+    assert node.process({}) == 0
+    assert queries == []
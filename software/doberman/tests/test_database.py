@@ -0,0 +1,151 @@
+import gzip
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+import Doberman
+
+
+class Collection(object):
+    """
+    Just enough of a pymongo collection: equality and $in cuts
+    """
+
+    def __init__(self, docs=()):
+        self.docs = list(docs)
+        self.indexes = []
+        self.queries = []
+
+    def create_index(self, key, **kwargs):
+        self.indexes.append(key)
+
+    def find(self, cuts, projection=None, **kwargs):
+        self.queries.append(cuts)
+        ret = []
+        for doc in self.docs:
+            if all(doc.get(k) in v['$in'] if isinstance(v, dict) else doc.get(k) == v for k, v in cuts.items()):
+                if projection:
+                    doc = {k: v for k, v in doc.items() if projection.get(k, k == '_id')}
+                ret.append(doc)
+        return ret
+
+
+class Client(dict):
+
+    def __init__(self, collections):
+        super().__init__(test=collections)
+
+
+@pytest.fixture
+def mongo():
+    return {
+        'experiment_config': Collection([{'name': 'influx', 'url': 'http://influx:8086', 'org': 'org',
+                                          'bucket': 'bucket', 'token': 'secret'}]),
+        'sensors': Collection([{'name': 'temp', 'alarm_is_triggered': True},
+                               {'name': 'pres', 'alarm_is_triggered': False},
+                               {'name': 'flow', 'alarm_is_triggered': True}]),
+    }
+
+
+@pytest.fixture
+def db(mongo):
+    return Doberman.Database(Client(mongo), experiment_name='test')
+
+
+class Logger(object):
+
+    def __init__(self):
+        self.lines = []
+
+    def __getattr__(self, level):
+        return lambda msg: self.lines.append(msg)
+
+
+@pytest.fixture
+def influx(mongo, monkeypatch):
+    """
+    Makes a Database with these gzip settings, and collects what it posts
+    """
+    posts = []
+
+    def post(url, headers=None, data=None):
+        posts.append(SimpleNamespace(url=url, headers=headers, data=data))
+        return SimpleNamespace(status_code=204)
+
+    monkeypatch.setattr(requests, 'post', post)
+
+    def make(gzip_cfg=None):
+        if gzip_cfg is not None:
+            mongo['experiment_config'].docs[0]['gzip'] = gzip_cfg
+        db = Doberman.Database(Client(mongo), experiment_name='test')
+        db.logger = Logger()
+        return db, posts
+
+    return make
+
+
+def lines(n):
+    return b''.join(b'temperature,sensor=T_%03d,subsystem=cryo value=%d.5 %d\n' % (i, i, 1700000000000 + i)
+                    for i in range(n))
+
+
+def test_triggered_sensors(db, mongo):
+    sensors = mongo['sensors']
+    # the index is made up front, not on the query path
+    assert sensors.indexes == ['alarm_is_triggered']
+    assert db.get_triggered_sensors() == ['temp', 'flow']
+    assert db.get_triggered_sensors(['pres', 'flow']) == ['flow']
+    assert db.get_triggered_sensors([]) == []
+    assert sensors.indexes == ['alarm_is_triggered']
+    assert sensors.queries[-2] == {'alarm_is_triggered': True, 'name': {'$in': ['pres', 'flow']}}
+
+
+def test_influx_gzip(influx):
+    db, posts = influx({'level': 9, 'min_size': 1000})
+    data = lines(100)
+    db.post_to_influx(bytearray(data))
+    [post] = posts
+    assert post.headers['Content-Encoding'] == 'gzip'
+    assert post.headers['Authorization'] == 'Token secret'
+    assert post.url == 'http://influx:8086/api/v2/write?precision=ms&org=org&bucket=bucket'
+    assert gzip.decompress(post.data) == data
+    assert len(post.data) < len(data) / 4
+    # the stored headers aren't touched
+    assert db.influx_cfg[1] == {'Authorization': 'Token secret'}
+
+
+def test_influx_gzip_threshold(influx):
+    db, posts = influx({'min_size': 1000})
+    small = lines(3)
+    assert len(small) < 1000
+    db.post_to_influx(small)
+    db.post_to_influx(lines(100))
+    assert posts[0].data == small and isinstance(posts[0].data, bytes)
+    assert 'Content-Encoding' not in posts[0].headers
+    assert posts[1].headers['Content-Encoding'] == 'gzip'
+
+
+def test_influx_without_gzip(influx):
+    db, posts = influx()
+    data = lines(100)
+    db.post_to_influx(data)
+    assert posts[0].data == data
+    assert 'Content-Encoding' not in posts[0].headers
+
+
+def test_influx_compression_report(influx):
+    db, posts = influx({'min_size': 1000})
+    assert db.report_influx_compression()['ratio'] == 1
+    small, big = lines(3), lines(100)
+    db.post_to_influx(small)
+    db.post_to_influx(big)
+    stats = db.report_influx_compression()
+    assert (stats['requests'], stats['compressed']) == (2, 1)
+    assert stats['raw_bytes'] == len(small) + len(big)
+    assert stats['sent_bytes'] == sum(len(p.data) for p in posts)
+    assert stats['ratio'] == stats['raw_bytes'] / stats['sent_bytes'] > 1
+    assert stats['compress_ms'] >= 0 and 'compress_time' not in stats
+    assert 'ratio' in db.logger.lines[-1]
+    # the counters start over
+    assert db.report_influx_compression()['requests'] == 0
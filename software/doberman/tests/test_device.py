@@ -0,0 +1,187 @@
+import os
+import struct
+import threading
+import time
+
+import pytest
+
+from Doberman.BaseDevice import Device, RevPiDevice
+
+
+class Logger(object):
+
+    def __getattr__(self, level):
+        return lambda msg: None
+
+
+@pytest.fixture
+def revpi(tmp_path, monkeypatch):
+    # a regular file stands in for the process image
+    image = tmp_path / 'piControl0'
+    data = bytearray(32)
+    struct.pack_into('<h', data, 0, -5)
+    struct.pack_into('<H', data, 2, 40000)
+    data[4] = 0b1010
+    struct.pack_into('<i', data, 8, 123456)
+    image.write_bytes(bytes(data))
+    monkeypatch.setattr(RevPiDevice, 'path', str(image))
+    params = {'positions': {'I_1': [0, 0, 16], 'I_2': [2, 0, 16], 'I_3': [4, 1, 1], 'I_4': [4, 2, 1],
+                            'I_5': [8, 0, 32], 'O_1': [20, 0, 8], 'O_2': [21, 3, 1], 'O_3': [21, 4, 1],
+                            'AO': [24, 0, 16]},
+              'unsigned': ['I_2'], 'inputs': ['I_1', 'I_3', 'I_5']}
+    dev = RevPiDevice({'params': params, 'sensors': []}, Logger(), threading.Event())
+    yield dev, image
+    dev.shutdown()
+
+
+def test_read(revpi):
+    dev, _ = revpi
+    assert not dev.is_device
+    assert dev.read('I_1') == -5
+    assert dev.read('I_2') == 40000
+    assert (dev.read('I_3'), dev.read('I_4')) == (1, 0)
+    assert dev.read('I_5') == 123456
+    with pytest.raises(ValueError):
+        dev.read('I_6')
+
+
+def test_read_inputs(revpi):
+    dev, image = revpi
+    # one block from the lowest to the end of the highest input
+    assert (dev.block[0], len(dev.block[1])) == (0, 12)
+    assert dev.read_inputs() == {'I_1': -5, 'I_3': 1, 'I_5': 123456}
+    fd = os.open(image, os.O_WRONLY)
+    os.pwrite(fd, struct.pack('<h', 7), 0)
+    os.close(fd)
+    assert dev.read_inputs()['I_1'] == 7
+    dev.set_inputs(['I_4', 'I_2'])
+    assert (dev.block[0], len(dev.block[1])) == (2, 3)
+    assert dev.read_inputs() == {'I_4': 0, 'I_2': 40000}
+    dev.set_inputs([])
+    assert dev.read_inputs() == {}
+
+
+def test_write(revpi):
+    dev, image = revpi
+    dev.write('O_1', 200)
+    dev.write('AO', -300)
+    assert dev.read('O_1') == 200
+    assert dev.read('AO') == -300
+    # single bits leave their neighbours alone
+    dev.write('O_2', 1)
+    dev.write('O_3', True)
+    assert image.read_bytes()[21] == 0b11000
+    dev.write('O_2', 0)
+    assert image.read_bytes()[21] == 0b10000
+    assert (dev.read('O_2'), dev.read('O_3')) == (0, 1)
+    dev.write('O_3', 0)
+    assert image.read_bytes()[20:26] == bytes([200, 0, 0, 0]) + struct.pack('<h', -300)
+
+
+def test_shutdown_closes_once(revpi):
+    dev, _ = revpi
+    dev.shutdown()
+    assert dev.fd is None
+    dev.shutdown()
+
+
+class CountingDevice(Device):
+    """
+    Replies with how often it was asked. 'r block' waits until released
+    """
+
+    def setup(self):
+        self.calls = []
+        self.release = threading.Event()
+        self.fail = False
+
+    def send_recv(self, message):
+        self.calls.append(message)
+        if message == 'r block':
+            self.release.wait(5)
+        if self.fail:
+            return {'retcode': -2, 'data': None}
+        return {'retcode': 0, 'data': len(self.calls)}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def counting(monkeypatch, clock):
+    monkeypatch.setattr(time, 'sleep', lambda s: None)
+    event = threading.Event()
+    dev = CountingDevice({'params': {'coalesce_window': 10}, 'sensors': []}, Logger(), event)
+    t = threading.Thread(target=dev.readout_scheduler, daemon=True)
+    t.start()
+    yield dev
+    dev.release.set()
+    event.set()
+    with dev.cv:
+        dev.cv.notify()
+    t.join()
+
+
+def request(dev, command):
+    pkg, cv = {}, threading.Condition()
+    dev.add_to_schedule(command, ret=(pkg, cv))
+    return pkg, cv
+
+
+def wait(pkg, cv):
+    with cv:
+        assert cv.wait_for(lambda: len(pkg) > 0, 5)
+    return pkg
+
+
+def test_coalesce_queued(counting):
+    dev = counting
+    blocker = request(dev, 'r block')
+    while not dev.calls:
+        time.sleep(0.001)
+    # these pile up behind the blocked command
+    waiting = [request(dev, 'r a') for _ in range(3)] + [request(dev, 'r b')]
+    dev.release.set()
+    replies = [wait(*r) for r in waiting]
+    assert wait(*blocker)['data'] == 1
+    assert dev.calls == ['r block', 'r a', 'r b']
+    # every sensor waiting on 'r a' got the same reply
+    assert [r['data'] for r in replies] == [2, 2, 2, 3]
+    assert replies[0]['time'] == replies[2]['time']
+
+
+def test_coalesce_window(counting, clock):
+    dev = counting
+    first = wait(*request(dev, 'r a'))
+    clock[0] += 9.9
+    again = wait(*request(dev, 'r a'))
+    # within the window the device isn't asked, the reply keeps its timestamp
+    assert dev.calls == ['r a']
+    assert again == first
+    clock[0] += 0.1
+    assert wait(*request(dev, 'r a'))['data'] == 2
+    assert wait(*request(dev, 'r b'))['data'] == 3
+    assert wait(*request(dev, 'r a'))['data'] == 2
+    # other commands might change what the device says
+    dev.add_to_schedule('w a 1')
+    assert wait(*request(dev, 'r a'))['data'] == 5
+    assert dev.calls == ['r a', 'r a', 'r b', 'w a 1', 'r a']
+
+
+def test_coalesce_skips_failures(counting):
+    dev = counting
+    dev.fail = True
+    assert wait(*request(dev, 'r a'))['retcode'] == -2
+    dev.fail = False
+    assert wait(*request(dev, 'r a'))['data'] == 2
+
+
+def test_coalesce_off(counting):
+    dev = counting
+    dev.coalesce_window = 0
+    for i in range(3):
+        assert wait(*request(dev, 'r a'))['data'] == i + 1
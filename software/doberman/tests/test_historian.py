@@ -0,0 +1,131 @@
+import os
+import shutil
+import time
+
+import pytest
+
+from Doberman.Historian import Historian
+
+T0 = 1_700_000_000.
+
+
+@pytest.fixture
+def historian(tmp_path):
+    h = Historian(str(tmp_path), segment_points=100, rollups=(60,))
+    yield h
+    h.close()
+
+
+def fill(historian, name='T1', n=350, **kwargs):
+    for i in range(n):
+        historian.write(name, T0 + i, float(i), **kwargs)
+
+
+def test_query_across_segments(historian):
+    fill(historian)
+    assert len(historian.get_series('T1').segments()) == 4
+    t, v = historian.query('T1', T0 + 95, T0 + 105)
+    assert t == [T0 + i for i in range(95, 105)]
+    assert v == [float(i) for i in range(95, 105)]
+    t, v = historian.query('T1')
+    assert v == [float(i) for i in range(350)]
+
+
+def test_last(historian):
+    assert historian.last('T1') is None
+    fill(historian)
+    assert historian.last('T1') == (T0 + 349, 349.)
+    historian.write('T1', T0 + 400, -1.)
+    assert historian.last('T1') == (T0 + 400, -1.)
+
+
+def test_rollups_only_hold_complete_bins(historian):
+    fill(historian)
+    assert historian.roll_up_pending() == 3
+    bins, means = historian.get_series('T1', 60).query()
+    # three segments are full, so everything up to the bin that holds T0 + 299 is in
+    assert bins[-1] + 60 <= T0 + 299
+    assert all(b % 60 == 0 for b in bins)
+    assert bins == sorted(set(bins))
+    for b, m in zip(bins, means):
+        _, v = historian.query('T1', b, b + 60)
+        assert m == pytest.approx(sum(v) / len(v))
+
+
+def test_downsample(historian):
+    fill(historian)
+    bins, means = historian.downsample('T1', 60, T0 + 120, T0 + 240)
+    expected = Historian.bin(*historian.query('T1', T0 + 120, T0 + 240), 60)
+    assert (bins, means) == expected
+
+
+def test_retention(historian):
+    fill(historian)
+    historian.retention = time.time() - T0 - 250
+    assert historian.enforce_retention() == 2
+    t, _ = historian.query('T1')
+    assert t[0] == T0 + 200
+
+
+def test_reopen_continues_the_last_segment(tmp_path):
+    h = Historian(str(tmp_path), segment_points=100)
+    fill(h, n=50)
+    h.close()
+    h = Historian(str(tmp_path), segment_points=100)
+    h.write('T1', T0 + 50, 50.)
+    assert len(h.get_series('T1').segments()) == 1
+    assert h.query('T1')[1] == [float(i) for i in range(51)]
+    h.close()
+
+
+def test_replay(historian, tmp_path):
+    fill(historian, 'T1', 10, topic='temperature', tags={'sensor': 'T1'})
+    other = Historian(str(tmp_path))
+    fill(other, 'T2', 10, topic='temperature', tags={'sensor': 'T2'})
+    points = list(historian.replay(T0 + 5))
+    assert {p[1]['sensor'] for p in points} == {'T1', 'T2'}
+    points = list(historian.replay(T0 + 5, names=historian.written))
+    assert points == [('temperature', {'sensor': 'T1'}, {'value': float(i)}, T0 + i) for i in range(5, 10)]
+    assert os.path.exists(tmp_path / 'T1' / 'meta.json')
+    other.close()
+
+
+def test_rollups_stay_off_the_write_path(historian):
+    fill(historian, n=250)
+    rollup = historian.get_series('T1', 60)
+    assert list(historian.pending) == [('T1', int(T0 * 1e6)), ('T1', int((T0 + 100) * 1e6))]
+    assert rollup.query() == ([], [])
+    assert historian.roll_up_pending() == 2
+    assert historian.roll_up_pending() == 0
+    bins, _ = rollup.query()
+    assert bins[-1] + 60 <= T0 + 199
+    # rolling up late doesn't lose or repeat bins
+    fill(historian, n=350)
+    historian.roll_up_pending()
+    bins, _ = rollup.query()
+    assert bins == sorted(set(bins))
+    assert bins[-1] + 60 <= T0 + 299
+
+
+def test_last_sees_a_deleted_segment(tmp_path):
+    writer = Historian(str(tmp_path), segment_points=100)
+    reader = Historian(str(tmp_path), segment_points=100)
+    fill(writer, n=50)
+    assert reader.last('T1') == (T0 + 49, 49.)
+    writer.close()
+    # the sensor's data is deleted, and a new writer starts over
+    shutil.rmtree(tmp_path / 'T1')
+    writer = Historian(str(tmp_path), segment_points=100)
+    writer.write('T1', T0 + 1000, -1.)
+    assert reader.last('T1') == (T0 + 1000, -1.)
+    writer.close()
+    reader.close()
+
+
+def test_replay_refreshes_last(historian):
+    fill(historian, n=10, topic='temperature', tags={'sensor': 'T1'})
+    assert historian.last('T1') == (T0 + 9, 9.)
+    assert historian.get_series('T1').tail is not None
+    assert len(list(historian.replay(T0))) == 10
+    assert historian.get_series('T1').tail is None
+    assert historian.last('T1') == (T0 + 9, 9.)
@@ -0,0 +1,161 @@
+import collections
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import Doberman.hypervisor as hypervisor
+from Doberman.hypervisor import AckTracker
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_ack(clock):
+    acks = AckTracker(timeout=5)
+    cmd_id = acks.add('dev1', 'sleep 1')
+    assert len(acks) == 1
+    assert acks.time_to_next_deadline() == 5
+    clock[0] += 0.25
+    assert acks.ack(cmd_id)
+    assert len(acks) == 0
+    assert acks.time_to_next_deadline() is None
+    assert acks.latency_summary() == {'dev1': (1, 0.25, 0.25, 0.25)}
+
+
+def test_timeout_and_retries(clock):
+    acks = AckTracker(timeout=5, retries=1, targets={'dev2': {'timeout': 1, 'retries': 0}})
+    first = acks.add('dev1', 'a')
+    second = acks.add('dev2', 'b')
+    assert acks.time_to_next_deadline() == 1
+    clock[0] += 1
+    assert list(acks.expired()) == [(second, 'dev2', 'b', 1, False)]
+    assert list(acks.expired()) == []
+    clock[0] += 4
+    assert list(acks.expired()) == [(first, 'dev1', 'a', 1, True)]
+    # the retry gets a fresh deadline
+    assert acks.time_to_next_deadline() == 5
+    clock[0] += 5
+    assert list(acks.expired()) == [(first, 'dev1', 'a', 2, False)]
+    assert len(acks) == 0
+
+
+def test_late_ack(clock):
+    acks = AckTracker(timeout=1)
+    cmd_id = acks.add('dev1', 'a')
+    clock[0] += 2
+    assert len(list(acks.expired())) == 1
+    assert not acks.ack(cmd_id)
+    assert not acks.ack('nonsense')
+    assert acks.latency_summary() == {}
+
+
+def test_acked_commands_leave_the_heap(clock):
+    acks = AckTracker(timeout=1)
+    ids = [acks.add('dev1', i) for i in range(3)]
+    clock[0] += 0.5
+    acks.ack(ids[0])
+    acks.ack(ids[1])
+    assert acks.time_to_next_deadline() == 0.5
+    assert acks._heap == [(101, ids[2])]
+    clock[0] += 1
+    assert [cmd for _, _, cmd, _, _ in acks.expired()] == [2]
+
+
+def test_percentiles(clock):
+    acks = AckTracker(timeout=1000, history=100)
+    # 150 acks with latencies 1..150 s, only the last 100 are kept
+    for i in range(1, 151):
+        cmd_id = acks.add('dev1', i)
+        clock[0] += i
+        acks.ack(cmd_id)
+    acks.add('dev2', 0)
+    assert acks.latency_summary() == {'dev1': (100, 101, 141, 150)}
+
+
+class FakeClock(object):
+    """
+    Monotonic and wall clocks that only move when the sync loop waits. Every wait
+    oversleeps a little, and one of them stalls for a long time
+    """
+
+    def __init__(self, sends, oversleep=0.003, stall=0):
+        self.mono = 50.
+        self.offset = 1000.3 - self.mono
+        self.sends = sends
+        self.oversleep = oversleep
+        self.stall = stall
+        self.waits = 0
+
+    def is_set(self):
+        return len(self.sends) >= 40
+
+    def wait(self, dt):
+        self.waits += 1
+        self.mono += dt + self.oversleep + (self.stall if self.waits == 10 else 0)
+
+
+class FakeSocket(object):
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def connect(self, address):
+        pass
+
+    def send_string(self, msg):
+        self.clock.sends.append((self.clock.mono, msg))
+
+
+def run_sync(monkeypatch, periods, **kwargs):
+    sends = []
+    clock = FakeClock(sends, **kwargs)
+    monkeypatch.setattr(time, 'monotonic', lambda: clock.mono)
+    monkeypatch.setattr(time, 'time', lambda: clock.mono + clock.offset)
+    monkeypatch.setattr(hypervisor.zmq.Context, 'instance', lambda: SimpleNamespace(socket=lambda t: FakeSocket(clock)))
+    hv = hypervisor.Hypervisor.__new__(hypervisor.Hypervisor)
+    hv.event = clock
+    hv.logger = SimpleNamespace(warning=lambda msg: None)
+    hv.db = SimpleNamespace(get_comms_info=lambda what: ('localhost', {'send': 1}))
+    hv.sync_jitter = collections.deque()
+    hv.sync_signals(periods)
+    return hv, clock, sends
+
+
+def test_sync_ticks_are_phase_locked(monkeypatch):
+    hv, clock, sends = run_sync(monkeypatch, [0.5, 2])
+    for mono, msg in sends:
+        name, nominal, _ = msg.split()
+        # each tick goes out just after its nominal time, the oversleeps don't add up
+        assert 0 <= mono + clock.offset - float(nominal) <= 0.0031
+    assert [msg.split()[1] for _, msg in sends if msg.startswith('X_SYNC_2 ')][:2] == ['1002.000', '1004.000']
+    assert len(hv.sync_jitter) == len(sends)
+    assert all(late == pytest.approx(0.003) for _, late in hv.sync_jitter)
+
+
+def test_sync_skips_missed_ticks(monkeypatch):
+    hv, clock, sends = run_sync(monkeypatch, [1], oversleep=0, stall=3.5)
+    nominal = [float(msg.split()[1]) for _, msg in sends]
+    gaps = [b - a for a, b in zip(nominal, nominal[1:])]
+    # one late tick, then back on the grid without a burst of the missed ones
+    assert sorted(set(gaps)) == [1, 4]
+    assert max(late for _, late in hv.sync_jitter) == pytest.approx(3.5)
+    assert all(mono + clock.offset - n <= 3.5 + 1e-9 for (mono, _), n in zip(sends, nominal))
+
+
+def test_report_sync_jitter():
+    written = []
+    hv = hypervisor.Hypervisor.__new__(hypervisor.Hypervisor)
+    hv.db = SimpleNamespace(write_to_influx=lambda **kwargs: written.append(kwargs))
+    hv.sync_jitter = collections.deque([(5, 0.001), (10, 0.004), (5, 0.003)])
+    hv.report_sync_jitter()
+    assert len(hv.sync_jitter) == 0
+    fields = {w['tags']['sensor']: w['fields'] for w in written}
+    assert fields['X_SYNC_5'] == {'jitter_mean': pytest.approx(2), 'jitter_max': pytest.approx(3)}
+    assert fields['X_SYNC_10'] == {'jitter_mean': pytest.approx(4), 'jitter_max': pytest.approx(4)}
+    hv.report_sync_jitter()
+    assert len(written) == 2
@@ -0,0 +1,66 @@
+import enum
+import fractions
+import math
+
+import pytest
+
+from Doberman.LineProtocol import LineEncoder, format_field
+
+
+def test_escaping():
+    encoder = LineEncoder()
+    line = encoder.encode('my temp,x', {'sensor': 'a,b', 'de vice': 'k=v'}, {'va lue': 1.5}, 1)
+    assert line == b'my\\ temp\\,x,de\\ vice=k\\=v,sensor=a\\,b va\\ lue=1.5 1000'
+
+
+def test_tags_sorted_and_empty_dropped():
+    line = LineEncoder().encode('t', {'z': 1, 'a': 2, 'e': ''}, {'value': 1.}, 1)
+    assert line.startswith(b't,a=2,z=1 ')
+
+
+def test_field_types():
+    assert format_field(True) == 't'
+    assert format_field(False) == 'f'
+    assert format_field(3) == '3i'
+    assert format_field(0.1) == '0.1'
+    assert format_field(1e-20) == '1e-20'
+    assert format_field('say "hi"\\') == '"say \\"hi\\"\\\\"'
+    assert format_field(math.nan) is None
+    assert format_field(math.inf) is None
+
+
+def test_other_numeric_types():
+    assert format_field(enum.IntEnum('E', 'A B').B) == '2i'
+    assert format_field(fractions.Fraction(1, 4)) == '0.25'
+
+
+def test_numpy_scalars():
+    np = pytest.importorskip('numpy')
+    assert format_field(np.int16(-3)) == '-3i'
+    assert format_field(np.uint64(7)) == '7i'
+    assert format_field(np.float32(0.5)) == '0.5'
+    assert format_field(np.float64(np.nan)) is None
+    assert format_field(np.bool_(True)) == 't'
+    assert LineEncoder().encode('t', None, {'value': np.float64(1.5)}, 1) == b't value=1.5 1000'
+
+
+def test_invalid_fields():
+    encoder = LineEncoder()
+    assert encoder.encode('t', None, {'a': math.nan, 'b': 2}, 1) == b't b=2i 1000'
+    with pytest.raises(ValueError):
+        encoder.encode('t', None, {'a': math.nan}, 1)
+
+
+def test_precision_and_override():
+    encoder = LineEncoder(precision=10 ** 9, measurement_override='testing')
+    assert encoder.encode('temperature', None, {'value': 1}, 1.5) == b'testing value=1i 1500000000'
+
+
+def test_prefix_is_cached():
+    encoder = LineEncoder()
+    assert encoder.prefix('t', {'sensor': 'a'}) is encoder.prefix('t', {'sensor': 'a'})
+
+
+def test_batch():
+    points = [('t', {'s': 'a'}, {'value': 1}, 1), ('t', {'s': 'b'}, {'value': 2.}, 2)]
+    assert LineEncoder().encode_batch(points) == b't,s=a value=1i 1000\nt,s=b value=2.0 2000'
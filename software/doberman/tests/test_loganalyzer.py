@@ -0,0 +1,118 @@
+import csv
+import datetime
+import json
+import os
+
+import pytest
+
+from Doberman.LogAnalyzer import LogAnalyzer, analyze_day
+
+DAY = datetime.datetime(2024, 11, 8)
+
+
+def at(minutes):
+    return DAY + datetime.timedelta(minutes=minutes)
+
+
+def write_day(root, day, name, records):
+    path = os.path.join(root, f'{day.year}', f'{day.month:02d}.{day.day:02d}')
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, f'{name}.log'), 'a') as f:
+        for when, level, func, msg in records:
+            f.write(f'{when.isoformat(sep=" ")} | {level} | {name} | {func} | 1 | {msg}\n')
+    return path
+
+
+@pytest.fixture
+def archive(tmp_path):
+    root = str(tmp_path)
+    write_day(root, DAY, 'dev1', [
+        (at(0), 'INFO', '__init__', 'Monitor "dev1" constructing'),
+        (at(1), 'CRITICAL', 'check_threads', 'T_1-thread died'),
+        (at(1.5), 'CRITICAL', 'check_threads', 'T_1-thread died'),
+        (at(3), 'CRITICAL', 'check_threads', 'T_1-thread died (repeated 4 times in 90 s)'),
+        (at(60), 'CRITICAL', 'check_threads', 'T_1-thread died'),
+        (at(120), 'INFO', '__init__', 'Monitor "dev1" constructing'),
+        (at(121), 'WARNING', 'readout', 'No reply'),
+        (at(122), 'WARNING', 'readout', 'No reply (repeated 9 times in 50 s)'),
+    ])
+    write_day(root, DAY, 'hypervisor', [
+        (at(130), 'CRITICAL', 'main', "Caught a <class 'KeyError'> while constructing dev2: 'port'"),
+        (at(131), 'CRITICAL', 'main', "Caught a <class 'KeyError'> while constructing dev2: 'port' "
+                                       "(repeated 2 times in 30 s)"),
+    ])
+    # the episode carries on past midnight, and dev1 restarts again
+    write_day(root, DAY + datetime.timedelta(days=1), 'dev1', [
+        (at(1440 + 60), 'INFO', '__init__', 'Monitor "dev1" constructing'),
+    ])
+    write_day(root, DAY, 'dev1', [(at(1439.5), 'CRITICAL', 'check_threads', 'T_2-thread died')])
+    write_day(root, DAY + datetime.timedelta(days=1), 'dev1', [
+        (at(1440.5), 'CRITICAL', 'check_threads', 'T_2-thread died'),
+    ])
+    return root
+
+
+def test_analyze_day(archive):
+    day = analyze_day(os.path.join(archive, '2024', '11.08'), bucket=3600)
+    assert day['records'] == 11
+    assert day['restarts'] == {'dev1': [at(0).timestamp(), at(120).timestamp()]}
+    deaths = {(thread, start): (end, count) for _, thread, start, end, count in day['thread_deaths']}
+    # the summary counts for its 4 repeats and joins the episode it came from
+    assert deaths == {('T_1', at(1).timestamp()): (at(3).timestamp(), 6),
+                      ('T_1', at(60).timestamp()): (at(60).timestamp(), 1),
+                      ('T_2', at(1439.5).timestamp()): (at(1439.5).timestamp(), 1)}
+    rates = {(process, level): n for process, _, level, n in day['error_rates'] if level == 'WARNING'}
+    assert rates == {('dev1', 'WARNING'): 10}
+    assert day['ctor_failures'] == [('dev2', 'KeyError', "'port'", 3)]
+
+
+def test_analyze_day_time_window(archive):
+    day = analyze_day(os.path.join(archive, '2024', '11.08'), t_start=at(100).timestamp(),
+                      t_end=at(125).timestamp())
+    assert day['records'] == 3
+    assert day['restarts'] == {'dev1': [at(120).timestamp()]}
+    assert day['thread_deaths'] == []
+
+
+def test_repeated_restarts_are_spread_out(tmp_path):
+    path = write_day(str(tmp_path), DAY, 'dev1', [
+        (at(0), 'INFO', '__init__', 'Monitor "dev1" constructing'),
+        (at(2), 'INFO', '__init__', 'Monitor "dev1" constructing (repeated 4 times in 80 s)'),
+    ])
+    t0 = at(0).timestamp()
+    assert analyze_day(path)['restarts'] == {'dev1': [t0, t0 + 60, t0 + 80, t0 + 100, t0 + 120]}
+
+
+def test_mtbf():
+    assert LogAnalyzer.mtbf({'a': [30, 10, 20], 'b': [5]}) == {'a': (3, 10), 'b': (1, None)}
+    # with a window every start is a failure
+    assert LogAnalyzer.mtbf({'a': [10, 20, 30]}, start=0, end=60) == {'a': (3, 20)}
+
+
+def test_run_and_export(archive, tmp_path):
+    analyzer = LogAnalyzer(archive, workers=1)
+    result = analyzer.run()
+    assert result['days'] == 2
+    assert result['records'] == 13
+    assert result['mtbf']['dev1'] == (3, (at(1500).timestamp() - at(0).timestamp()) / 2)
+    # episodes that span midnight are joined
+    t2 = [ep for ep in result['thread_deaths'] if ep[1] == 'T_2']
+    assert t2 == [('dev1', 'T_2', at(1439.5).timestamp(), at(1440.5).timestamp(), 2)]
+    assert 'dev1: 3 starts' in analyzer.report(result)
+
+    analyzer.to_json(result, str(tmp_path / 'out.json'))
+    with open(tmp_path / 'out.json') as f:
+        doc = json.load(f)
+    assert doc['records'] == 13
+    assert ['dev2', 'KeyError', "'port'", 3] in doc['ctor_failures']
+    assert sum(n for *_, level, n in doc['error_rates'] if level == 'CRITICAL') == 12
+
+    analyzer.to_csv(result, str(tmp_path / 'csv'))
+    assert sorted(os.listdir(tmp_path / 'csv')) == ['ctor_failures.csv', 'error_rates.csv', 'restarts.csv',
+                                                    'thread_deaths.csv']
+    with open(tmp_path / 'csv' / 'restarts.csv') as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ['process', 'restarts', 'mtbf_s']
+    assert rows[1][:2] == ['dev1', '3']
+    with open(tmp_path / 'csv' / 'thread_deaths.csv') as f:
+        assert len(list(csv.reader(f))) == 1 + 3
@@ -0,0 +1,160 @@
+import datetime
+import gzip
+import os
+
+import pytest
+
+from Doberman.LogIndex import LogIndex, iter_records, message_template, open_log, process_name
+from Doberman.utils import BlockGzipWriter
+
+DAY = datetime.datetime(2024, 11, 8)
+LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR']
+
+
+def write_log(path, records, compress=False):
+    lines = ''.join(f'{when.isoformat(sep=" ")} | {level} | {name} | func | 1 | {msg}\n'
+                    for when, level, name, msg in records)
+    with (gzip.open(path, 'wt') if compress else open(path, 'w')) as f:
+        f.write(lines)
+
+
+@pytest.fixture
+def archive(tmp_path):
+    """
+    Two days, a hypervisor log and a device log on each, one of them compressed
+    """
+    for d in range(2):
+        day = DAY + datetime.timedelta(days=d)
+        path = tmp_path / f'{day.year}' / f'{day.month:02d}.{day.day:02d}'
+        os.makedirs(path)
+        records = [(day + datetime.timedelta(minutes=i), LEVELS[i % 4], 'hypervisor', f'Check {i} done')
+                   for i in range(100)]
+        write_log(path / 'hypervisor.log.gz', records, compress=True)
+        records = [(day + datetime.timedelta(minutes=i, seconds=30), LEVELS[i % 4], f'T_{i % 3}',
+                    f'Reading {i * 0.5} out of range' if i % 10 == 0 else f'Value {i}')
+                   for i in range(100)]
+        write_log(path / 'dev1.log', records)
+    return tmp_path
+
+
+def search_both(root, **kwargs):
+    """
+    Runs the search without and with the index, which must find the same
+    """
+    index = LogIndex(str(root))
+    plain = list(index.search(**kwargs))
+    index.checkpoint_every = 7
+    index.update(until=DAY.date() + datetime.timedelta(days=1))
+    assert list(index.search(**kwargs)) == plain
+    return plain
+
+
+def test_helpers():
+    assert process_name('hypervisor.log.gz') == 'hypervisor'
+    assert process_name('dev1.2.log') == 'dev1'
+    assert message_template('Reading 1.5e3 out of range 2') == message_template('Reading -7 out of range 4')
+
+
+def test_index_day_is_reused(archive):
+    index = LogIndex(str(archive))
+    path = os.path.join(index.day_dir(DAY), '')
+    doc = index.index_day(path)
+    assert set(doc['files']) == {'dev1.log', 'hypervisor.log.gz'}
+    assert doc['files']['dev1.log']['loggers']['T_0']['DEBUG'][0] == 9
+    mtime = os.stat(os.path.join(path, LogIndex.index_name)).st_mtime_ns
+    assert index.index_day(path) == doc
+    assert os.stat(os.path.join(path, LogIndex.index_name)).st_mtime_ns == mtime
+
+
+def test_search_filters(archive):
+    recs = search_both(archive, logger='T_1', level='ERROR')
+    assert len(recs) == 2 * 8
+    assert all(r.name == 'T_1' and r.level == 'ERROR' for r in recs)
+    recs = search_both(archive, process='hypervisor', contains='Check 42 ')
+    assert [r.time for r in recs] == [DAY + datetime.timedelta(days=d, minutes=42) for d in range(2)]
+    recs = search_both(archive, contains='out of range')
+    assert len(recs) == 20 and all(r.file.endswith('dev1.log') for r in recs)
+
+
+def test_search_time_window(archive):
+    start = DAY + datetime.timedelta(days=1, minutes=50)
+    end = start + datetime.timedelta(minutes=10)
+    recs = search_both(archive, start=start, end=end, process='hypervisor')
+    assert [r.msg for r in recs] == [f'Check {i} done' for i in range(50, 60)]
+
+
+def test_search_limit_and_reverse(archive):
+    recs = search_both(archive, process='dev1', limit=3)
+    assert [r.msg for r in recs] == ['Reading 0.0 out of range', 'Value 1', 'Value 2']
+    recs = search_both(archive, process='dev1', limit=2, reverse=True)
+    assert [r.msg for r in recs] == ['Value 99', 'Value 98']
+    assert recs[0].time.date() == DAY.date() + datetime.timedelta(days=1)
+
+
+def test_multiline_records(tmp_path):
+    path = tmp_path / '2024' / '11.08'
+    os.makedirs(path)
+    with open(path / 'dev1.log', 'w') as f:
+        f.write(f'{DAY.isoformat(sep=" ")} | ERROR | device | func | 1 | Traceback\n  line 1\n  line 2\n'
+                f'{(DAY + datetime.timedelta(seconds=1)).isoformat(sep=" ")} | INFO | device | func | 1 | ok\n')
+    recs = search_both(tmp_path, level='ERROR')
+    assert [r.msg for r in recs] == ['Traceback\n  line 1\n  line 2']
+
+
+def test_open_log_seeks_by_block(tmp_path):
+    path = str(tmp_path / 'dev1.log.gz')
+    w = BlockGzipWriter(path, block_size=200)
+    lines = [f'{(DAY + datetime.timedelta(seconds=i)).isoformat(sep=" ")} | INFO | T_1 | func | 1 | Value {i}\n'
+             for i in range(50)]
+    for line in lines:
+        w.write(line)
+    w.close()
+    data = ''.join(lines).encode()
+    with open(path + '.blocks') as f:
+        blocks = [tuple(map(int, line.split())) for line in f]
+    assert len(blocks) > 5
+    # wreck the first block, which a reader starting further on must never touch
+    with open(path, 'r+b') as f:
+        f.write(b'\0' * blocks[1][0])
+    offset = data.index(lines[30].encode())
+    with open_log(path, offset) as f:
+        assert f.read() == data[offset:]
+    records = list(iter_records(path, offset))
+    assert [msg for _, (*_, msg) in records] == [f'Value {i}' for i in range(30, 50)]
+    assert records[0][0] == offset
+
+
+def test_changed_files_are_scanned(archive):
+    index = LogIndex(str(archive))
+    index.update(until=DAY.date() + datetime.timedelta(days=1))
+    path = os.path.join(index.day_dir(DAY), 'dev1.log')
+    # appended to after indexing
+    write_log(path + '.new', [(DAY + datetime.timedelta(hours=5), 'ERROR', 'T_9', 'Late 1')])
+    with open(path, 'a') as f, open(path + '.new') as new:
+        f.write(new.read())
+    os.remove(path + '.new')
+    assert [r.msg for r in index.search(logger='T_9')] == ['Late 1']
+
+
+def test_same_size_rewrites_are_noticed(tmp_path):
+    path = tmp_path / '2024' / '11.08'
+    os.makedirs(path)
+    fn = str(path / 'dev1.log')
+    t = 1_700_000_000 * 10 ** 9
+    write_log(fn, [(DAY, 'INFO', 'T_1', 'Value 1')])
+    os.utime(fn, ns=(t, t))
+    index = LogIndex(str(tmp_path))
+    index.update(until=DAY.date())
+    assert [r.msg for r in index.search(contains='Other')] == []
+    # same size, and the mtime only moves within the same second
+    write_log(fn, [(DAY, 'INFO', 'T_1', 'Other 1')])
+    os.utime(fn, ns=(t, t + 1000))
+    assert [r.msg for r in index.search(contains='Other')] == ['Other 1']
+
+
+def test_update_since(archive):
+    index = LogIndex(str(archive))
+    second = DAY + datetime.timedelta(days=1)
+    assert index.update(until=second.date(), since=second.date()) == 1
+    assert index.load_day(index.day_dir(DAY)) is None
+    assert index.load_day(index.day_dir(second)) is not None
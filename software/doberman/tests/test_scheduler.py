@@ -0,0 +1,182 @@
+import threading
+import time
+
+import pytest
+
+from Doberman.BaseMonitor import ScheduledTask, Scheduler, WorkerLane
+
+
+class Logger(object):
+
+    def __getattr__(self, level):
+        return lambda msg: None
+
+
+class FakeScheduler(object):
+    """
+    Records when tasks ask to be run, instead of running them
+    """
+
+    def __init__(self, stagger=10):
+        self.stagger = stagger
+        self.queued = []
+        self.tasks = 0
+
+    phase = Scheduler.phase
+
+    def add(self, task, when):
+        self.queued.append(when)
+
+    def add_task(self, task):
+        self.tasks += 1
+
+    def drop_task(self, task):
+        self.tasks -= 1
+
+    def is_alive(self):
+        return True
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_phase_stagger():
+    s = FakeScheduler(stagger=10)
+    phases = [s.phase(f'sensor_{i}', 60) for i in range(50)]
+    assert all(0 <= p < 10 for p in phases)
+    assert len(set(phases)) == 50
+    assert s.phase('sensor_1', 60) == phases[1]
+    # never more than a period
+    assert all(0 <= s.phase(f'sensor_{i}', 2) < 2 for i in range(50))
+
+
+def test_shared_key_shares_the_phase(clock):
+    s = FakeScheduler()
+    a = ScheduledTask(s, 'T_1', lambda: None, 5, Logger(), key='dev1')
+    b = ScheduledTask(s, 'T_2', lambda: None, 5, Logger(), key='dev1')
+    a.start()
+    b.start()
+    assert s.queued[0] == s.queued[1] == 1000 + s.phase('dev1', 5)
+    assert s.tasks == 2
+
+
+def test_missed_slots_are_skipped(clock):
+    s = FakeScheduler()
+    task = ScheduledTask(s, 'slow', lambda: clock.__setitem__(0, clock[0] + 25), 10, Logger())
+    task.start()
+    first = s.queued[0]
+    clock[0] = first
+    task.run_once()
+    # the run took 25 s, so the two slots it covered are skipped and the phase is kept
+    assert s.queued[1] == first + 30
+    clock[0] = s.queued[1] + 1
+    task.func = lambda: None
+    task.run_once()
+    assert s.queued[2] == first + 40
+
+
+def test_period_returned_by_the_task(clock):
+    s = FakeScheduler()
+    periods = iter([3, 'not a number', 0, -1, 7.5])
+    task = ScheduledTask(s, 'adaptive', lambda: next(periods), 10, Logger())
+    task.start()
+    expected = [3, 3, 3, 3, 7.5]
+    for period in expected:
+        clock[0] = s.queued[-1]
+        task.run_once()
+        assert task.period == period
+        assert s.queued[-1] - s.queued[-2] == period
+
+
+def test_stopped_tasks_leave_the_lane(clock):
+    s = FakeScheduler()
+    task = ScheduledTask(s, 'task', lambda: task.event.set(), 10, Logger())
+    task.start()
+    task.run_once()
+    assert len(s.queued) == 1
+    assert s.tasks == 0
+    assert not task.is_alive()
+
+
+def test_hung_tasks_are_not_alive(clock):
+    s = FakeScheduler()
+    seen = []
+
+    def func(duration):
+        seen.append(task.is_alive())
+        clock[0] += duration
+        seen.append(task.is_alive())
+
+    task = ScheduledTask(s, 'task', lambda: func(29), 10, Logger(), hang_timeout=30)
+    task.start()
+    task.run_once()
+    task.func = lambda: func(31)
+    task.run_once()
+    assert seen == [True, True, True, False]
+    # it came back, so it's fine again
+    assert task.is_alive()
+    # the default is 3 periods, but at least a minute
+    task = ScheduledTask(s, 'task', lambda: func(61), 10, Logger())
+    task.start()
+    task.run_once()
+    task = ScheduledTask(s, 'task', lambda: func(89), 30, Logger())
+    task.start()
+    task.run_once()
+    assert seen[4:] == [True, False, True, True]
+
+
+def test_lane_grows_with_its_tasks():
+    lane = WorkerLane('test', workers=1)
+    release = threading.Event()
+    started = threading.Semaphore(0)
+
+    def block():
+        started.release()
+        release.wait(5)
+
+    lane.tasks = 3
+    for _ in range(3):
+        lane.submit(block)
+        assert started.acquire(timeout=5)
+    assert len(lane.threads) == 3
+    # every task has a thread, more can only queue
+    done = threading.Event()
+    lane.submit(done.set)
+    assert not done.wait(0.1)
+    release.set()
+    assert done.wait(5)
+    # idle threads get reused
+    for _ in range(10):
+        done.clear()
+        lane.submit(done.set)
+        assert done.wait(5)
+    assert len(lane.threads) == 3
+    lane.shutdown()
+    with pytest.raises(RuntimeError):
+        lane.submit(done.set)
+
+
+def test_blocking_tasks_dont_starve_the_others():
+    scheduler = Scheduler(Logger(), workers=1, readout_workers=1, stagger=0)
+    scheduler.start()
+    release = threading.Event()
+    ticks = []
+    blockers = [ScheduledTask(scheduler, f'slow_{i}', lambda: release.wait(5), 0.01, Logger(), lane='readout')
+                for i in range(3)]
+    quick = ScheduledTask(scheduler, 'quick', lambda: ticks.append(time.monotonic()), 0.01, Logger(), lane='readout')
+    try:
+        for task in blockers + [quick]:
+            task.start()
+        deadline = time.monotonic() + 5
+        while len(ticks) < 10 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(ticks) >= 10
+    finally:
+        release.set()
+        for task in blockers + [quick]:
+            task.event.set()
+        scheduler.close()
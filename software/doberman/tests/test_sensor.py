@@ -0,0 +1,298 @@
+import pathlib
+import struct
+import threading
+from types import SimpleNamespace
+
+import pytest
+import zmq
+
+from Doberman.BaseDevice import RevPiDevice
+from Doberman.Sensor import Deadband, Sensor, SnapshotSensor
+import Doberman.utils as utils
+
+
+def publish(deadband, values, config, name='x'):
+    out = []
+    for t, v in enumerate(values):
+        out += deadband.filter(name, v, float(t), config)
+    return out
+
+
+def test_without_deadband_everything_goes_out():
+    values = [1, 1, 1]
+    assert publish(Deadband(), values, None) == [(1, 0.), (1, 1.), (1, 2.)]
+
+
+def test_changes_and_heartbeat():
+    out = publish(Deadband(), [0, 0, 0, 0, 1, 1, 1, 1, 1, 1], (0.1, 5))
+    # the first value, the held value before the step, the step, then the heartbeat
+    assert out == [(0, 0.), (0, 3.), (1, 4.), (1, 9.)]
+
+
+def test_step_is_reconstructed():
+    values = [0, 0.05, 0.08, 0.5, 0.5]
+    out = publish(Deadband(), values, (0.1, 60))
+    assert out == [(0, 0.), (0.08, 2.), (0.5, 3.)]
+    # holding each published value until the next point stays within the threshold
+    for t, v in enumerate(values):
+        held = [pv for pv, pt in out if pt <= t][-1]
+        assert abs(held - v) <= 0.1
+
+
+def test_sensors_are_independent():
+    deadband = Deadband()
+    assert deadband.filter('a', 1, 0., (0, 60)) == [(1, 0.)]
+    assert deadband.filter('b', 1, 0., (0, 60)) == [(1, 0.)]
+    assert deadband.filter('a', 1, 1., (0, 60)) == []
+    assert deadband.filter('b', 2, 1., (0, 60)) == [(2, 1.)]
+
+
+def test_deadband_config():
+    assert utils.deadband_config({}) is None
+    assert utils.deadband_config({'deadband': 0.5}) == (0.5, 60)
+    assert utils.deadband_config({'deadband': {'threshold': 1, 'heartbeat': 10}}) == (1, 10)
+
+
+def test_intervals():
+    doc = {'readout_interval': 5, 'effective_interval': 20}
+    assert utils.effective_interval(doc) == 5
+    assert utils.effective_interval({**doc, 'adaptive': True}) == 20
+    assert utils.publish_interval({'readout_interval': 5, 'deadband': 1}) == 60
+    assert utils.publish_interval({'readout_interval': 5}) == 5
+
+
+class FakeSocket(object):
+
+    def __init__(self, sent):
+        self.sent = sent
+
+    def connect(self, address):
+        pass
+
+    def send_string(self, msg):
+        self.sent.append(msg)
+
+
+class SensorsDB(object):
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.points = []
+
+    def read_from_db(self, collection, cuts):
+        return [dict(self.docs[n]) for n in cuts['name']['$in'] if n in self.docs]
+
+    def get_comms_info(self, which):
+        return 'localhost', {'send': 1}
+
+    def write_to_influx(self, topic, tags, fields, timestamp):
+        self.points.append((tags['sensor'], fields['value'], timestamp))
+
+
+class Logger(object):
+
+    def __init__(self):
+        self.errors = []
+
+    def error(self, msg):
+        self.errors.append(msg)
+
+    def __getattr__(self, level):
+        return lambda msg: None
+
+
+def sensor_doc(name, command, **kwargs):
+    return {'name': name, 'readout_command': command, 'topic': 'temperature', 'subsystem': 'cryo',
+            'readout_interval': 1, 'status': 'online', **kwargs}
+
+
+@pytest.fixture
+def snapshot(tmp_path, monkeypatch):
+    """
+    A SnapshotSensor reading the revpi plugin, with a file as the process image
+    """
+    plugins = pathlib.Path(__file__).resolve().parents[2] / 'doberman_pancake'
+    if not (plugins / 'revpi.py').exists():
+        pytest.skip('revpi plugin not found')
+    revpi = utils.find_plugin('revpi', [str(plugins)])
+    image = tmp_path / 'piControl0'
+    data = bytearray(16)
+    struct.pack_into('<hhB', data, 0, 100, -20, 0b100)
+    image.write_bytes(bytes(data))
+    monkeypatch.setattr(RevPiDevice, 'path', str(image))
+    event = threading.Event()
+    device = revpi({'params': {'snapshot': True, 'positions': {'I_1': [0, 0, 16], 'I_2': [2, 0, 16],
+                                                                 'I_3': [4, 2, 1]}}, 'sensors': []},
+                   Logger(), event)
+    scheduler = threading.Thread(target=device.readout_scheduler, daemon=True)
+    scheduler.start()
+    sent = []
+    monkeypatch.setattr(zmq.Context, 'instance', lambda: SimpleNamespace(socket=lambda t: FakeSocket(sent)))
+    db = SensorsDB({d['name']: d for d in [
+        sensor_doc('temp', 'r I_1', value_xform=[0, 0.5]),
+        sensor_doc('pres', 'r I_2', is_int=True),
+        sensor_doc('flag', 'r I_3', is_int=True),
+        sensor_doc('slow', 'r I_1', readout_interval=3),
+        sensor_doc('off', 'r I_2', status='offline'),
+        # not in the process image, so it fails on its own
+        sensor_doc('typo', 'r I_9'),
+    ]})
+    logger = Logger()
+    sensor = SnapshotSensor(sensor_names=list(db.docs), db=db, logger=logger, device_name='revpi', device=device)
+    yield SimpleNamespace(sensor=sensor, db=db, sent=sent, logger=logger, device=device, image=image)
+    event.set()
+    with device.cv:
+        device.cv.notify()
+    scheduler.join()
+    device.shutdown()
+
+
+def test_snapshot_fan_out(snapshot):
+    sensor, db = snapshot.sensor, snapshot.db
+    assert snapshot.device.block[0:2] == (0, bytearray(5))
+    assert sensor.readout_interval == 1
+    sensor.do_one_measurement()
+    values = {name: value for name, value, _ in db.points}
+    assert values == {'temp': 50., 'pres': -20, 'flag': 1, 'slow': 100.}
+    # one snapshot, one timestamp
+    assert len({t for _, _, t in db.points}) == 1
+    assert sorted(msg.split()[0] for msg in snapshot.sent) == sorted(values)
+    assert any('typo' in msg for msg in snapshot.logger.errors)
+
+
+def test_snapshot_intervals(snapshot):
+    sensor, db = snapshot.sensor, snapshot.db
+    sensor.do_one_measurement()
+    db.points.clear()
+    sensor.do_one_measurement()
+    assert db.points == []
+    # a second later the fast sensors are due again, the slow one isn't
+    for n in sensor.last:
+        sensor.last[n] -= 1
+    sensor.do_one_measurement()
+    assert sorted(name for name, _, _ in db.points) == ['flag', 'pres', 'temp']
+
+
+def test_snapshot_failed_read(snapshot):
+    sensor, db = snapshot.sensor, snapshot.db
+    sensor.intervals = dict.fromkeys(sensor.intervals, 0.1)
+    sensor.readout_interval = 0.1
+    # the image got shorter than the inputs, so the device can't take the snapshot
+    snapshot.image.write_bytes(b'\0\0')
+    sensor.do_one_measurement()
+    assert db.points == []
+    assert 'Didn\'t get anything from the device!' in snapshot.logger.errors
+    snapshot.image.write_bytes(b'\x02\0\0\0\0')
+    sensor.do_one_measurement()
+    assert {name: value for name, value, _ in db.points} == {'temp': 1., 'pres': 0, 'flag': 0, 'slow': 2.}
+
+
+class SettingsDB(object):
+
+    def __init__(self):
+        self.settings = []
+        self.fail = False
+
+    def set_sensor_setting(self, name, field, value):
+        if self.fail:
+            raise ConnectionError('no db')
+        self.settings.append(value)
+
+
+def adaptive_sensor(**kwargs):
+    doc = {'topic': 'temperature', 'subsystem': 'cryo', 'readout_command': 'r a', 'readout_interval': 4,
+           'adaptive': True, **kwargs}
+    sensor = Sensor.__new__(Sensor)
+    threading.Thread.__init__(sensor)
+    sensor.name = 'x'
+    sensor.device_name = 'dev'
+    sensor.db = SettingsDB()
+    sensor.logger = Logger()
+    sensor.setup(doc)
+    sensor.update_config(doc)
+    return sensor, doc
+
+
+def test_adaptive_config():
+    sensor, doc = adaptive_sensor()
+    assert (sensor.min_interval, sensor.max_interval, sensor.readout_interval) == (1, 16, 4)
+    assert sensor.thresholds is None
+    # a restart picks up where the published interval left off, within the limits
+    sensor, doc = adaptive_sensor(effective_interval=10)
+    assert sensor.readout_interval == 10
+    sensor, doc = adaptive_sensor(effective_interval=100, adaptive={'max_interval': 20, 'tolerance': 0.5})
+    assert (sensor.readout_interval, sensor.tolerance) == (20, 0.5)
+    # the interval it has survives a config reload, unless it's now out of bounds
+    sensor.readout_interval = 12
+    sensor.update_config({**doc, 'adaptive': {'max_interval': 8}})
+    assert sensor.readout_interval == 8
+    sensor.update_config({**doc, 'adaptive': False})
+    assert sensor.readout_interval == 4 and not sensor.adaptive
+    # only a [low, high] pair counts as thresholds
+    sensor.update_config({**doc, 'alarm_thresholds': [1, 5]})
+    assert sensor.thresholds == (1., 5.)
+    for thresholds in ([5, 1], [[1, 1, 'a']], [True, 5], None):
+        sensor.update_config({**doc, 'alarm_thresholds': thresholds})
+        assert sensor.thresholds is None
+
+
+def test_adapt_steps():
+    sensor, _ = adaptive_sensor(adaptive={'tolerance': 1})
+    intervals = []
+    for t, value in enumerate([10, 10, 10.1, 10.6, 12, 15, 15.5]):
+        sensor.adapt(value, float(t))
+        intervals.append(sensor.readout_interval)
+    # steady values relax, big changes halve, in between stays
+    assert intervals == [4, 6, 9, 9, 4.5, 2.25, 2.25]
+    sensor.adapt(15.5, 7.)
+    sensor.adapt(15.5, 7.)
+    assert sensor.readout_interval == 3.375
+    for t in range(8, 20):
+        sensor.adapt(15.5, float(t))
+    assert sensor.readout_interval == 16
+
+
+def test_adapt_near_thresholds():
+    sensor, _ = adaptive_sensor(alarm_thresholds=[0, 100])
+    sensor.adapt(50, 0.)
+    sensor.adapt(50, 1.)
+    assert sensor.readout_interval == 6
+    # within 10% of the band from a threshold
+    sensor.adapt(95, 2.)
+    assert sensor.readout_interval == 1
+    sensor.adapt(50, 3.)
+    sensor.adapt(50, 4.)
+    assert sensor.readout_interval == 1.5
+    # heading for a threshold faster than the next reading
+    sensor.adapt(80, 5.)
+    assert sensor.readout_interval == 1
+
+
+def test_publish_hysteresis():
+    sensor, _ = adaptive_sensor(adaptive={'tolerance': 1, 'publish_holdoff': 60})
+    db = sensor.db
+    for t in range(5):
+        sensor.adapt(10, float(t))
+    # longer intervals go out right away
+    assert db.settings == [4, 6, 9, 13.5, 16]
+    # shorter ones wait for the holdoff, and jitter inside the tolerance never goes out
+    sensor.adapt(20, 5.)
+    sensor.adapt(30, 6.)
+    assert sensor.readout_interval == 4
+    assert db.settings[-1] == 16
+    sensor.adapt(30, 64.)
+    assert db.settings[-1] == 6
+    for t, value in enumerate([40, 40, 50, 50, 50, 60], start=65):
+        sensor.adapt(value, float(t))
+    assert db.settings[-1] == 6
+    assert len(db.settings) == 6
+
+
+def test_publish_retries():
+    sensor, _ = adaptive_sensor()
+    sensor.db.fail = True
+    sensor.adapt(10, 0.)
+    assert sensor.published_interval is None
+    sensor.db.fail = False
+    sensor.adapt(10, 1.)
+    assert sensor.db.settings == [6]
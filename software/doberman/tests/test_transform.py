@@ -0,0 +1,50 @@
+import pytest
+
+from Doberman.Transform import Polynomial, LookupTable, CallendarVanDusen, get_transform
+
+
+def test_polynomial():
+    assert Polynomial([1, 2, 3])(2) == 17
+    assert Polynomial([0, 1])(5) == 5
+    assert Polynomial([])(5) == 0
+    assert Polynomial([1.5])(100) == 1.5
+
+
+def test_lookup_table():
+    table = LookupTable([0, 10, 20], [0, 100, 150])
+    assert table(5) == 50
+    assert table(15) == 125
+    assert table(-1) == 0
+    assert table(25) == 150
+    with pytest.raises(ValueError):
+        LookupTable([0, 1], [0])
+
+
+def test_lookup_table_sorts():
+    assert LookupTable([20, 0, 10], [150, 0, 100])(15) == 125
+
+
+@pytest.mark.parametrize('t,r', [(-200, 18.5201), (-100, 60.2558), (0, 100.), (100, 138.5055),
+                                 (200, 175.8560), (400, 247.0920), (800, 375.7038)])
+def test_cvd_iec60751(t, r):
+    # reference resistances of a PT100 from IEC 60751
+    assert CallendarVanDusen()(r) == pytest.approx(t, abs=1e-3)
+
+
+def test_cvd_r0():
+    assert CallendarVanDusen(r0=1000)(1385.055) == pytest.approx(100, abs=1e-3)
+
+
+def test_many_keeps_none():
+    poly = Polynomial([1, 2])
+    assert poly.many([1, None, 3]) == [3, None, 7]
+    assert poly.many([None]) == [None]
+
+
+def test_get_transform():
+    assert isinstance(get_transform([0, 1]), Polynomial)
+    assert get_transform([0, 1]) is get_transform([0, 1])
+    assert isinstance(get_transform({'type': 'table', 'x': [0, 1], 'y': [0, 2]}), LookupTable)
+    assert isinstance(get_transform({'type': 'cvd'}), CallendarVanDusen)
+    with pytest.raises(ValueError):
+        get_transform({'type': 'nope'})
@@ -0,0 +1,333 @@
+import datetime
+import gzip
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+import Doberman.utils as utils
+
+
+class FakeDate(datetime.date):
+    now = datetime.date(2024, 1, 1)
+
+    @classmethod
+    def today(cls):
+        return cls.now
+
+
+@pytest.fixture
+def make_handler(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils.datetime, 'date', FakeDate)
+    FakeDate.now = datetime.date(2024, 1, 1)
+    made = []
+
+    class Handler(utils.OutputHandler):
+        def get_logdir(self, date):
+            return os.path.join(tmp_path, date.isoformat())
+
+    def make(**kwargs):
+        made.append(Handler('test', 'testing', stdout=False, **kwargs))
+        return made[-1]
+
+    yield make
+    for oh in made:
+        oh.close()
+
+
+@pytest.fixture
+def handler(make_handler):
+    return make_handler()
+
+
+def read(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as f:
+        return f.read()
+
+
+def test_rotates_at_midnight(handler, tmp_path):
+    day1, day2 = datetime.date(2024, 1, 1), datetime.date(2024, 1, 2)
+    handler.write('first', day1)
+    FakeDate.now = day2
+    handler.write('second', day2)
+    handler.close()
+    assert read(str(tmp_path / '2024-01-01' / 'test.log.gz')) == 'first\n'
+    assert read(str(tmp_path / '2024-01-02' / 'test.log')) == 'second\n'
+
+
+def test_late_records_go_into_the_current_file(handler, tmp_path):
+    day1, day2 = datetime.date(2024, 1, 1), datetime.date(2024, 1, 2)
+    FakeDate.now = day2
+    handler.write('today', day2)
+    path = handler.path
+    # ie a suppression summary or a record queued before midnight
+    handler.write('late', day1)
+    handler.write('later', day2)
+    handler.close()
+    assert handler.path == path
+    assert os.path.exists(path)
+    assert not os.path.exists(path + '.gz')
+    assert read(path).endswith('today\nlate\nlater\n')
+
+
+def test_no_rotation_on_the_same_day(handler):
+    path = handler.path
+    handler.rotate()
+    handler.write('still here', FakeDate.now)
+    handler.close()
+    assert handler.path == path
+    assert read(path) == 'still here\n'
+
+
+
+def test_size_rotation_in_a_dotted_directory(tmp_path, monkeypatch):
+    monkeypatch.setattr(utils.datetime, 'date', FakeDate)
+    FakeDate.now = datetime.date(2024, 1, 1)
+    logdir = tmp_path / 'my.logs'
+
+    class Handler(utils.OutputHandler):
+        def get_logdir(self, date):
+            return str(logdir)
+
+    oh = Handler('test', 'testing', stdout=False, config={'rotation': {'max_bytes': 25, 'compress': False}})
+    # 12 characters but 23 bytes, so the second line goes over the limit
+    oh.write('é' * 11, FakeDate.now)
+    oh.flush()
+    assert oh.size == os.path.getsize(oh.path) == 23
+    oh.write('second', FakeDate.now)
+    oh.write('third', FakeDate.now)
+    oh.close()
+    assert sorted(os.listdir(logdir)) == ['test.1.log', 'test.log']
+    assert read(str(logdir / 'test.1.log')) == 'é' * 11 + '\nsecond\n'
+    assert read(str(logdir / 'test.log')) == 'third\n'
+
+
+def test_compress_log(tmp_path):
+    path = str(tmp_path / 'test.log')
+    for text in ('one\n', 'two\n'):
+        with open(path, 'w') as f:
+            f.write(text)
+        assert utils.compress_log(path) == path + '.gz'
+        assert not os.path.exists(path)
+    # the second one is appended as another gzip member
+    assert read(path + '.gz') == 'one\ntwo\n'
+
+
+def test_block_gzip_writer(tmp_path, monkeypatch):
+    path = str(tmp_path / 'test.log.gz')
+    lines = [f'line {i} µ\n' for i in range(100)]
+    w = utils.BlockGzipWriter(path, block_size=100)
+    for line in lines[:50]:
+        w.write(line)
+    assert w.tell() == len(''.join(lines[:50]).encode())
+    w.close()
+    # reopening carries on where the last one stopped
+    w = utils.BlockGzipWriter(path, block_size=100)
+    assert w.tell() == len(''.join(lines[:50]).encode())
+    for line in lines[50:]:
+        w.write(line)
+    w.flush()
+    assert os.path.getsize(path + '.blocks') > 0
+    clock = [time.monotonic() + 100]
+    monkeypatch.setattr(time, 'monotonic', lambda: clock[0])
+    w.write('partial\n')
+    w.flush()
+    # too young to be written yet
+    assert read(path) == ''.join(lines)
+    clock[0] += 11
+    w.flush()
+    assert read(path).endswith('partial\n')
+    w.close()
+    data = ''.join(lines + ['partial\n']).encode()
+    with gzip.open(path, 'rb') as f:
+        assert f.read() == data
+    with open(path + '.blocks') as f:
+        blocks = [tuple(map(int, line.split())) for line in f]
+    assert [b[1] for b in blocks] == [0] + list(itertools.accumulate(b[2] for b in blocks))[:-1]
+    assert sum(b[2] for b in blocks) == len(data)
+    with open(path, 'rb') as f:
+        raw = f.read()
+    for (c, u, n), following in zip(blocks, blocks[1:] + [(len(raw),)]):
+        assert gzip.decompress(raw[c:following[0]]) == data[u:u + n]
+
+
+class FakeDB(object):
+
+    def __init__(self):
+        self.inserted = []
+
+    def insert_into_db(self, collection, docs, **kwargs):
+        self.inserted += docs
+
+
+def test_writer_keeps_order_and_drains_on_close(make_handler):
+    db = FakeDB()
+    oh = make_handler(db=db, db_batch_size=1000, db_flush_interval=60,
+                      config={'suppression': {'default': {'window': 0}}})
+    logger = logging.getLogger('test_writer')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(utils.DobermanLogger(db, 'test_writer', oh))
+    for i in range(500):
+        logger.log(logging.WARNING if i % 100 == 0 else logging.INFO, 'message %d', i)
+    # nothing has been waited for, close has to get everything out
+    oh.close()
+    logger.handlers.clear()
+    lines = read(oh.path).splitlines()
+    assert [line.rsplit(' | ', 1)[1] for line in lines] == [f'message {i}' for i in range(500)]
+    assert [doc['msg'] for doc in db.inserted] == [f'message {i}' for i in range(0, 500, 100)]
+
+
+class BlockingRecords(object):
+    """
+    Makes the writer thread wait on the first record, so the queue can be filled up
+    """
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def process_record(self, record):
+        if record == 'first':
+            self.started.set()
+            self.release.wait(5)
+        return record, FakeDate.now, None
+
+    def sweep(self):
+        pass
+
+
+def test_dropped_records_are_reported(make_handler):
+    oh = make_handler(queue_size=2)
+    records = BlockingRecords()
+    oh.submit(records, 'first')
+    assert records.started.wait(5)
+    for msg in ('second', 'third', 'lost', 'also lost'):
+        oh.submit(records, msg)
+    assert oh.dropped == 2
+    records.release.set()
+    oh.close()
+    lines = read(oh.path).splitlines()
+    # the drops happened before the first record got written
+    assert lines[0].endswith('| WARNING | test | write | 0 | Log queue full, dropped 2 messages')
+    assert lines[1:] == ['first', 'second', 'third']
+
+
+def record(msg, created, level=logging.WARNING, func='f'):
+    return logging.makeLogRecord({'msg': msg, 'message': msg, 'created': created, 'levelno': level,
+                                  'levelname': logging.getLevelName(level), 'funcName': func})
+
+
+def test_suppression_window():
+    s = utils.LogSuppressor(window=10)
+    assert s.check(record('Value 1 out of range', 100)) == (True, None)
+    # same template, so only counted
+    assert s.check(record('Value 2 out of range', 101)) == (False, None)
+    assert s.check(record('Value 3.5e3 out of range', 105)) == (False, None)
+    # other level, other function, other text all count as different messages
+    assert s.check(record('Value 1 out of range', 102, level=logging.ERROR)) == (True, None)
+    assert s.check(record('Value 1 out of range', 102, func='g')) == (True, None)
+    assert s.check(record('Something else', 102)) == (True, None)
+    # the window is over: this one goes out along with the summary of the last one
+    send, summary = s.check(record('Value 4 out of range', 110))
+    assert send
+    assert summary.message == 'Value 3.5e3 out of range (repeated 2 times in 5 s)'
+    assert summary.created == 105
+    assert s.check(record('Value 5 out of range', 119)) == (False, None)
+
+
+def test_sweep_flushes_summaries_per_key():
+    s = utils.LogSuppressor(window=10)
+    s.check(record('a 1', 100))
+    s.check(record('a 2', 101))
+    s.check(record('b 1', 105))
+    s.check(record('b 2', 106))
+    s.check(record('c', 100))
+    assert s.sweep(now=109) == []
+    # a's window is over, c had no repeats so it's just forgotten
+    assert [r.message for r in s.sweep(now=110)] == ['a 2 (repeated 1 time in 1 s)']
+    assert len(s.seen) == 1
+    assert [r.message for r in s.sweep(now=115)] == ['b 2 (repeated 1 time in 1 s)']
+    assert s.sweep(now=200) == []
+    # forgotten, so the next one goes straight out
+    assert s.check(record('a 3', 200)) == (True, None)
+
+
+def test_max_keys():
+    s = utils.LogSuppressor(window=10, max_keys=2)
+    s.check(record('a', 100))
+    s.check(record('b', 100))
+    assert s.check(record('c', 100)) == (True, None)
+    assert s.check(record('c', 101)) == (True, None)
+    assert s.check(record('a', 101)) == (False, None)
+
+
+def test_parse_summary():
+    s = utils.LogSuppressor(window=10)
+    for msg in ('Value 1 out of range', 'Traceback:\n  File "x", line 3\n(repeated)'):
+        s.check(record(msg, 100))
+        for t in (101, 102, 104):
+            s.check(record(msg, t))
+        summary, = s.sweep(now=200)
+        assert utils.LogSuppressor.parse_summary(summary.message) == (msg, 3, 4)
+        assert utils.LogSuppressor.parse_summary(msg) == (msg, 1, 0)
+    assert utils.LogSuppressor.parse_summary('x (repeated 1 time in 0 s)') == ('x', 1, 0)
+
+
+def test_logger_sends_summaries(make_handler):
+    oh = make_handler(config={'suppression': {'default': {'window': 60}, 'quiet': {'window': 0}}})
+    assert utils.DobermanLogger(None, 'quiet', oh).suppressor is None
+    handler = utils.DobermanLogger(None, 'test', oh)
+    # long enough ago that the window is over by the time of the sweep
+    t0 = time.time() - 100
+    for t in (t0, t0 + 1, t0 + 2):
+        handler.emit(record('Value %d', t))
+    handler.sweep()
+    oh.close()
+    lines = [line.split(' | ', 5)[5] for line in read(oh.path).splitlines()]
+    assert lines == ['Value %d', 'Value %d (repeated 2 times in 2 s)']
+
+
+@pytest.mark.parametrize('fmt', ['json', 'msgpack'])
+def test_structured_round_trip(make_handler, fmt):
+    if fmt == 'msgpack':
+        pytest.importorskip('msgpack')
+    oh = make_handler(config={'structured': {'enabled': True, 'format': fmt},
+                              'suppression': {'default': {'window': 0}}})
+    handler = utils.DobermanLogger(None, 'test', oh)
+    records = [('Value %s is %.2f', ('T_1', 1.5)), ('Two\nlines, 3 numbers: %d %d', (1, -2)), ('Has a # in it', ())]
+    t0 = 1731024000.25
+    for i, (msg, args) in enumerate(records):
+        rec = logging.makeLogRecord({'name': 'test', 'msg': msg, 'args': args, 'created': t0 + i,
+                                     'levelno': logging.INFO, 'levelname': 'INFO', 'funcName': 'f', 'lineno': i})
+        handler.emit(rec)
+    try:
+        {}['missing']
+    except KeyError:
+        rec = logging.makeLogRecord({'name': 'test', 'msg': 'Failed after %d tries', 'args': (3,),
+                                     'created': t0 + 10, 'levelno': logging.ERROR, 'levelname': 'ERROR',
+                                     'funcName': 'g', 'lineno': 7, 'exc_info': sys.exc_info()})
+        handler.emit(rec)
+    oh.close()
+    path = oh.path[:-4] + '.dblog'
+    docs = list(utils.iter_structured(path))
+    assert [d['msg'] for d in docs] == ['Value T_1 is 1.50', 'Two\nlines, 3 numbers: 1 -2', 'Has a # in it',
+                                        'Failed after 3 tries']
+    assert docs[0]['tmpl'] == 'Value T_# is #' and docs[0]['args'] == ['1', '1.50']
+    assert 'tmpl' not in docs[2]
+    assert docs[3]['exc'].startswith('Traceback') and docs[3]['exc'].endswith("KeyError: 'missing'")
+    assert docs[3]['lvl'] == logging.ERROR
+    # the text log and the structured one say the same thing
+    assert '\n'.join(utils.structured_to_text(d) for d in docs) + '\n' == read(oh.path)
+
+
+def test_structured_rejects_other_files(tmp_path):
+    path = tmp_path / 'test.log'
+    path.write_text('not a structured log\n')
+    with pytest.raises(ValueError):
+        list(utils.iter_structured(str(path)))
@@ -1,9 +1,8 @@
-from Doberman import Device
-import time
-import fcntl
-import struct
+from Doberman import RevPiDevice
+import threading
 
-class pt100mux(Device):
+
+class pt100mux(RevPiDevice):
     """
     Plug-in for PT100MUX multiplexer. 
     This works together with a given RevPi and must be executed on this RevPi.
@@ -14,23 +13,56 @@ class pt100mux(Device):
                         e.g. ['O_1', 0_2', 'O_3'], where O_1 is connected to PT100MUX input 1 etc.
         analog_output:  name of the analog input (of the RevPi), the analog output of the multiplexer is
                         connected to.
+        settle_time:    seconds to let the analog channel adjust after switching, either one number or
+                        one per channel. Default 1.5
+    The channels are scanned by a background thread, so a readout doesn't hold up the command
+    queue. A readout returns the channels that settled since the previous one and None for the
+    others, so with a readout_interval around the settle time each value goes out soon after it's read.
     """
     
-    def set_parameters(self):
-        self.analog_pos = self.find_pos_by_name(self.params['analog_output'])
-        self.analog_offset = struct.unpack_from('>H', self.analog_pos, 32)[0] >> 8
-    
+    def setup(self):
+        super().setup()
+        # the multiplexer output is a current, always positive
+        self.unsigned.add(self.params['analog_output'])
+        for name in [self.params['analog_output']] + self.params['digital_inputs'][:3]:
+            self.layout(name)
+        settle = self.params.get('settle_time', 1.5)
+        self.settle_times = list(settle) if isinstance(settle, (list, tuple)) else [settle] * 8
+        self.latest = [None] * 8
+        self.lock = threading.Lock()
+        self.scanner = threading.Thread(target=self.scan, name='pt100mux_scan', daemon=True)
+        self.scanner.start()
+
+    def shutdown(self):
+        # also runs if setup failed before the scanner was started
+        self.event.set()
+        if (scanner := getattr(self, 'scanner', None)) is not None:
+            scanner.join(max(getattr(self, 'settle_times', [0])) + 1)
+        super().shutdown()
+
+    def scan(self):
+        """
+        Steps through the channels until the event is set
+        """
+        i = 0
+        while not self.event.is_set():
+            try:
+                self.switch_channel(i)
+                if self.event.wait(self.settle_times[i]):  # Let analog channel adjust to new value
+                    break
+                value = self.read(self.params['analog_output'])
+                with self.lock:
+                    self.latest[i] = value
+            except Exception as e:
+                self.logger.error(f'Scan caught a {type(e)} on channel {i}: {e}')
+                self.event.wait(1)
+            i = (i + 1) % 8
 
     def send_recv(self, message):
-        ret = {'retcode': 0, 'data': []}
-        for i in range(8):
-            self.switch_channel(i)
-            self.event.wait(1.5)  # Let analog channel adjust to new value
-            with open('/dev/piControl0', 'rb+', 0) as f:
-                f.seek(self.analog_offset)
-                ret['data'].append(int.from_bytes(f.read(2), 'little'))
-        self.logger.debug(f'currents: {ret["data"]}')
-        return ret
+        with self.lock:
+            data, self.latest = self.latest, [None] * 8
+        self.logger.debug(f'currents: {data}')
+        return {'retcode': 0, 'data': data}
 
 
     def switch_channel(self, i):
@@ -41,42 +73,8 @@ class pt100mux(Device):
         self.logger.debug(f'switching to channel {i}')
         bin_str = format(i, '03b')[::-1]  # 0='000', 1='100', 2='010', 3='110', ..., 7='111'
         self.logger.debug(f' binary string: {bin_str}')
-        with open('/dev/piControl0', 'wb+', 0) as f:
-            for j in range(3):
-                bit_pos = self.find_pos_by_name(self.params['digital_inputs'][j])
-                self.write_bit(bit_pos, int(bin_str[j]))
-
-
-    def find_pos_by_name(self, name):
-        """
-        Finds the position information of a parameter in the proccess image
-        :param name: symbolic name of the parameter (defined in piCtory)
-        :returns:   packed byte array which contains symbolic name (32 bytes), offset (2 bytes),
-                    bit (1 byte), and length (2 bytes)
-        """
-        prm = (b'K'[0]<<8) + 17  # function to find a variable by the name defined in piCtory  
-        struct_name = struct.pack('37s', name.encode())
-        with open('/dev/piControl0', 'wb+', 0) as f:
-            ret = fcntl.ioctl(f, prm, struct_name)
-        return ret
-
-
-    def write_bit(self, pos, bitval):
-        """
-        Overwrites a single bit in the process images
-        :param pos: packed array containing position information of the bit. 
-                    Contains name (32 bytes), offset (2 bytes),bit (1 byte), and length (2 bytes)
-        :param bitval: Value to write to the given position
-        """
-        prm = (b'K'[0]<<8) + 16  # function to change single bit
-        value = bytearray([0,0,0,0])
-        offset = struct.unpack_from('>H', pos, 32)[0]
-        bit = struct.unpack_from('B', pos, 34)[0]
-        struct.pack_into('>H', value, 0, offset)
-        struct.pack_into('B', value, 2, bit)
-        struct.pack_into('B', value, 3, bitval)
-        with open('/dev/piControl0', 'wb+', 0) as f:
-            fcntl.ioctl(f, prm, value)
+        for j in range(3):
+            self.write(self.params['digital_inputs'][j], int(bin_str[j]))
 
 
     def process_one_value(self, name, data):
@@ -84,8 +82,8 @@ class pt100mux(Device):
         Convert current measurement [4000-20000]uA to temperature [-200,300]degC.
         Values below 4000uA are set to -1000dC
         :param name: name of the reading
-        :param data: array of 8 current values in uA
+        :param data: array of 8 current values in uA, None for channels without a new reading
         :returns: array of currents converted to temperatures
         """
-        temperatures = list(map(lambda x: 1/32 * (x - 10400), data))
+        temperatures = [None if x is None else 1/32 * (x - 10400) for x in data]
         return temperatures